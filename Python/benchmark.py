@@ -0,0 +1,199 @@
+# Benchmark of the main_code.py stages on synthetic data
+# Generates data at several scales with generate_data.py and times and memory-profiles
+# every stage separately: ingestion, validation, casting, reconciliation, commission check
+# and reporting. The peak memory is the peak of the Python allocations (tracemalloc) inside
+# the stage, so the stages can be compared against each other.
+#
+# Usage: python benchmark.py --scales 1 10 100 --output benchmark.csv
+
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import generate_data
+import main_code
+
+
+def run_stage(results, scale, rows, stage, func, *args):
+    # Run one stage, record its duration and memory peak and return its result
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results.append(
+        {
+            "scale": scale,
+            "register_rows": rows,
+            "stage": stage,
+            "seconds": round(seconds, 4),
+            "peak_mib": round(peak / 2**20, 2),
+        }
+    )
+    return result
+
+
+def read_raw_register(path):
+    # Read the register like read_register() does, without the validation
+    register = pd.read_csv(path)
+    register["provider_name"] = register["provider_name"].astype(str)
+    return register
+
+
+def validate(df, register):
+    # Validate the statements and the register
+    _, statements_parsed = main_code.validate_frame(df)
+    _, register_parsed = main_code.validate_frame(register)
+    return statements_parsed, register_parsed
+
+
+def cast(df, register, parsed):
+    # Cast both frames, reusing the parsed columns of the validation
+    statements_parsed, register_parsed = parsed
+    return (
+        main_code.cast_statements(df.assign(**statements_parsed)),
+        main_code.cast_register(register.assign(**register_parsed)),
+    )
+
+
+def reconcile(df, register, time_window, amount_tolerance):
+    # Pair the statement legs and check them in the register
+    paired, _ = main_code.pair_statement_legs(df)
+    merged_df, _ = main_code.check_register_fullness(
+        paired, register, time_window, amount_tolerance
+    )
+    return merged_df
+
+
+def report(register, check_commissions, dictionary_terms, path):
+    # Build the financial base and both reports and save them to Excel
+    fin = main_code.build_financial_base(register, check_commissions, dictionary_terms)
+    fin_banks = main_code.money_in_units(main_code.aggregate_financial_base(fin))
+    turnover = main_code.build_turnover(fin_banks)
+    turnover_type = main_code.build_turnover_type(fin_banks)
+    main_code.save_excel_reports(turnover, turnover_type, path)
+
+
+def benchmark_scale(scale, args, work_dir):
+    # Generate the data of one scale and run every stage on it
+    rows = args.rows * scale
+    data_dir = os.path.join(work_dir, f"scale_{scale}")
+    statements_path, register_path, tariffs_path = generate_data.generate(
+        data_dir,
+        rows=rows,
+        banks=args.banks,
+        currencies=args.currencies,
+        months=args.months,
+        clients=args.clients * scale,
+        seed=args.seed,
+    )
+    dictionary_terms = main_code.load_tariffs(tariffs_path)
+
+    results = []
+    df = run_stage(
+        results,
+        scale,
+        rows,
+        "ingestion",
+        main_code.read_statements,
+        [statements_path],
+        args.workers,
+    )
+    register = run_stage(
+        results, scale, rows, "register_read", read_raw_register, register_path
+    )
+    parsed = run_stage(results, scale, rows, "validation", validate, df, register)
+    df, register = run_stage(results, scale, rows, "cast", cast, df, register, parsed)
+    merged_df = run_stage(
+        results,
+        scale,
+        rows,
+        "reconciliation",
+        reconcile,
+        df,
+        register,
+        args.time_window,
+        args.amount_tolerance,
+    )
+    check_commissions = run_stage(
+        results,
+        scale,
+        rows,
+        "commission_check",
+        main_code.verify_commissions,
+        merged_df,
+        dictionary_terms,
+    )
+    run_stage(
+        results,
+        scale,
+        rows,
+        "reporting",
+        report,
+        register,
+        check_commissions,
+        dictionary_terms,
+        os.path.join(data_dir, "financial_report.xlsx"),
+    )
+    return results
+
+
+def parse_args(argv=None):
+    # Read the command line options
+    parser = argparse.ArgumentParser(
+        description="Time and memory-profile the stages of main_code.py on synthetic data."
+    )
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        type=int,
+        default=[1, 10, 100],
+        help="multiples of the base data volume",
+    )
+    parser.add_argument(
+        "--rows", type=int, default=2500, help="register rows at scale 1"
+    )
+    parser.add_argument("--banks", type=int, default=2, help="number of banks")
+    parser.add_argument(
+        "--currencies", nargs="+", default=["USD", "EUR"], help="currency codes"
+    )
+    parser.add_argument("--months", type=int, default=3, help="number of months")
+    parser.add_argument(
+        "--clients", type=int, default=3, help="number of clients at scale 1"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="processes parsing the statements"
+    )
+    parser.add_argument(
+        "--time-window", type=float, default=0, help="reconciliation window, seconds"
+    )
+    parser.add_argument(
+        "--amount-tolerance",
+        type=float,
+        default=0,
+        help="reconciliation amount tolerance",
+    )
+    parser.add_argument("--output", help="csv file for the results")
+    return parser.parse_args(argv)
+
+
+# Entry point of the script
+if __name__ == "__main__":
+    args = parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for scale in args.scales:
+            results.extend(benchmark_scale(scale, args, work_dir))
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
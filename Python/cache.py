@@ -0,0 +1,93 @@
+# Binary columnar cache of the parsed statements and the normalized register
+# The DataFrames are stored as uncompressed Arrow IPC (Feather v2) files, so they can be
+# memory-mapped on load: the numeric and datetime columns are used from the mapped file
+# without a copy, and only the text columns are converted to Python strings. A cache file is
+# keyed by the content hash of its sources and by SCHEMA_VERSION; storing a new version of
+# a frame removes the previous files of that kind.
+
+
+import hashlib
+import os
+import uuid
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    # The cache is disabled when pyarrow is not installed
+    pa = None
+    feather = None
+
+
+# Increase when the layout or the types of the cached frames change
+SCHEMA_VERSION = 1
+
+
+def is_available():
+    # Check if the cache can be used
+    return feather is not None
+
+
+def file_hash(path):
+    # Content hash of a file
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def combined_hash(parts):
+    # Hash of several strings (e.g. the names and content hashes of all sources)
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir, kind, content_hash):
+    # Path of the cache file of a frame
+    return os.path.join(cache_dir, f"{kind}-v{SCHEMA_VERSION}-{content_hash}.arrow")
+
+
+def load_frame(cache_dir, kind, content_hash):
+    # Load a cached frame, or return None if it is not in the cache
+    if not is_available():
+        return None
+    path = cache_path(cache_dir, kind, content_hash)
+    if not os.path.exists(path):
+        return None
+    try:
+        table = feather.read_table(path, memory_map=True)
+    except (OSError, pa.ArrowInvalid):
+        # A damaged cache file is treated as a miss
+        return None
+    # One block per column keeps the columns zero-copy views of the file, and the Arrow
+    # buffers are released as soon as their column is converted
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def store_frame(cache_dir, kind, content_hash, df):
+    # Store a frame in the cache and remove its outdated versions
+    if not is_available():
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(cache_dir, kind, content_hash)
+
+    # Write to a temporary file of this run first, so a crash never leaves a half-written
+    # cache file; a cache file that can not be written is skipped
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    try:
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+
+    for name in os.listdir(cache_dir):
+        if name.startswith(f"{kind}-v") and name.endswith(".arrow"):
+            if os.path.join(cache_dir, name) != path:
+                os.remove(os.path.join(cache_dir, name))
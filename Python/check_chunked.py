@@ -0,0 +1,174 @@
+# Regression check of the out-of-core and incremental runs of main_code.py
+# Runs the pipeline on the same inputs in memory, with --memory-budget and with --incremental
+# and compares the verdicts of Task 2 and Task 3 and the financial base. Before the runs, the
+# register rows in the first time window of a month are moved back into the previous month,
+# so that some matches cross the boundaries of the partitions. The incremental run first
+# processes the register as it is and then again with the commentary of one row of the first
+# month edited, so only that month and its neighbours are processed again.
+#
+# Usage: python check_chunked.py --register register.csv --statements employee_task_statements.zip --time-window 14400
+
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import pandas as pd
+
+# Outputs compared between the two runs (the chunked run writes their rows in partition order)
+COMPARED_OUTPUTS = [
+    "register_fullness.csv",
+    "commissions.csv",
+    "reconciliation_unmatched.csv",
+    "reconciliation_ambiguous.csv",
+    "reports_financial_banks_base.csv",
+]
+
+MAIN_CODE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main_code.py")
+
+
+def cross_month_register(path, time_window, out_path):
+    # Write a copy of the register with the rows of the first window of every month moved
+    # back across the month boundary, still within the window of their bank operation
+    register = pd.read_csv(path)
+    datetimes = pd.to_datetime(register["datetime"], errors="coerce")
+    window = pd.Timedelta(seconds=time_window)
+    month_starts = datetimes.dt.to_period("M").dt.start_time
+    offsets = datetimes - month_starts
+    moved = offsets < window
+    register.loc[moved, "datetime"] = (
+        (month_starts[moved] - (window - offsets[moved]) / 2)
+        .dt.floor("s")
+        .dt.strftime("%Y-%m-%d %H:%M:%S")
+    )
+    register.to_csv(out_path, index=False)
+    return int(moved.sum())
+
+
+def edit_first_month(path, out_path):
+    # Write a copy of the register with the commentary of a row of its first month edited
+    register = pd.read_csv(path)
+    months = register["datetime"].astype(str).str[:7]
+    row = register.index[months == months.min()][0]
+    register.loc[row, "commentary"] = f"{register.loc[row, 'commentary']} (edited)"
+    register.to_csv(out_path, index=False)
+
+
+def run_pipeline(work_dir, options, exist_ok=False):
+    # Run main_code.py in its own folder, so that the outputs of the runs are kept apart
+    os.makedirs(work_dir, exist_ok=exist_ok)
+    result = subprocess.run(
+        [sys.executable, MAIN_CODE] + options,
+        cwd=work_dir,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        raise RuntimeError(f"main_code.py {' '.join(options)} failed:\n{result.stderr}")
+
+
+def sorted_output(path):
+    # An output with its rows in a fixed order
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    return df.sort_values(by=list(df.columns)).reset_index(drop=True)
+
+
+def compare_outputs(memory_dir, other_dir):
+    # Names of the outputs that differ between the in-memory run and another one
+    differences = []
+    for name in COMPARED_OUTPUTS:
+        in_memory = sorted_output(os.path.join(memory_dir, name))
+        other = sorted_output(os.path.join(other_dir, name))
+        if not in_memory.equals(other[in_memory.columns]):
+            differences.append(name)
+    return differences
+
+
+def parse_args(argv=None):
+    # Read the command line options
+    parser = argparse.ArgumentParser(
+        description="Compare the verdicts of the in-memory, chunked and incremental runs of main_code.py."
+    )
+    parser.add_argument("--register", default="register.csv")
+    parser.add_argument(
+        "--statements", nargs="+", default=["employee_task_statements.zip"]
+    )
+    parser.add_argument("--tariffs", default="tariffs.csv")
+    parser.add_argument(
+        "--time-window",
+        type=float,
+        default=14400,
+        help="reconciliation window, seconds",
+    )
+    parser.add_argument(
+        "--amount-tolerance",
+        type=float,
+        default=0,
+        help="reconciliation amount tolerance",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=1,
+        help="memory budget in MB of the chunked run",
+    )
+    return parser.parse_args(argv)
+
+
+# Entry point of the script
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as work_dir:
+        register_path = os.path.join(work_dir, "register.csv")
+        edited_path = os.path.join(work_dir, "register_edited.csv")
+        moved = cross_month_register(args.register, args.time_window, register_path)
+        edit_first_month(register_path, edited_path)
+        options = [
+            "--tariffs",
+            os.path.abspath(args.tariffs),
+            "--time-window",
+            str(args.time_window),
+            "--amount-tolerance",
+            str(args.amount_tolerance),
+            "--statements",
+        ] + [os.path.abspath(path) for path in args.statements]
+
+        memory_dir = os.path.join(work_dir, "memory")
+        run_pipeline(memory_dir, ["--register", edited_path] + options)
+        chunked_dir = os.path.join(work_dir, "chunked")
+        run_pipeline(
+            chunked_dir,
+            ["--register", edited_path, "--memory-budget", str(args.memory_budget)]
+            + options,
+        )
+        incremental_dir = os.path.join(work_dir, "incremental")
+        run_pipeline(
+            incremental_dir, ["--register", register_path, "--incremental"] + options
+        )
+        run_pipeline(
+            incremental_dir,
+            ["--register", edited_path, "--incremental"] + options,
+            exist_ok=True,
+        )
+        differences = {
+            mode: compare_outputs(memory_dir, mode_dir)
+            for mode, mode_dir in (
+                ("chunked", chunked_dir),
+                ("incremental", incremental_dir),
+            )
+        }
+
+    print(f"{moved} register rows moved across a month boundary")
+    failed = False
+    for mode, names in differences.items():
+        if names:
+            print(
+                f"The {mode} run differs from the in-memory run in: " + ", ".join(names)
+            )
+            failed = True
+        else:
+            print(f"The {mode} run has the same verdicts as the in-memory run")
+    if failed:
+        sys.exit(1)
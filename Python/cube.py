@@ -0,0 +1,321 @@
+# Rollup cube of the financial base (Task 4)
+# Keeps in a SQLite file the total of every category of the financial base per period,
+# provider and currency at day, week and month grain. The contribution of every register
+# transaction is stored with a hash, so new transactions are added to the stored cells and
+# changed ones are taken out and added again; the monthly fee cells they touch are
+# recomputed from the stored contributions. Report 1, Report 2 and the Tableau base extract
+# can then be read from the cube at any grain instead of regrouping the whole financial base.
+
+
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+# Name of the period column of every grain; the periods are stored as text:
+# day 'YYYY-MM-DD', week 'YYYY-MM-DD' (its Monday), month 'YYYY-MM'
+GRAINS = {"day": "date", "week": "week_start", "month": "year_month"}
+
+# Categories of the financial base and how the cells of a category are combined
+# The "max" categories are monthly fees: they are kept once per month, in the first period
+# that starts in the month at every grain (its first day, the week of its first Monday), so
+# the totals of all grains are the same and a fee never lands in a period of another month
+CATEGORIES = {
+    "income_operations": "sum",
+    "income_commissions": "sum",
+    "income_service_customers": "sum",
+    "income": "sum",
+    "outcome_operations": "sum",
+    "outcome_commissions": "sum",
+    "outcome_service_banks": "max",
+    "outcome": "sum",
+}
+
+KEYS = ["provider_name", "currency"]
+
+# Columns of the base extract, in the order of the financial base aggregated by month
+BASE_COLUMNS = [
+    "provider_name",
+    "currency",
+    "income_operations",
+    "income_commissions",
+    "income_service_customers",
+    "outcome_operations",
+    "outcome_commissions",
+    "outcome_service_banks",
+    "outcome",
+    "income",
+]
+
+
+# Layout version of the cube file (PRAGMA user_version)
+SCHEMA_VERSION = 3
+
+
+def open_cube(path):
+    # Open (and create if needed) the cube
+    conn = sqlite3.connect(path)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    existing = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'cube'"
+    ).fetchone()[0]
+    if existing and version != SCHEMA_VERSION:
+        conn.close()
+        raise ValueError(
+            f"The rollup cube '{path}' has an older layout; rebuild it from the register"
+        )
+
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cube (grain TEXT, period TEXT, provider_name TEXT, "
+        "currency TEXT, category TEXT, value REAL, "
+        "PRIMARY KEY (grain, period, provider_name, currency, category))"
+    )
+    # The contribution of every transaction, to take it out again when it changes
+    categories = ", ".join(f"{category} REAL" for category in CATEGORIES)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cube_transactions (transaction_id TEXT PRIMARY KEY, "
+        f"row_hash TEXT, datetime TEXT, provider_name TEXT, currency TEXT, {categories})"
+    )
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+    return conn
+
+
+def period_labels(datetimes, grain):
+    # Period of every datetime at a grain, as text
+    datetimes = pd.to_datetime(pd.Series(datetimes))
+    if grain == "day":
+        return datetimes.dt.strftime("%Y-%m-%d")
+    if grain == "week":
+        monday = datetimes.dt.normalize() - pd.to_timedelta(
+            datetimes.dt.weekday, unit="D"
+        )
+        return monday.dt.strftime("%Y-%m-%d")
+    return datetimes.dt.strftime("%Y-%m")
+
+
+TRANSACTION_COLUMNS = (
+    ["transaction_id", "row_hash", "datetime"] + KEYS + list(CATEGORIES)
+)
+
+
+def transaction_contributions(fin):
+    # Contribution of every transaction (its rows combined per category) and its hash
+    fin = fin.assign(
+        transaction_id=fin["transaction_id"].astype(str),
+        datetime=pd.to_datetime(fin["datetime"]),
+        provider_name=fin["provider_name"].astype(object).astype(str),
+        currency=fin["currency"].astype(object).astype(str),
+    )
+    contributions = (
+        fin.groupby("transaction_id", sort=False)
+        .agg(
+            datetime=("datetime", "first"),
+            provider_name=("provider_name", "first"),
+            currency=("currency", "first"),
+            **{category: (category, how) for category, how in CATEGORIES.items()},
+        )
+        .reset_index()
+    )
+    row_hash = pd.util.hash_pandas_object(
+        contributions.drop(columns=["transaction_id"]), index=False
+    )
+    contributions.insert(1, "row_hash", row_hash.astype(str).to_numpy())
+    return contributions
+
+
+def stored_contributions(conn, ids):
+    # Stored contributions of the given transactions
+    conn.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS lookup_ids (transaction_id TEXT PRIMARY KEY)"
+    )
+    conn.execute("DELETE FROM lookup_ids")
+    conn.executemany("INSERT OR IGNORE INTO lookup_ids VALUES (?)", [(i,) for i in ids])
+    stored = pd.read_sql_query(
+        "SELECT t.* FROM cube_transactions t JOIN lookup_ids USING (transaction_id)",
+        conn,
+    )
+    conn.execute("DELETE FROM lookup_ids")
+    stored["datetime"] = pd.to_datetime(stored["datetime"])
+    return stored
+
+
+def fee_periods(months, grain):
+    # Period of the fee cells of every month at a grain: the first period starting in it
+    starts = pd.PeriodIndex(pd.Series(months).astype(str), freq="M").start_time
+    if grain == "week":
+        starts = starts + pd.to_timedelta((7 - starts.weekday) % 7, unit="D")
+    return period_labels(starts, grain)
+
+
+def add_cells(conn, contributions, sign):
+    # Add (sign=1) or take out (sign=-1) the summed categories of contributions in the cells
+    # of every grain
+    upsert = (
+        "INSERT INTO cube (grain, period, provider_name, currency, category, value) "
+        "VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (grain, period, provider_name, currency, category) DO UPDATE SET "
+        "value = value + excluded.value"
+    )
+    sums = [category for category, how in CATEGORIES.items() if how == "sum"]
+    contributions = contributions.assign(
+        **{category: contributions[category] * sign for category in sums}
+    )
+    for grain in GRAINS:
+        cells = grain_cells(
+            contributions, period_labels(contributions["datetime"], grain), "sum"
+        )
+        conn.executemany(
+            upsert,
+            [
+                (grain, period, str(provider), str(currency), category, float(value))
+                for period, provider, currency, category, value in cells.itertuples(
+                    index=False
+                )
+            ],
+        )
+
+
+def set_fee_cells(conn, contributions):
+    # Recompute the fee cells of the months, providers and currencies of the contributions
+    # from all stored contributions, so a changed or moved fee replaces the previous one
+    fees = [category for category, how in CATEGORIES.items() if how == "max"]
+    keys = (
+        contributions.assign(month=contributions["datetime"].dt.strftime("%Y-%m"))[
+            ["month"] + KEYS
+        ]
+        .drop_duplicates()
+        .itertuples(index=False)
+    )
+    conn.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS fee_keys "
+        "(month TEXT, provider_name TEXT, currency TEXT)"
+    )
+    conn.execute("DELETE FROM fee_keys")
+    conn.executemany("INSERT INTO fee_keys VALUES (?, ?, ?)", keys)
+    cells = pd.read_sql_query(
+        "SELECT k.month, k.provider_name, k.currency, "
+        + ", ".join(f"COALESCE(MAX(t.{fee}), 0) AS {fee}" for fee in fees)
+        + " FROM fee_keys k LEFT JOIN cube_transactions t "
+        "ON substr(t.datetime, 1, 7) = k.month AND t.provider_name = k.provider_name "
+        "AND t.currency = k.currency GROUP BY k.month, k.provider_name, k.currency",
+        conn,
+    )
+    conn.execute("DELETE FROM fee_keys")
+
+    upsert = (
+        "INSERT INTO cube (grain, period, provider_name, currency, category, value) "
+        "VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (grain, period, provider_name, currency, category) DO UPDATE SET "
+        "value = excluded.value"
+    )
+    for grain in GRAINS:
+        periods = fee_periods(cells["month"], grain).to_numpy()
+        conn.executemany(
+            upsert,
+            [
+                (grain, period, provider, currency, fee, float(value))
+                for fee in fees
+                for period, provider, currency, value in zip(
+                    periods, cells["provider_name"], cells["currency"], cells[fee]
+                )
+            ],
+        )
+
+
+def update_cube(conn, fin):
+    # Add the new transactions and replace the changed ones; return their number
+    # Unchanged transactions are skipped, so a register can be processed again
+    contributions = transaction_contributions(fin)
+    known = dict(conn.execute("SELECT transaction_id, row_hash FROM cube_transactions"))
+    stored_hash = contributions["transaction_id"].map(known)
+    changed = (
+        stored_hash.notna() & (stored_hash != contributions["row_hash"])
+    ).to_numpy()
+    new = stored_hash.isna().to_numpy()
+    if not (changed.any() or new.any()):
+        return 0
+
+    # Take the previous contributions of the changed transactions out
+    previous = stored_contributions(conn, contributions["transaction_id"][changed])
+    add_cells(conn, previous, -1)
+
+    updated = contributions[changed | new]
+    add_cells(conn, updated, 1)
+    conn.executemany(
+        f"INSERT OR REPLACE INTO cube_transactions ({', '.join(TRANSACTION_COLUMNS)}) "
+        f"VALUES ({', '.join('?' * len(TRANSACTION_COLUMNS))})",
+        updated.assign(datetime=updated["datetime"].dt.strftime("%Y-%m-%d %H:%M:%S"))[
+            TRANSACTION_COLUMNS
+        ].itertuples(index=False),
+    )
+
+    # The fee cells of the months the changed transactions left are recomputed as well
+    set_fee_cells(conn, pd.concat([previous, updated], ignore_index=True))
+
+    # Drop the periods left without any value by the transactions that moved out of them
+    conn.execute(
+        "DELETE FROM cube WHERE (grain, period, provider_name, currency) IN "
+        "(SELECT grain, period, provider_name, currency FROM cube "
+        "GROUP BY grain, period, provider_name, currency HAVING MAX(ABS(value)) < 1e-9)"
+    )
+    check_grain_totals(conn)
+    conn.commit()
+    return len(updated)
+
+
+def grain_cells(fin, periods, how):
+    # (period, provider, currency, category, value) cells of the categories combined by 'how'
+    categories = [category for category, kind in CATEGORIES.items() if kind == how]
+    cells = (
+        fin.assign(period=periods.to_numpy())
+        .groupby(["period"] + KEYS, observed=True)
+        .agg(**{category: (category, how) for category in categories})
+        .reset_index()
+    )
+    return cells.melt(
+        id_vars=["period"] + KEYS, var_name="category", value_name="value"
+    )
+
+
+def check_grain_totals(conn):
+    # Raise an error if the total of a category differs between the grains
+    totals = pd.read_sql_query(
+        "SELECT grain, category, SUM(value) AS value FROM cube GROUP BY grain, category",
+        conn,
+    ).pivot(index="category", columns="grain", values="value")
+    if totals.empty:
+        return
+    month = totals["month"].to_numpy()
+    for grain in GRAINS:
+        if not np.allclose(totals[grain].to_numpy(), month, rtol=1e-9, atol=1e-6):
+            raise ValueError(
+                f"The {grain} totals of the rollup cube differ from the month totals; "
+                "rebuild the cube from the register"
+            )
+
+
+def query_cube(conn, grain):
+    # Base extract of the reports at a grain (the financial base aggregated per period,
+    # provider and currency with the income and outcome totals)
+    cells = pd.read_sql_query(
+        "SELECT period, provider_name, currency, category, value FROM cube WHERE grain = ?",
+        conn,
+        params=[grain],
+    )
+    base = (
+        cells.pivot(index=["period"] + KEYS, columns="category", values="value")
+        .reindex(columns=list(CATEGORIES))
+        .fillna(0.0)
+        .reset_index()
+        .sort_values(by=["period"] + KEYS)
+        .reset_index(drop=True)
+    )
+    base.columns.name = None
+
+    # Add the fixed fees to the totals, as in the monthly aggregation of the financial base
+    base["outcome"] = base["outcome"] + base["outcome_service_banks"]
+    base["income"] = base["income"] + base["income_service_customers"]
+    return base.rename(columns={"period": GRAINS[grain]})[
+        [GRAINS[grain]] + BASE_COLUMNS
+    ]
@@ -0,0 +1,87 @@
+# Offline FX rate store
+# Rates are read once from a local csv table with one row per date and currency pair
+# (date, from_currency, to_currency, rate: 1 from_currency = rate to_currency). Every pair is
+# indexed as sorted date and rate arrays, so whole columns are converted with one as-of
+# lookup (the last rate on or before each date) per currency, without any network calls.
+
+
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+RATE_COLUMNS = ["date", "from_currency", "to_currency", "rate"]
+
+
+@functools.lru_cache(maxsize=None)
+def read_rates(path, mtime):
+    # Read and index the rate table; cached per file version
+    rates = pd.read_csv(path, usecols=RATE_COLUMNS)
+    rates["date"] = pd.to_datetime(rates["date"])
+    rates["rate"] = rates["rate"].astype("float64")
+
+    # {(from, to): (dates as int64 ns, rates)} in date order, with the inverse pairs
+    index = {}
+    for (source, target), pair in rates.groupby(["from_currency", "to_currency"]):
+        pair = pair.sort_values(by="date", kind="stable")
+        dates = pair["date"].to_numpy(dtype="datetime64[ns]").astype("int64")
+        values = pair["rate"].to_numpy()
+        index[(source, target)] = (dates, values)
+        index.setdefault((target, source), (dates, 1 / values))
+    return index
+
+
+def load_rates(path):
+    # Indexed rate table of a csv file (read again only when the file changes)
+    return read_rates(os.path.abspath(path), os.path.getmtime(path))
+
+
+def lookup_rates(rates, currencies, dates, base):
+    # Rate from every currency to the base currency as of every date (NaN if unknown)
+    codes, uniques = pd.factorize(pd.Series(currencies).astype(object))
+    dates = pd.to_datetime(pd.Series(dates)).to_numpy(dtype="datetime64[ns]")
+    dates = dates.astype("int64")
+    result = np.full(len(codes), np.nan)
+
+    for code, currency in enumerate(uniques):
+        rows = codes == code
+        if currency == base:
+            result[rows] = 1.0
+            continue
+        pair = rates.get((currency, base))
+        if pair is None:
+            continue
+        pair_dates, pair_rates = pair
+        # Position of the last rate on or before every date
+        position = np.searchsorted(pair_dates, dates[rows], side="right") - 1
+        values = pair_rates[np.maximum(position, 0)]
+        values[position < 0] = np.nan
+        result[rows] = values
+    return result
+
+
+def missing_rates(currencies, rates_found):
+    # Currencies with rows that could not be converted
+    currencies = pd.Series(currencies).astype(object).to_numpy()
+    return sorted(set(currencies[np.isnan(rates_found)]))
+
+
+def consolidate(frame, keys, value_columns, rates, base, dates):
+    # Convert the value columns to the base currency as of the given dates (one per row)
+    # and add them up per keys (period first); the currency column becomes the base currency
+    # Return the totals and the currencies without a rate
+    found = lookup_rates(rates, frame["currency"], dates, base)
+    converted = frame.assign(
+        **{
+            column: frame[column].to_numpy(dtype="float64", na_value=np.nan) * found
+            for column in value_columns
+        }
+    )
+    totals = (
+        converted.groupby(keys, sort=True, observed=True)[value_columns]
+        .sum(min_count=1)
+        .reset_index()
+    )
+    totals.insert(1, "currency", base)
+    return totals, missing_rates(frame["currency"], found)
@@ -0,0 +1,361 @@
+# Synthetic data generator for main_code.py
+# Writes a zip archive of banks' statements, a matching company register and a tariff
+# registry at a configurable volume, e.g. to see how the pipeline behaves at 100x or 1000x
+# the size of the sample data.
+#
+# The statements use every dialect the parser handles: ';' or ',' delimiters, separate
+# 'debit'/'credit' columns or 'Debi/Credit' + 'amount', and 'payment info' or 'description'.
+#
+# Usage: python generate_data.py --rows 250000 --banks 4 --currencies USD EUR --months 12 --out data
+
+
+import argparse
+import io
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+COMPANY = "Best Company"
+
+# Names of the generated banks; further banks are numbered
+BANK_NAMES = ["Gold Fix", "Green Field", "Silver Line", "Blue Harbor"]
+
+# Statement dialects: (delimiter, amount layout, description column)
+DIALECTS = [
+    (delimiter, layout, description)
+    for delimiter in (";", ",")
+    for layout in ("debit_credit", "debi_credit_flag")
+    for description in ("payment info", "description")
+]
+
+# Share of the register rows that are customer deposits (each has two bank legs)
+DEPOSIT_SHARE = 0.15
+
+
+def bank_names(banks):
+    # Names of the first 'banks' banks
+    return [
+        BANK_NAMES[i] if i < len(BANK_NAMES) else f"Bank {i + 1}" for i in range(banks)
+    ]
+
+
+def generate_tariffs(banks, currencies, rng):
+    # Tariffs of the banks and of the company, valid at any time
+    rows = []
+    for bank in banks + [COMPANY]:
+        for currency in currencies:
+            company = bank == COMPANY
+            rows.append(
+                {
+                    "bank": bank,
+                    "currency": currency,
+                    "effective_from": "",
+                    "effective_to": "",
+                    "price_per_month": float(
+                        rng.integers(200, 260) if company else rng.integers(70, 120)
+                    ),
+                    "min_deposit": float(rng.integers(0, 5) * 100),
+                    "payout_price": round(
+                        float(
+                            rng.uniform(0.02, 0.026)
+                            if company
+                            else rng.uniform(0.01, 0.017)
+                        ),
+                        3,
+                    ),
+                    "payin_price": 0.0,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def generate_deposits(rows, banks, currencies, months, clients, rng):
+    # Customer deposits: the income rows of the register and the two legs in the statements
+    count = max(1, int(rows * DEPOSIT_SHARE))
+    month_starts = pd.period_range("2023-01", periods=months, freq="M").to_timestamp()
+
+    month = rng.integers(0, months, count)
+    # Keep one day at the end of the month for the payout leg
+    seconds = rng.integers(86400, 27 * 86400, count) // 60 * 60
+    deposits = pd.DataFrame(
+        {
+            "bank": np.array(banks, dtype=object)[rng.integers(0, len(banks), count)],
+            "currency": np.array(currencies, dtype=object)[
+                rng.integers(0, len(currencies), count)
+            ],
+            "client": np.array(clients, dtype=object)[
+                rng.integers(0, len(clients), count)
+            ],
+            "datetime": month_starts[month] + pd.to_timedelta(seconds, unit="s"),
+            "amount": rng.integers(10, 100, count) * 100.0,
+        }
+    )
+    return deposits.sort_values("datetime", kind="stable").reset_index(drop=True)
+
+
+def statement_frame(deposits, tariffs, bank, currency, period):
+    # Rows of one bank statement in the common layout (before the dialect is applied)
+    terms = tariffs[(tariffs["bank"] == bank) & (tariffs["currency"] == currency)].iloc[
+        0
+    ]
+    account = f"{COMPANY}_{currency}"
+    n = len(deposits)
+
+    # The monthly fee of the bank, then the deposit and payout legs of every deposit
+    fee = pd.DataFrame(
+        {
+            "datetime": [period.to_timestamp() + pd.Timedelta(days=1)],
+            "client_name": [""],
+            "credit": [0.0],
+            "debit": [terms["price_per_month"]],
+            "commission": [0.0],
+            "description": [
+                f"Monthly withdrawl according conditions. Period {period - 1}"
+            ],
+        }
+    )
+    descriptions = (
+        "INVOICE: deposit, " + deposits["client"] + " to " + currency
+    ).to_numpy()
+    credits = pd.DataFrame(
+        {
+            "datetime": deposits["datetime"].to_numpy(),
+            "client_name": deposits["client"].to_numpy(),
+            "credit": deposits["amount"].to_numpy(),
+            "debit": np.zeros(n),
+            "commission": np.zeros(n),
+            "description": descriptions,
+        }
+    )
+    debits = pd.DataFrame(
+        {
+            "datetime": deposits["datetime"].to_numpy() + np.timedelta64(2, "m"),
+            "client_name": deposits["client"].to_numpy(),
+            "credit": np.zeros(n),
+            "debit": deposits["amount"].to_numpy(),
+            "commission": deposits["amount"].to_numpy() * terms["payout_price"],
+            "description": descriptions,
+        }
+    )
+    df = pd.concat([fee, credits, debits], ignore_index=True)
+    df = df.sort_values("datetime", kind="stable").reset_index(drop=True)
+
+    df.insert(0, "account_name", account)
+    df.insert(2, "transaction_id", [f"{i + 1}_{account}" for i in range(len(df))])
+    df.insert(3, "provider_name", bank)
+    df.insert(5, "currency", currency)
+    df["datetime"] = df["datetime"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    return df
+
+
+def apply_dialect(df, dialect):
+    # Bring a statement to the columns of one bank dialect
+    delimiter, layout, description = dialect
+    df = df.rename(columns={"description": description})
+    if layout == "debi_credit_flag":
+        df["Debi/Credit"] = np.where(df["credit"] > 0, "C", "D")
+        df["amount"] = np.where(df["credit"] > 0, df["credit"], df["debit"])
+        columns = [
+            "account_name",
+            "datetime",
+            "transaction_id",
+            "provider_name",
+            "client_name",
+            "Debi/Credit",
+            "currency",
+            "amount",
+            "commission",
+            description,
+        ]
+    else:
+        columns = [
+            "account_name",
+            "datetime",
+            "transaction_id",
+            "provider_name",
+            "client_name",
+            "currency",
+            "commission",
+            description,
+            "credit",
+            "debit",
+        ]
+    return df[columns]
+
+
+def write_statement(df, dialect, bank, currency, period):
+    # Text of one statement file: the preamble, the header and the rows
+    delimiter = dialect[0]
+    preamble = (
+        f"bank: {bank}\naccount: {COMPANY}_{currency}\n"
+        f"currency: {currency}\nfo period: {period}\n\n"
+    )
+    buffer = io.StringIO()
+    buffer.write(preamble)
+    df = apply_dialect(df, dialect)
+    # Amounts are whole numbers; the ';' banks write the commission with a decimal comma
+    for column in ("credit", "debit", "amount"):
+        if column in df:
+            df[column] = df[column].astype("int64")
+    if delimiter == ";":
+        df["commission"] = df["commission"].map(repr).str.replace(".", ",", regex=False)
+    df.to_csv(buffer, sep=delimiter, index=False, lineterminator="\n")
+    return buffer.getvalue()
+
+
+def generate_register(deposits, tariffs, rows, currencies, months, clients, rng):
+    # Register rows: deposits (income), transfers to fx and monthly fees (outcome)
+    company = tariffs[tariffs["bank"] == COMPANY].set_index("currency")
+    provider_ids = {
+        bank: float(i + 1) for i, bank in enumerate(sorted(deposits["bank"].unique()))
+    }
+
+    income = pd.DataFrame(
+        {
+            "datetime": deposits["datetime"],
+            "provider_id": deposits["bank"].map(provider_ids),
+            "account_name": deposits["client"] + "_" + deposits["currency"],
+            "provider_name": deposits["bank"],
+            "operation_type": "income",
+            "currency": deposits["currency"],
+            "amount": deposits["amount"],
+            "commission": 0.0,
+            "commentary": "INVOICE: deposit, "
+            + deposits["client"]
+            + " to "
+            + deposits["currency"],
+        }
+    )
+
+    # Monthly fees of the company for every client account
+    periods = pd.period_range("2023-01", periods=months, freq="M")
+    fee_keys = pd.MultiIndex.from_product(
+        [periods, clients, currencies], names=["period", "client", "currency"]
+    ).to_frame(index=False)
+    fees = pd.DataFrame(
+        {
+            "datetime": fee_keys["period"].dt.to_timestamp() + pd.Timedelta(days=1),
+            "provider_id": np.nan,
+            "account_name": fee_keys["client"] + "_" + fee_keys["currency"],
+            "provider_name": COMPANY,
+            "operation_type": "outcome",
+            "currency": fee_keys["currency"],
+            "amount": fee_keys["currency"].map(company["price_per_month"]),
+            "commission": 0.0,
+            "commentary": "Monthly withdrawl according conditions. Period "
+            + (fee_keys["period"] - 1).astype(str),
+        }
+    )
+
+    # Transfers to fx fill the remaining rows
+    count = max(0, rows - len(income) - len(fees))
+    month_starts = periods.to_timestamp()
+    currency = np.array(currencies, dtype=object)[
+        rng.integers(0, len(currencies), count)
+    ]
+    client = np.array(clients, dtype=object)[rng.integers(0, len(clients), count)]
+    amount = rng.integers(1, 20, count) * 100.0
+    transfers = pd.DataFrame(
+        {
+            "datetime": month_starts[rng.integers(0, months, count)]
+            + pd.to_timedelta(
+                rng.integers(86400, 28 * 86400, count) // 60 * 60, unit="s"
+            ),
+            "provider_id": np.nan,
+            "account_name": client + "_" + currency,
+            "provider_name": np.nan,
+            "operation_type": "outcome",
+            "currency": currency,
+            "amount": amount,
+            "commission": amount
+            * pd.Series(currency).map(company["payout_price"]).to_numpy(),
+            "commentary": "transfer to fx",
+        }
+    )
+
+    register = pd.concat([income, fees, transfers], ignore_index=True)
+    register = register.sort_values("datetime", kind="stable").reset_index(drop=True)
+
+    # Transaction ids are numbered per account, like in the sample register
+    number = register.groupby("account_name").cumcount() + 1
+    register.insert(
+        1, "transaction_id", number.astype(str) + "_" + register["account_name"]
+    )
+    register["datetime"] = register["datetime"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    return register
+
+
+def generate(
+    out_dir, rows=2500, banks=2, currencies=("USD", "EUR"), months=3, clients=3, seed=0
+):
+    # Write the statements archive, the register and the tariffs; return their paths
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    banks = bank_names(banks)
+    currencies = list(currencies)
+    clients = [f"Client {i + 1}" for i in range(clients)]
+
+    tariffs = generate_tariffs(banks, currencies, rng)
+    deposits = generate_deposits(rows, banks, currencies, months, clients, rng)
+    deposits["period"] = deposits["datetime"].dt.to_period("M")
+
+    statements_path = os.path.join(out_dir, "statements.zip")
+    with zipfile.ZipFile(statements_path, "w", zipfile.ZIP_DEFLATED) as myzip:
+        for bank_no, bank in enumerate(banks):
+            dialect = DIALECTS[bank_no % len(DIALECTS)]
+            for currency in currencies:
+                for period in pd.period_range("2023-01", periods=months, freq="M"):
+                    selected = deposits[
+                        (deposits["bank"] == bank)
+                        & (deposits["currency"] == currency)
+                        & (deposits["period"] == period)
+                    ]
+                    df = statement_frame(selected, tariffs, bank, currency, period)
+                    myzip.writestr(
+                        f"{bank}_{currency}_{period}.csv",
+                        write_statement(df, dialect, bank, currency, period),
+                    )
+
+    register_path = os.path.join(out_dir, "register.csv")
+    register = generate_register(
+        deposits, tariffs, rows, currencies, months, clients, rng
+    )
+    register.to_csv(register_path, index=False)
+
+    tariffs_path = os.path.join(out_dir, "tariffs.csv")
+    tariffs.to_csv(tariffs_path, index=False)
+    return statements_path, register_path, tariffs_path
+
+
+def parse_args(argv=None):
+    # Read the command line options
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic banks' statements, a company register and tariffs."
+    )
+    parser.add_argument("--rows", type=int, default=2500, help="register rows")
+    parser.add_argument("--banks", type=int, default=2, help="number of banks")
+    parser.add_argument(
+        "--currencies", nargs="+", default=["USD", "EUR"], help="currency codes"
+    )
+    parser.add_argument("--months", type=int, default=3, help="number of months")
+    parser.add_argument("--clients", type=int, default=3, help="number of clients")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--out", default="synthetic_data", help="output folder")
+    return parser.parse_args(argv)
+
+
+# Entry point of the script
+if __name__ == "__main__":
+    args = parse_args()
+    paths = generate(
+        args.out,
+        rows=args.rows,
+        banks=args.banks,
+        currencies=args.currencies,
+        months=args.months,
+        clients=args.clients,
+        seed=args.seed,
+    )
+    print("Generated: " + ", ".join(paths))
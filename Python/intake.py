@@ -0,0 +1,145 @@
+# Concurrent intake of the banks' statements
+# Sources are zip archives, csv files and drop folders on disk, and http(s):// or file://
+# URLs of archives and statements (e.g. an object-store stand-in served over HTTP).
+# An asyncio event loop discovers and fetches them with a bounded number of reads in
+# flight, and hands every statement to the parser as soon as its bytes have arrived, so
+# the I/O waits overlap with the parsing. The parsed blocks come back in source order.
+# The discovery of the local sources is shared with the serial reading in main_code.py.
+
+
+import asyncio
+import io
+import os
+import urllib.request
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+URL_PREFIXES = ("http://", "https://", "file://")
+
+# Seconds to wait for a URL before giving up
+URL_TIMEOUT = 60
+
+
+def is_url(path):
+    # Check if a source is a URL rather than a local path
+    return path.lower().startswith(URL_PREFIXES)
+
+
+def list_folder(path):
+    # Archives and statements of a drop folder in name order
+    return [
+        os.path.join(path, name)
+        for name in sorted(os.listdir(path))
+        if name.lower().endswith((".zip", ".csv"))
+    ]
+
+
+def archive_members(archive):
+    # Statements of an open zip archive (its folder entries left out)
+    return [name for name in archive.namelist() if not name.endswith("/")]
+
+
+def list_statement_sources(paths):
+    # Expand zip archives, folders and csv files into (path, member) pairs in a stable order
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            sources.extend(list_statement_sources(list_folder(path)))
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                sources.extend((path, member) for member in archive_members(archive))
+        else:
+            sources.append((path, None))
+    return sources
+
+
+def read_file(path):
+    # Content of a local file
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def fetch_url(url):
+    # Content of a URL
+    with urllib.request.urlopen(url, timeout=URL_TIMEOUT) as response:
+        return response.read()
+
+
+def read_member(archive, member):
+    # Decompressed content of a zip member
+    with archive.open(member, "r") as f:
+        return f.read()
+
+
+async def intake_archive(archive, context):
+    # Read the members of an open archive one by one and parse each one as it arrives
+    members = archive_members(archive)
+    tasks = []
+    for member in members:
+        async with context["limit"]:
+            data = await asyncio.to_thread(read_member, archive, member)
+        tasks.append(asyncio.ensure_future(parse(data, context)))
+    return await asyncio.gather(*tasks)
+
+
+async def intake_source(path, context):
+    # Fetch one source (URL, folder, archive or statement); return its parsed blocks in order
+    if is_url(path):
+        async with context["limit"]:
+            data = await asyncio.to_thread(fetch_url, path)
+        if zipfile.is_zipfile(io.BytesIO(data)):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                return await intake_archive(archive, context)
+        return [await parse(data, context)]
+
+    if os.path.isdir(path):
+        children = await asyncio.to_thread(list_folder, path)
+        return await intake_sources(children, context)
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            return await intake_archive(archive, context)
+
+    async with context["limit"]:
+        data = await asyncio.to_thread(read_file, path)
+    return [await parse(data, context)]
+
+
+async def intake_sources(paths, context):
+    # Fetch several sources concurrently; return their parsed blocks in source order
+    results = await asyncio.gather(*(intake_source(path, context) for path in paths))
+    return [block for blocks in results for block in blocks]
+
+
+async def parse(data, context):
+    # Parse the bytes of one statement in the parser pool
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(context["pool"], context["parse"], data)
+
+
+async def run_intake(paths, parse_data, concurrency, workers):
+    # Set up the fetch limit and the parser pool and take in all sources
+    # A single parser thread keeps the event loop free to start further fetches
+    pool = (
+        ProcessPoolExecutor(max_workers=workers)
+        if workers > 1
+        else ThreadPoolExecutor(max_workers=1, thread_name_prefix="parser")
+    )
+    context = {
+        "limit": asyncio.Semaphore(max(1, concurrency)),
+        "pool": pool,
+        "parse": parse_data,
+    }
+    try:
+        return await intake_sources(paths, context)
+    finally:
+        pool.shutdown()
+
+
+def read_sources(paths, parse_data, concurrency=8, workers=1):
+    # Fetch and parse all statements of the given sources; parse_data(bytes) parses one
+    # statement. At most 'concurrency' reads are in flight, 'workers' > 1 parses in processes
+    # (0 = one per CPU core)
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    return asyncio.run(run_intake(list(paths), parse_data, concurrency, workers))
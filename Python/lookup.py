@@ -0,0 +1,222 @@
+# Transaction lookup index
+# A SQLite file holding every register row and every bank statement leg as a JSON record,
+# indexed by transaction id and by (account_name, provider_name, currency, datetime), with
+# the paired credit/debit legs and the register check and commission verdict of every bank
+# operation. Bank transaction ids are only unique within a bank, so the bank legs, the pairs
+# and the verdicts are keyed by (provider_name, transaction_id). It is written as a
+# by-product of a run, so a single payment can be looked up with a few indexed queries
+# instead of reading the output files or running the pipeline.
+
+
+import json
+import sqlite3
+
+import pandas as pd
+
+KEY_COLUMNS = ["account_name", "provider_name", "currency", "datetime"]
+
+# Text form of the datetimes in the secondary key
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+SCHEMA = [
+    "CREATE TABLE register (transaction_id TEXT, account_name TEXT, provider_name TEXT, "
+    "currency TEXT, datetime TEXT, record TEXT)",
+    "CREATE TABLE statements (transaction_id TEXT, account_name TEXT, "
+    "provider_name TEXT, currency TEXT, datetime TEXT, record TEXT)",
+    "CREATE TABLE legs (provider_name TEXT, credit_id TEXT, debit_id TEXT)",
+    "CREATE TABLE verdicts (provider_name TEXT, transaction_id_banks TEXT, "
+    "transaction_id_register TEXT, record TEXT)",
+]
+
+# The indexes are created after the rows are inserted, which is faster than keeping them up
+# to date row by row
+INDEXES = [
+    "CREATE INDEX register_id ON register (transaction_id)",
+    "CREATE INDEX register_key ON register "
+    "(account_name, provider_name, currency, datetime)",
+    "CREATE INDEX statements_id ON statements (provider_name, transaction_id)",
+    "CREATE INDEX statements_bank_id ON statements (transaction_id)",
+    "CREATE INDEX statements_key ON statements "
+    "(account_name, provider_name, currency, datetime)",
+    "CREATE INDEX legs_credit ON legs (provider_name, credit_id)",
+    "CREATE INDEX legs_debit ON legs (provider_name, debit_id)",
+    "CREATE INDEX verdicts_banks ON verdicts (provider_name, transaction_id_banks)",
+    "CREATE INDEX verdicts_register ON verdicts (transaction_id_register)",
+]
+
+
+def json_records(df):
+    # Every row of a DataFrame as a JSON object
+    if df.empty:
+        return []
+    return df.to_json(
+        orient="records", lines=True, date_format="iso", default_handler=str
+    ).splitlines()
+
+
+def text_column(values):
+    # A column as text, with missing values as NULL
+    values = pd.Series(values).astype(object)
+    return values.where(values.notna(), None).astype(object).to_numpy()
+
+
+def keyed_rows(df):
+    # (transaction_id, secondary key..., record) rows of a register or statements frame
+    datetimes = pd.to_datetime(df["datetime"]).dt.strftime(DATETIME_FORMAT)
+    columns = [text_column(df["transaction_id"])]
+    columns += [text_column(df[column]) for column in KEY_COLUMNS[:-1]]
+    columns += [text_column(datetimes), json_records(df)]
+    return zip(*columns)
+
+
+def build_index(path, statements, register, links, verdicts):
+    # Write the index of a run to a new SQLite file; the frames are in currency units
+    conn = sqlite3.connect(path)
+    try:
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.executemany(
+            "INSERT INTO register VALUES (?, ?, ?, ?, ?, ?)", keyed_rows(register)
+        )
+        conn.executemany(
+            "INSERT INTO statements VALUES (?, ?, ?, ?, ?, ?)", keyed_rows(statements)
+        )
+        conn.executemany(
+            "INSERT INTO legs VALUES (?, ?, ?)",
+            zip(
+                text_column(links["provider_name"]),
+                text_column(links["credit_id"]),
+                text_column(links["debit_id"]),
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO verdicts VALUES (?, ?, ?, ?)",
+            zip(
+                text_column(verdicts["provider_name"]),
+                text_column(verdicts["transaction_id_banks"]),
+                text_column(verdicts["transaction_id_register"]),
+                json_records(verdicts),
+            ),
+        )
+        for statement in INDEXES:
+            conn.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def open_index(path):
+    # Open an index for lookups only
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+
+def select(conn, table, column, values, provider_name=None):
+    # Records of the rows of a table whose column is one of the values (and of one bank)
+    values = sorted(set(values))
+    if not values:
+        return []
+    marks = ", ".join("?" * len(values))
+    query = f"SELECT record FROM {table} WHERE {column} IN ({marks})"
+    if provider_name is not None:
+        query += " AND provider_name = ?"
+        values.append(provider_name)
+    return [json.loads(record) for (record,) in conn.execute(query, values)]
+
+
+def bank_operation(conn, provider_name, credit_id):
+    # Bank legs (the credit and its paired debits), verdicts and matched register rows of
+    # the credit with this id at one bank
+    debit_ids = [
+        debit_id
+        for (debit_id,) in conn.execute(
+            "SELECT debit_id FROM legs WHERE provider_name = ? AND credit_id = ?",
+            (provider_name, credit_id),
+        )
+    ]
+    verdicts = select(
+        conn, "verdicts", "transaction_id_banks", [credit_id], provider_name
+    )
+    register_ids = [
+        verdict["transaction_id_register"]
+        for verdict in verdicts
+        if verdict["transaction_id_register"] is not None
+    ]
+    return {
+        "provider_name": provider_name,
+        "transaction_id": credit_id,
+        "statements": select(
+            conn,
+            "statements",
+            "transaction_id",
+            [credit_id] + debit_ids,
+            provider_name,
+        ),
+        "verdicts": verdicts,
+        "register": select(conn, "register", "transaction_id", register_ids),
+    }
+
+
+def find_transaction(conn, transaction_id, provider_name=None):
+    # Register rows with a transaction id, and the bank operations with it: one entry per
+    # (bank, credit) with its legs, verdicts and matched register rows. A bank id is only
+    # unique within its bank, so the operations of different banks are never merged; the
+    # provider_name narrows the search to one bank.
+    keys = set()
+    query = (
+        "SELECT provider_name, transaction_id FROM statements WHERE transaction_id = ?"
+    )
+    params = [transaction_id]
+    if provider_name is not None:
+        query += " AND provider_name = ?"
+        params.append(provider_name)
+    keys.update(conn.execute(query, params))
+
+    # Bank operations matched to a register transaction
+    keys.update(
+        conn.execute(
+            "SELECT provider_name, transaction_id_banks FROM verdicts "
+            "WHERE transaction_id_register = ?",
+            (transaction_id,),
+        )
+    )
+    if provider_name is not None:
+        keys = {key for key in keys if key[0] == provider_name}
+
+    # A debit leg is answered with the credit it is paired with
+    credits = set()
+    for provider, bank_id in keys:
+        paired = conn.execute(
+            "SELECT credit_id FROM legs WHERE provider_name = ? AND debit_id = ?",
+            (provider, bank_id),
+        ).fetchall()
+        credits.update((provider, credit_id) for (credit_id,) in paired)
+        if not paired:
+            credits.add((provider, bank_id))
+
+    return {
+        "register": select(conn, "register", "transaction_id", [transaction_id]),
+        "operations": [
+            bank_operation(conn, provider, credit_id)
+            for provider, credit_id in sorted(credits, key=str)
+        ],
+    }
+
+
+def find_key(conn, account_name, provider_name, currency, datetime):
+    # Register rows and bank legs with the given account, provider, currency and datetime
+    key = (
+        account_name,
+        provider_name,
+        currency,
+        pd.Timestamp(datetime).strftime(DATETIME_FORMAT),
+    )
+    where = " AND ".join(f"{column} = ?" for column in KEY_COLUMNS)
+    return {
+        table: [
+            json.loads(record)
+            for (record,) in conn.execute(
+                f"SELECT record FROM {table} WHERE {where}", key
+            )
+        ]
+        for table in ("register", "statements")
+    }
@@ -12,130 +12,409 @@
 
 
 import pandas as pd
+import numpy as np
+import argparse
 import zipfile
 import csv
 import openpyxl
 import os
+import re
+import sqlite3
 import sys
-
+import hashlib
+import json
+import tempfile
+import time
+
+import cache
+import cube
+import fx
+import intake
+import lookup
+import metrics
+import service
+import sinks
+import state_store
+
+import functools
+import importlib.resources
 import io
-from detect_delimiter import detect
+import itertools
 from itertools import islice
-from datetime import datetime
-from forex_python.converter import CurrencyCodes
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
 
-def main():
+def main(args=None):
+    # Use the default settings when called without command line arguments
+    if args is None:
+        args = parse_args([])
 
-    #### TASK 1 ####
+    # Bank tariffs used in Task 3 and Task 4
+    dictionary_terms = load_tariffs(args.tariffs)
 
-    # Read the banks' data
-    # Initialize empty lists to store data from the zip files
-    account_name = []
-    datetime = []
-    transaction_id = []
-    provider_name = []
-    client_name = []
-    currency = []
-    debit = []
-    credit = []
-    commission = []
-    description = []
-
-    # Unzip the file 'employee_task_statements.zip'
-    with zipfile.ZipFile("employee_task_statements.zip") as myzip:
-        for file in myzip.namelist():
-            # Detect the delimiter (',' or ';') by analyzing the file's content
-            with myzip.open(file) as f0:
-                del_1 = 0
-                del_2 = 0
-                for line in f0:
-                    del_1 += str(line).count(",")
-                    del_2 += str(line).count(";")
-                # Choose the delimiter with more occurrences
-                if del_1 > del_2:
-                    del_ = ","
-                else:
-                    del_ = ";"
-
-            # Read the file and skip the first 5 lines to get the header from the 6th line
-            with myzip.open(file, "r") as f:
-                reader = csv.reader(io.TextIOWrapper(f), delimiter=del_)
-                iterator = islice(reader, 5, None)
-                headers = next(iterator)
-
-            # Read the file again to parse the data using the detected header
-            with myzip.open(file, "r") as f1:
-                dict_reader = csv.DictReader(
-                    io.TextIOWrapper(f1, encoding="utf-8"),
-                    delimiter=del_,
-                    fieldnames=headers,
-                )
+    # Wall time, CPU time, rows and peak memory of every stage
+    run = metrics.start_run(profile=args.profile is not None)
 
-                # Skip the first 5 lines and start reading data
-                iterator1 = islice(dict_reader, 5, None)
-
-                # Loop through each row in the file
-                for col in iterator1:
-                    # Append the values to respective lists
-                    account_name.append(col["account_name"])
-                    datetime.append(col["datetime"])
-                    transaction_id.append(col["transaction_id"])
-                    provider_name.append(col["provider_name"])
-                    client_name.append(col["client_name"])
-                    currency.append(col["currency"])
-                    commission.append(col["commission"])
-
-                    # Validate fields from various files to ensure consistency in common columns
-                    # Handle credit and debit fields based on the 'Debi/Credit' column
-                    if "Debi/Credit" in col:
-                        if col["Debi/Credit"] == "D":
-                            debit.append(col["amount"])
-                            credit.append(0)
-                        elif col["Debi/Credit"] == "C":
-                            credit.append(col["amount"])
-                            debit.append(0)
-
-                    # Append debit and credit values if they exist
-                    if "debit" in col:
-                        debit.append(col["debit"])
-                    if "credit" in col:
-                        credit.append(col["credit"])
-
-                    # Handle description or payment info fields
-                    if "payment info" in col:
-                        description.append([col["payment info"]])
-                    elif "description" in col:
-                        description.append([col["description"]])
-
-    # Create a DataFrame from the lists
-    df = pd.DataFrame(
-        {
-            "account_name": account_name,
-            "datetime": datetime,
-            "transaction_id": transaction_id,
-            "provider_name": provider_name,
-            "client_name": client_name,
-            "currency": currency,
-            "credit": credit,
-            "debit": debit,
-            "commission": commission,
-            "description": description,
-        }
+    # Format and compression of the outputs, written in parallel by a thread pool; with
+    # metrics, every export stage waits for its own writes
+    sinks.configure(
+        args.output_format,
+        args.compression,
+        args.output_workers,
+        timed=bool(args.metrics or args.profile),
     )
 
-    # Replace the ',' symbol in 'commission' with a '.' for proper numeric parsing
-    df["commission"] = df["commission"].str.replace(",", ".", regex=False)
+    if args.lookup or args.lookup_key:
+        # Answer a question about one payment from the lookup index
+        with metrics.stage(run, "lookup"):
+            print_lookup(args)
+    elif args.watch:
+        # Keep running and process the statements as they arrive in the inbox
+        run_service(args, dictionary_terms)
+    elif args.cube_report:
+        # Answer the reports from the rollup cube without processing the inputs
+        with metrics.stage(run, "cube_report"):
+            publish_cube_reports(args)
+    elif args.incremental:
+        run_incremental(args, dictionary_terms, run)
+    elif args.memory_budget:
+        run_chunked(args, dictionary_terms, run)
+    else:
+        run_full(args, dictionary_terms, run)
 
-    # Convert the description list to a string, removing brackets
-    df["description"] = df["description"].apply(lambda x: ", ".join(x))
+    # Wait for the outputs still being written
+    with metrics.stage(run, "export_wait"):
+        failed = sinks.wait()
 
-    # Perform Validation
+    save_run_metrics(run, args)
+
+    # Exit with an error status if some outputs could not be written
+    if failed:
+        sys.exit(1)
+
+
+@contextmanager
+def export_stage(run, name, rows_in=None):
+    # Stage that saves outputs; the outputs are written by the sink threads, so with metrics
+    # the stage waits for them and measures their I/O as well
+    with metrics.stage(run, name, rows_in) as stage:
+        yield stage
+        sinks.settle()
+
+
+def run_full(args, dictionary_terms, run=None):
+    # Process all statements and the whole register in memory
+
+    #### TASK 1 ####
+
+    # Read, validate and cast the banks' data (or load it from the cache)
     print("Task 1:")
-    perform_validation(df, "Merging and Validating Banks' Records")
+    df = load_statements(args, run)
+
+    # Read, validate and normalize the 'register' file (or load it from the cache)
+    register = load_register(args, run)
+
+    # Keep the amounts as integer minor units in the fixed-point money mode
+    if args.money == "fixed":
+        with metrics.stage(run, "fixed_point", rows_in=len(df) + len(register)):
+            df = to_fixed_point(df, STATEMENT_MONEY_COLUMNS)
+            register = to_fixed_point(register, REGISTER_MONEY_COLUMNS)
+
+    # Share the category dictionaries of the low-cardinality columns in the compact profile
+    if args.dtype_profile == "compact":
+        with metrics.stage(run, "compact_dtypes", rows_in=len(df) + len(register)):
+            frames, report = compact_frames(
+                {"statements": df, "register": register, "tariffs": dictionary_terms}
+            )
+            df = frames["statements"]
+            register = frames["register"]
+            dictionary_terms = frames["tariffs"]
+            report_memory(report)
+
+    # Save the validated banks statements to 'banks_statements.csv'
+    with export_stage(run, "export_statements", rows_in=len(df)) as stage:
+        if save_output(df, "banks_statemetns.csv"):
+            stage["rows_out"] = len(df)
+            print(
+                "The banks' statements are generated by code and saved to the 'banks_statements.csv' file."
+            )
+
+    #### TASK 2 ####
+
+    # Copy the commissions of the paired debit legs to the credits and check them in the register
+    with metrics.stage(run, "pair", rows_in=len(df)) as stage:
+        paired, unpaired, links = pair_statement_legs(df, links=True)
+        stage["rows_out"] = len(paired)
+    with metrics.stage(run, "reconcile", rows_in=len(paired) + len(register)) as stage:
+        merged_df, ambiguous = check_register_fullness(
+            paired,
+            register,
+            time_window=args.time_window,
+            amount_tolerance=args.amount_tolerance,
+        )
+        stage["rows_out"] = len(merged_df)
+
+    # Save the register fullness result to 'register_fullness.csv'
+    with export_stage(run, "export_reconciliation", rows_in=len(merged_df)) as stage:
+        save_output(merged_df, "register_fullness.csv")
+        save_output(unpaired, "unpaired_legs.csv")
+        save_reconciliation(merged_df, ambiguous)
+        stage["rows_out"] = len(merged_df) + len(unpaired)
+
+    #### TASK 3 ####
+
+    with metrics.stage(run, "commission_check", rows_in=len(merged_df)) as stage:
+        check_commissions = verify_commissions(merged_df, dictionary_terms)
+        stage["rows_out"] = len(check_commissions)
+
+    # Save the commissions check result to 'commissions.csv'
+    with export_stage(
+        run, "export_commissions", rows_in=len(check_commissions)
+    ) as stage:
+        save_output(check_commissions, "commissions.csv")
+        stage["rows_out"] = len(check_commissions)
+
+    # Check the recurring monthly fees of every account against the tariffs
+    with export_stage(run, "fee_check", rows_in=len(df) + len(register)) as stage:
+        fee_issues = save_recurring_fees(
+            {"register": register, "statements": df}, dictionary_terms
+        )
+        stage["rows_out"] = len(fee_issues)
+
+    # Index the register rows, bank legs and verdicts for the lookups of single payments
+    if args.index:
+        with metrics.stage(run, "index", rows_in=len(df) + len(register)) as stage:
+            if save_lookup_index(args.index, df, register, links, check_commissions):
+                stage["rows_out"] = len(df) + len(register)
+
+    #### TASK 4 ####
+
+    with metrics.stage(run, "aggregate", rows_in=len(register)) as stage:
+        fin = build_financial_base(register, check_commissions, dictionary_terms)
+        fin_banks = aggregate_financial_base(fin)
+        if args.cube:
+            # Add the new and changed transactions to the rollup cube; the reports of this
+            # run stay the ones of its own register (--cube-report reads the cube)
+            update_rollup_cube(args.cube, fin)
+        stage["rows_out"] = len(fin_banks)
+
+    with export_stage(run, "export_reports", rows_in=len(fin_banks)) as stage:
+        publish_reports(
+            fin_banks, merged_df, ambiguous, check_commissions, args, fee_issues
+        )
+        stage["rows_out"] = len(fin_banks)
+
+    # Evaluate the alternative tariffs against the same financial base
+    if args.scenarios:
+        with export_stage(run, "scenarios", rows_in=len(fin)) as stage:
+            results = simulate_tariff_scenarios(
+                fin, fin_banks, load_scenarios(args.scenarios)
+            )
+            save_output(results, "tariff_scenarios.csv")
+            report_tariff_scenarios(results)
+            stage["rows_out"] = len(results)
+
+    # Fan the financial base out into one statement per client
+    if args.client_statements:
+        with metrics.stage(run, "client_statements", rows_in=len(fin)) as stage:
+            stage["rows_out"] = save_client_statements(
+                fin, args.client_statements, args.client_workers
+            )
+            print(
+                f"\nStatements of {stage['rows_out']} clients have been saved to '{args.client_statements}'."
+            )
+
+
+def save_lookup_index(path, df, register, links, check_commissions):
+    # Replace the lookup index with the one of this run
+    try:
+        with sinks.atomic_path(path) as tmp_path:
+            lookup.build_index(
+                tmp_path,
+                money_in_units(df),
+                money_in_units(register),
+                links,
+                money_in_units(check_commissions),
+            )
+        return True
+    except (OSError, sqlite3.Error) as error:
+        sinks.report_failure(path, error)
+        return False
+
+
+def print_lookup(args):
+    # Print the register rows, bank legs and verdicts of a transaction id or secondary key
+    conn = lookup.open_index(args.index)
+    if args.lookup:
+        found = lookup.find_transaction(conn, args.lookup, args.lookup_provider)
+    else:
+        found = lookup.find_key(conn, *args.lookup_key)
+    conn.close()
+    print(json.dumps(found, indent=2))
+
+
+def save_run_metrics(run, args):
+    # Write the stage metrics and the profile of the slowest stage if they were requested
+    if args.metrics:
+        metrics.write_metrics(run, args.metrics)
+    if args.profile:
+        metrics.dump_hottest_profile(run, args.profile)
+
+
+def publish_reports(
+    fin_banks, merged_df, ambiguous, check_commissions, args=None, fee_issues=None
+):
+    # Print the Task 2 and Task 3 results (with the recurring fee check when it was run) and
+    # build, print and save both Task 4 reports
+    fin_banks = money_in_units(fin_banks)
+
+    print("\nTask 2:")
+    missing = int((~merged_df["is_present_in_register"]).sum())
+    if missing == 0:
+        print("All banks' operations are present in the company register\n")
+    else:
+        print(
+            f"{missing} of {len(merged_df)} banks' operations are not found in the company register"
+        )
+        print(
+            f"{ambiguous['transaction_id_banks'].nunique()} of them have ambiguous matches, see 'reconciliation_unmatched.csv' and 'reconciliation_ambiguous.csv'\n"
+        )
+
+    print("Task 3:")
+    report_commissions(check_commissions)
+    if fee_issues is not None:
+        report_recurring_fees(fee_issues)
+
+    publish_financial_reports(fin_banks, args=args)
+
+
+def publish_financial_reports(fin_banks, grain="month", args=None):
+    # Build, print and save both Task 4 reports at a grain of the rollup cube
+    # The monthly reports keep their file names, the other grains get the grain as suffix
+    period = cube.GRAINS[grain]
+    suffix = "" if grain == "month" else f"_{grain}"
+    base_path = f"reports_financial_banks_base{suffix}.csv"
+    excel_path = f"financial_report{suffix}.xlsx"
+    titles = [
+        name.replace("Monthly", REPORT_GRAIN_TITLES[grain])
+        for name in (REPORT_1_NAME, REPORT_2_NAME)
+    ]
+
+    # Report 1: Company Monthly Income and Outcome Breakdown by Currency
+    turnover = build_turnover(fin_banks, period)
+
+    # Save the report's data to 'reports_financial_banks_base.csv'
+    save_output(fin_banks, base_path)
+
+    # Display Report 1
+    print("\nTask 4:")
+    print(f"The data for the visualization is saved to '{base_path}'.")
+    print(titles[0] + "\n")
+    print(turnover)
+
+    # Report 2: Company Monthly Income and Expense Breakdown by Currency and Type
+    turnover_type = build_turnover_type(fin_banks, period)
+
+    # Display Report 2
+    print("\n" + titles[1] + "\n")
+    print(turnover_type)
+
+    # Consolidate both reports in the base currency when one is requested
+    extra_sheets = []
+    if args is not None and args.base_currency:
+        base = args.base_currency
+        consolidated = consolidate_reports(
+            turnover, turnover_type, period, fx.load_rates(args.fx_rates), base
+        )
+        for number, (title, frame) in enumerate(zip(titles, consolidated), start=1):
+            title = f"{title}, Consolidated in {base}"
+            print("\n" + title + "\n")
+            print(frame)
+            extra_sheets.append((f"Report {number} ({base})", title, frame))
+
+    # Save two reports to different excel sheets to financial_report.xlsx
+    if save_excel_reports(turnover, turnover_type, excel_path, titles, extra_sheets):
+        print(f"\nFinancial reports have been generated and saved to '{excel_path}'.")
+
+
+def period_end_dates(periods, period):
+    # Last moment of every report period, the as-of date of its FX rate
+    if period == "year_month":
+        return pd.PeriodIndex(periods.astype(str), freq="M").end_time
+    days = 7 if period == "week_start" else 1
+    return (
+        pd.to_datetime(periods.astype(str))
+        + pd.Timedelta(days=days)
+        - pd.Timedelta(1, unit="ns")
+    )
+
+
+def consolidate_reports(turnover, turnover_type, period, rates, base):
+    # Report 1 and Report 2 with all currencies converted to the base currency and added up
+    dates = period_end_dates(turnover[period], period)
+    turnover_base, missing = fx.consolidate(
+        turnover, [period], ["income", "outcome", "balance"], rates, base, dates
+    )
+
+    dates = period_end_dates(turnover_type[period], period)
+    turnover_type_base, missing_type = fx.consolidate(
+        turnover_type, [period, "type"], ["amount"], rates, base, dates
+    )
+    turnover_type_base.index = turnover_type_base.index + 1
+
+    missing = sorted(set(missing) | set(missing_type))
+    if missing:
+        print(
+            f"No FX rate to {base} for {', '.join(missing)}; these amounts are left out of the consolidated reports."
+        )
+    return turnover_base, turnover_type_base
+
+
+def update_rollup_cube(path, fin):
+    # Add the financial base to the rollup cube; a cube that can not be updated is left as
+    # it was and reported, so the run still publishes its own reports
+    try:
+        conn = cube.open_cube(path)
+    except (ValueError, sqlite3.Error) as error:
+        print(f"The rollup cube '{path}' is not updated: {error}")
+        return
+    try:
+        cube.update_cube(conn, money_in_units(fin))
+    except (ValueError, sqlite3.Error) as error:
+        print(f"The rollup cube '{path}' is not updated: {error}")
+    finally:
+        conn.close()
+
+
+def publish_cube_reports(args):
+    # Answer both Task 4 reports at the requested grain from the rollup cube, without a run
+    conn = cube.open_cube(args.cube)
+    fin_banks = cube.query_cube(conn, args.cube_report)
+    conn.close()
+    if fin_banks.empty:
+        print(f"The rollup cube '{args.cube}' is empty.")
+        return
+    publish_financial_reports(fin_banks, args.cube_report, args)
+
 
+# Pipeline stages
+
+REPORT_1_NAME = "Company Monthly Income and Outcome Breakdown by Currency"
+REPORT_2_NAME = "Company Monthly Income and Expense Breakdown by Currency and Type"
+
+# Word replacing "Monthly" in the report titles at every grain
+REPORT_GRAIN_TITLES = {"day": "Daily", "week": "Weekly", "month": "Monthly"}
+
+
+def save_output(df, path):
+    # Save a DataFrame through the output sinks (atomic, in the configured format)
+    return sinks.save_frame(money_in_units(df), path)
+
+
+def cast_statements(df):
     # Casting columns to desired types
-    df = df.astype(
+    return df.astype(
         {
             "account_name": "string",
             "datetime": "datetime64[ns]",  # datetime type
@@ -150,30 +429,94 @@ def main():
         }
     )
 
+
+def read_register(path, run=None):
     # Read the 'register' file into a DataFrame
-    register = pd.read_csv("register.csv")
-    register["provider_name"] = register["provider_name"].astype(str)
+    with metrics.stage(run, "ingest_register") as stage:
+        register = pd.read_csv(path)
+        register["provider_name"] = register["provider_name"].astype(str)
+        stage["rows_out"] = len(register)
 
     # Perform Validation
-    perform_validation(register, "Register Validation")
-
-    # Save the validated banks statements to 'banks_statements.csv'
-    # check if file exists
-    try:
-        if os.path.exists("banks_statemetns.csv"):
-            os.remove("banks_statemetns.csv")
-        df.to_csv("banks_statemetns.csv", index=False)
-        print(
-            "The banks' statements are generated by code and saved to the 'banks_statements.csv' file."
-        )
-    except PermissionError:
-        # Raise an error with if permission is denied
-        print(
-            f"Permission denied: The file banks_statemetns.csv might be open in another program or you don't have write access."
+    with metrics.stage(run, "validate_register", rows_in=len(register)) as stage:
+        errors, parsed = perform_validation(register, "Register Validation")
+        stage["rows_out"] = len(register)
+    return register.assign(**parsed), errors
+
+
+def load_statements(args, run=None):
+    # Parse, validate and cast the banks' statements, using the cache when it is enabled
+    # URL sources are always fetched, so the cache is only used for local sources
+    remote = any(intake.is_url(path) for path in args.statements)
+    sources = [] if remote else intake.list_statement_sources(args.statements)
+    content_hash = None
+    if args.cache_dir and cache.is_available() and not remote:
+        content_hash = cache.combined_hash(
+            f"{source_key(source)}={source_hash(source)}" for source in sources
         )
+        with metrics.stage(run, "cache_statements") as stage:
+            df = cache.load_frame(args.cache_dir, "statements", content_hash)
+            stage["rows_out"] = None if df is None else len(df)
+        if df is not None:
+            print(
+                "Merging and Validating Banks' Records: All data has been loaded from the cache and is valid."
+            )
+            return df
+
+    # Parse every statement from the given archives, folders and files into a DataFrame
+    with metrics.stage(run, "ingest_statements") as stage:
+        if args.intake == "async" or remote:
+            # Fetch the sources concurrently and parse the statements as they arrive
+            blocks = intake.read_sources(
+                args.statements,
+                parse_statement_data,
+                concurrency=args.fetch_concurrency,
+                workers=args.workers,
+            )
+        else:
+            blocks = parse_statement_sources(sources, workers=args.workers)
+        df = statements_frame(blocks)
+        stage["rows_out"] = len(df)
+
+    # Perform Validation and reuse the parsed datetime and numeric columns for the casting
+    with metrics.stage(run, "validate_statements", rows_in=len(df)) as stage:
+        errors, parsed = perform_validation(df, "Merging and Validating Banks' Records")
+        stage["rows_out"] = len(df)
+    with metrics.stage(run, "cast_statements", rows_in=len(df)) as stage:
+        df = cast_statements(df.assign(**parsed))
+        stage["rows_out"] = len(df)
+
+    # Only valid data is cached, so the validation errors are reported on every run
+    if content_hash and not len(errors):
+        cache.store_frame(args.cache_dir, "statements", content_hash, df)
+    return df
+
+
+def load_register(args, run=None):
+    # Read, validate and normalize the register, using the cache when it is enabled
+    content_hash = None
+    if args.cache_dir and cache.is_available():
+        content_hash = cache.file_hash(args.register)
+        with metrics.stage(run, "cache_register") as stage:
+            register = cache.load_frame(args.cache_dir, "register", content_hash)
+            stage["rows_out"] = None if register is None else len(register)
+        if register is not None:
+            print(
+                "Register Validation: All data has been loaded from the cache and is valid."
+            )
+            return register
 
-    #### TASK 2 ####
+    register, errors = read_register(args.register, run)
+    with metrics.stage(run, "cast_register", rows_in=len(register)) as stage:
+        register = cast_register(register)
+        stage["rows_out"] = len(register)
+
+    if content_hash and not len(errors):
+        cache.store_frame(args.cache_dir, "register", content_hash, register)
+    return register
 
+
+def cast_register(register):
     # Casting columns to desired types
     register = register.astype(
         {
@@ -192,40 +535,340 @@ def main():
 
     # Prepare the `account_name` column by removing the first 4 characters
     register["account_name"] = register["account_name"].str[:-4]
+    return register
+
+
+# Compact dtype profile
+
+# Low-cardinality columns that share one category dictionary across the statements, the
+# register and the tariffs, so the joins between them compare the same integer codes
+CATEGORY_DOMAINS = {
+    "account": [
+        ("statements", "account_name"),
+        ("statements", "client_name"),
+        ("register", "account_name"),
+    ],
+    "provider": [
+        ("statements", "provider_name"),
+        ("register", "provider_name"),
+        ("tariffs", "bank"),
+    ],
+    "currency": [
+        ("statements", "currency"),
+        ("register", "currency"),
+        ("tariffs", "currency"),
+    ],
+    "description": [("statements", "description"), ("register", "commentary")],
+    "operation_type": [("register", "operation_type")],
+    "provider_id": [("register", "provider_id")],
+}
+
+
+def compact_frames(frames):
+    # Cast the low-cardinality columns of {name: DataFrame} to shared categoricals
+    # Return the new frames and the {name: (bytes before, bytes after)} memory report of the
+    # cast columns (the other columns are shared with the input frames)
+    columns = {name: {} for name in frames}
+    report = {name: [0, 0] for name in frames}
+    for members in CATEGORY_DOMAINS.values():
+        members = [
+            (name, column)
+            for name, column in members
+            if name in frames and column in frames[name].columns
+        ]
+        # Sorted categories keep the sort order of the string columns
+        values = [frames[name][column].dropna().unique() for name, column in members]
+        dtype = pd.CategoricalDtype(sorted(set().union(*map(set, values))))
+        for name, column in members:
+            values = frames[name][column]
+            columns[name][column] = values.astype(dtype)
+            report[name][0] += values.memory_usage(deep=True, index=False)
+            report[name][1] += columns[name][column].memory_usage(
+                deep=True, index=False
+            )
+
+    frames = {name: df.assign(**columns[name]) for name, df in frames.items()}
+    return frames, {name: tuple(sizes) for name, sizes in report.items()}
+
+
+def report_memory(report):
+    # Print the memory saved by the compact dtype profile
+    total_before = sum(before for before, _ in report.values())
+    total_after = sum(after for _, after in report.values())
+    print("Compact dtype profile (categorical columns):")
+    for name, (before, after) in report.items():
+        print(f"  {name}: {before / 2**20:.2f} MB -> {after / 2**20:.2f} MB")
+    print(
+        f"  saved {(total_before - total_after) / 2**20:.2f} MB ({1 - total_after / max(total_before, 1):.0%})"
+    )
+
+
+def shared_codes(left, right):
+    # Join keys of two columns: their integer codes when they share one category
+    # dictionary, else their values as Python objects
+    if isinstance(left.dtype, pd.CategoricalDtype) and left.dtype == right.dtype:
+        return left.cat.codes.to_numpy(), right.cat.codes.to_numpy()
+    return left.astype(object).to_numpy(), right.astype(object).to_numpy()
+
+
+# Keys of the accounts whose credit and debit legs are paired
+PAIRING_KEYS = ["client_name", "provider_name", "currency"]
+
+
+def pair_statement_legs(df, links=False):
+    # Pair every credit leg with the earliest later unpaired debit leg of the same client,
+    # provider, currency and amount, and copy the debit's commission to the credit.
+    # Return the credits (in client, provider, currency and datetime order) and the table
+    # of the client legs left unpaired, and with links=True also the provider and the
+    # transaction ids of the paired (credit, debit) legs (bank ids are unique per bank only).
+    credit = df["credit"].to_numpy(dtype="float64", na_value=np.nan)
+    debit = df["debit"].to_numpy(dtype="float64", na_value=np.nan)
+    is_credit = credit > 0
+    is_debit = ~is_credit & (debit > 0)
 
-    # Sort the DataFrame by 'client_name', 'provider_name', 'currency', and 'datetime'
-    df = df.sort_values(by=["client_name", "provider_name", "currency", "datetime"])
+    # Account codes numbered in the sorted order of the keys, and times as integers
+    account = (
+        df.groupby(PAIRING_KEYS, sort=True, dropna=False, observed=True)
+        .ngroup()
+        .to_numpy()
+    )
+    times = df["datetime"].to_numpy(dtype="datetime64[ns]").astype("int64")
+
+    # Hash index of the legs by (account, amount)
+    legs = np.flatnonzero(is_credit | is_debit)
+    leg_amounts = np.where(is_credit, credit, debit)[legs]
+    leg_keys = (
+        pd.DataFrame({"account": account[legs], "amount": leg_amounts})
+        .groupby(["account", "amount"], sort=False, dropna=False)
+        .ngroup()
+        .to_numpy()
+    )
+    leg_is_credit = is_credit[legs]
+
+    # Walk the legs of every key in time order, credits before debits at the same time
+    order = np.lexsort((~leg_is_credit, times[legs], leg_keys))
+    legs, leg_keys, leg_is_credit = legs[order], leg_keys[order], leg_is_credit[order]
+    groups = pd.Series(leg_keys)
+    credits_seen = pd.Series(leg_is_credit.astype("int64")).groupby(groups).cumsum()
+    debits_seen = pd.Series((~leg_is_credit).astype("int64")).groupby(groups).cumsum()
+
+    # Debits without an open credit before them stay unpaired; their running count is the
+    # running maximum of (debits - credits), so the paired debits are found without a loop
+    unpaired_debits = (
+        (debits_seen - credits_seen).groupby(groups).cummax().clip(lower=0)
+    )
+    previous = unpaired_debits.groupby(groups).shift(1, fill_value=0)
+    paired_debit = ~leg_is_credit & (unpaired_debits == previous).to_numpy()
+
+    # First in, first out: the n-th paired debit of a key belongs to its n-th credit
+    debit_no = pd.Series(paired_debit.astype("int64")).groupby(groups).cumsum()
+    pairs = pd.merge(
+        pd.DataFrame(
+            {
+                "key": leg_keys[leg_is_credit],
+                "no": credits_seen.to_numpy()[leg_is_credit],
+                "credit_row": legs[leg_is_credit],
+            }
+        ),
+        pd.DataFrame(
+            {
+                "key": leg_keys[paired_debit],
+                "no": debit_no.to_numpy()[paired_debit],
+                "debit_row": legs[paired_debit],
+            }
+        ),
+        on=["key", "no"],
+    )
+
+    # Replace the 'commission' of the paired credits with the commission of their debits
+    commission = df["commission"].copy()
+    commission.iloc[pairs["credit_row"].to_numpy()] = (
+        df["commission"].iloc[pairs["debit_row"].to_numpy()].to_numpy()
+    )
+    df = df.assign(commission=commission)
+
+    # Report the client legs left unpaired
+    paired_rows = np.zeros(len(df), dtype=bool)
+    paired_rows[pairs["credit_row"].to_numpy()] = True
+    paired_rows[pairs["debit_row"].to_numpy()] = True
+    has_client = (
+        df["client_name"].astype(object).fillna("").astype(str).str.len().to_numpy() > 0
+    )
+    unpaired_rows = (is_credit | is_debit) & ~paired_rows & has_client
+    unpaired = df[unpaired_rows].assign(
+        leg=np.where(is_credit[unpaired_rows], "credit", "debit")
+    )
+
+    # Keep the credits in client, provider, currency and datetime order
+    credit_rows = np.flatnonzero(is_credit)
+    credit_rows = credit_rows[np.lexsort((times[credit_rows], account[credit_rows]))]
+    if not links:
+        return df.iloc[credit_rows], unpaired
+
+    transaction_ids = df["transaction_id"].astype(object).to_numpy()
+    providers = df["provider_name"].astype(object).to_numpy()
+    leg_links = pd.DataFrame(
+        {
+            "provider_name": providers[pairs["credit_row"].to_numpy()],
+            "credit_id": transaction_ids[pairs["credit_row"].to_numpy()],
+            "debit_id": transaction_ids[pairs["debit_row"].to_numpy()],
+        }
+    )
+    return df.iloc[credit_rows], unpaired, leg_links
+
+
+# Keys of the reconciliation: (bank statement column, register column)
+RECONCILIATION_KEYS = [
+    ("client_name", "account_name"),
+    ("provider_name", "provider_name"),
+    ("currency", "currency"),
+]
+
+AMBIGUOUS_COLUMNS = [
+    "transaction_id_banks",
+    "client_name",
+    "provider_name",
+    "currency",
+    "datetime",
+    "credit",
+    "transaction_id_register",
+    "datetime_register",
+    "amount_register",
+    "reason",
+]
+
+
+def find_register_candidates(df, register, time_window, amount_tolerance):
+    # Find for every bank operation the register rows with the same account, provider and
+    # currency, a datetime within time_window and an amount within amount_tolerance.
+    # Return the positions of the (bank operation, register row) candidate pairs.
+
+    # Encode the keys of both frames as integer codes of one common index
+    keys = pd.concat(
+        [
+            df[[bank for bank, _ in RECONCILIATION_KEYS]].set_axis(
+                [register_key for _, register_key in RECONCILIATION_KEYS], axis=1
+            ),
+            register[[register_key for _, register_key in RECONCILIATION_KEYS]],
+        ],
+        ignore_index=True,
+    )
+    codes = keys.groupby(
+        list(keys.columns), sort=False, dropna=False, observed=True
+    ).ngroup()
+    codes = codes.to_numpy(dtype="int64")
+    bank_codes, register_codes = codes[: len(df)], codes[len(df) :]
+
+    # Rank the register datetimes and the window bounds on one time axis
+    window = np.int64(pd.Timedelta(seconds=time_window).value)
+    bank_times = df["datetime"].to_numpy(dtype="datetime64[ns]").astype("int64")
+    register_times = (
+        register["datetime"].to_numpy(dtype="datetime64[ns]").astype("int64")
+    )
+    lower, upper = bank_times - window, bank_times + window
+    time_axis = np.unique(np.concatenate([register_times, lower, upper]))
+    span = len(time_axis) + 1
+
+    # Sort the register by (key, datetime) as a single int64 index and search the windows in it
+    register_index = register_codes * span + np.searchsorted(time_axis, register_times)
+    order = np.argsort(register_index, kind="stable")
+    register_index = register_index[order]
+    start = np.searchsorted(
+        register_index, bank_codes * span + np.searchsorted(time_axis, lower), "left"
+    )
+    stop = np.searchsorted(
+        register_index, bank_codes * span + np.searchsorted(time_axis, upper), "right"
+    )
 
-    # Group by 'client_name', 'provider_name', 'currency' and get the next row's 'debit' value
-    df["next_debit"] = df.groupby(["client_name", "provider_name", "currency"])[
-        "debit"
-    ].shift(-1)
-    # Group by 'client_name', 'provider_name', 'currency' and get the next row's 'commission' value
-    df["next_commission"] = df.groupby(["client_name", "provider_name", "currency"])[
-        "commission"
-    ].shift(-1)
+    # Expand the windows into candidate pairs
+    counts = stop - start
+    bank_pos = np.repeat(np.arange(len(df)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    register_pos = order[np.repeat(start, counts) + offsets]
+
+    # Keep the candidates with a close enough amount
+    bank_amounts = df["credit"].to_numpy(dtype="float64", na_value=np.nan)
+    register_amounts = register["amount"].to_numpy(dtype="float64", na_value=np.nan)
+    if is_fixed_point(df["credit"]):
+        # The tolerance is given in currency units, the amounts are in minor units
+        amount_tolerance = amount_tolerance * currency_scale(df["currency"])[bank_pos]
+    close = (
+        np.abs(bank_amounts[bank_pos] - register_amounts[register_pos])
+        <= amount_tolerance
+    )
+    return bank_pos[close], register_pos[close]
+
+
+def check_register_fullness(df, register, time_window=0, amount_tolerance=0):
+    # Match the bank operations with the register rows within the tolerances
+    # Return the register fullness table and the table of the ambiguous matches
+    df = df.reset_index(drop=True)
+    register = register.reset_index(drop=True)
+    bank_pos, register_pos = find_register_candidates(
+        df, register, time_window, amount_tolerance
+    )
 
-    # Identify the rows where the 'credit' matches the next row's 'debit'
-    matching_rows = df["credit"] == df["next_debit"]
+    # A bank operation is matched when it has exactly one candidate and that register
+    # row is not the only candidate of another bank operation too
+    candidates = np.bincount(bank_pos, minlength=len(df))
+    single = candidates[bank_pos] == 1
+    claims = np.bincount(register_pos[single], minlength=len(register))
+    matched = single & (claims[register_pos] == 1)
 
-    # Replace the 'commission' column with the next commission value where a match is found
-    df.loc[matching_rows, "commission"] = df.loc[matching_rows, "next_commission"]
+    match = np.full(len(df), -1, dtype="int64")
+    match[bank_pos[matched]] = register_pos[matched]
 
-    # Drop the 'next_commission' and 'next_debit' columns as it's no longer needed
-    df = df.drop(columns=["next_commission", "next_debit"])
+    # Ambiguous: several candidates, or one register row claimed by several bank operations
+    ambiguous_pairs = ~matched
+    ambiguous = pd.DataFrame(
+        {
+            "transaction_id_banks": df["transaction_id"].to_numpy()[
+                bank_pos[ambiguous_pairs]
+            ],
+            "client_name": df["client_name"].to_numpy()[bank_pos[ambiguous_pairs]],
+            "provider_name": df["provider_name"].to_numpy()[bank_pos[ambiguous_pairs]],
+            "currency": df["currency"].to_numpy()[bank_pos[ambiguous_pairs]],
+            "datetime": df["datetime"].to_numpy()[bank_pos[ambiguous_pairs]],
+            "credit": df["credit"].to_numpy()[bank_pos[ambiguous_pairs]],
+            "transaction_id_register": register["transaction_id"].to_numpy()[
+                register_pos[ambiguous_pairs]
+            ],
+            "datetime_register": register["datetime"].to_numpy()[
+                register_pos[ambiguous_pairs]
+            ],
+            "amount_register": register["amount"].to_numpy()[
+                register_pos[ambiguous_pairs]
+            ],
+            "reason": np.where(
+                single[ambiguous_pairs],
+                "register row matches several bank operations",
+                "several register rows match the bank operation",
+            ),
+        },
+        columns=AMBIGUOUS_COLUMNS,
+    )
 
-    # Filter df to include only rows where credit > 0
-    df = df[df["credit"] > 0]
+    # The key columns with the same name are taken from the bank statement; the register
+    # datetime is kept only when it can differ from the bank's one
+    register_columns = [
+        column
+        for column in register.columns
+        if column not in ("provider_name", "currency", "datetime")
+    ]
+    matched_register = register[register_columns]
+    if time_window:
+        matched_register = matched_register.assign(
+            datetime_register=register["datetime"]
+        )
 
-    # Perform the left join based on the conditions
+    # Perform the left join on the matched register rows
     merged_df = pd.merge(
-        df,
-        register,
+        df.assign(register_row=match),
+        matched_register.assign(register_row=np.arange(len(register))),
         how="left",
-        left_on=["client_name", "provider_name", "currency", "credit", "datetime"],
-        right_on=["account_name", "provider_name", "currency", "amount", "datetime"],
+        on="register_row",
         suffixes=("_banks", "_register"),
-    )
+    ).drop(columns=["register_row"])
 
     # Add "is_present_in_register" column to indicate if the transaction was found
     merged_df["is_present_in_register"] = ~merged_df["transaction_id_register"].isna()
@@ -240,26 +883,20 @@ def main():
             "account_name_register",
         ]
     )
+    return merged_df, ambiguous
 
-    # Save the register fullness result to 'register_fullness.csv'
-    # check if file exists
-    try:
-        if os.path.exists("register_fullness.csv"):
-            os.remove("register_fullness.csv")
-        merged_df.to_csv("register_fullness.csv", index=False)
-    except PermissionError as e:
-        # Raise an error with if permission is denied
-        print(
-            f"Permission denied: The file register_fullness.csv might be open in another program or you don't have write access."
-        )
-        sys.exit()
 
-    # Print the result
-    print("\nTask 2:")
-    print("All banks' operations are present in the company register\n")
+def save_reconciliation(merged_df, ambiguous):
+    # Save the unmatched and the ambiguous bank operations to separate files
+    unmatched = merged_df[~merged_df["is_present_in_register"]]
+    unmatched = unmatched[
+        ~unmatched["transaction_id_banks"].isin(ambiguous["transaction_id_banks"])
+    ]
+    save_output(unmatched, "reconciliation_unmatched.csv")
+    save_output(ambiguous, "reconciliation_ambiguous.csv")
 
-    #### TASK 3 ####
 
+def build_dictionary_terms():
     # Generate tables with given commissions
 
     # Define the data for each bank with currency as a separate column
@@ -294,24 +931,208 @@ def main():
     df_company_terms["bank"] = "Best Company"
 
     # Merge all dataframes
-    dictionary_terms = pd.concat(
-        [df_green_field, df_gold_fix, df_company_terms], ignore_index=True
+    return pd.concat([df_green_field, df_gold_fix, df_company_terms], ignore_index=True)
+
+
+# Fixed-point money
+# In the 'fixed' money mode amounts are kept as nullable int64 minor units (e.g. cents).
+# They are converted back to currency units only when the results are saved or printed.
+
+# Number of decimals of the currencies that do not use 2
+CURRENCY_MINOR_UNITS = {
+    "BHD": 3,
+    "CLP": 0,
+    "IQD": 3,
+    "ISK": 0,
+    "JOD": 3,
+    "JPY": 0,
+    "KRW": 0,
+    "KWD": 3,
+    "LYD": 3,
+    "OMR": 3,
+    "TND": 3,
+    "UGX": 0,
+    "VND": 0,
+}
+DEFAULT_MINOR_UNITS = 2
+
+STATEMENT_MONEY_COLUMNS = ["credit", "debit", "commission"]
+REGISTER_MONEY_COLUMNS = ["amount", "commission"]
+
+# Every money column that can appear in the outputs
+MONEY_COLUMNS = [
+    "credit",
+    "debit",
+    "commission",
+    "commission_banks",
+    "amount",
+    "amount_register",
+    "price_per_month",
+    "min_deposit",
+    "income",
+    "outcome",
+    "income_operations",
+    "income_commissions",
+    "income_service_customers",
+    "outcome_operations",
+    "outcome_commissions",
+    "outcome_service_banks",
+]
+
+
+def currency_scale(currencies):
+    # 10 ** minor units of every currency, as a numpy array
+    digits = (
+        pd.Series(currencies)
+        .map(CURRENCY_MINOR_UNITS)
+        .fillna(DEFAULT_MINOR_UNITS)
+        .to_numpy(dtype="int64")
     )
+    return 10**digits
 
-    # Perform the left join based on the conditions
-    check_commissions = pd.merge(
-        merged_df,
-        dictionary_terms,
-        how="left",
-        left_on=["provider_name", "currency"],
-        right_on=["bank", "currency"],
-        suffixes=("_operations", "_dict"),
+
+def round_half_up(values):
+    # Round to whole minor units, halves away from zero (NaN stays NaN)
+    return np.sign(values) * np.floor(np.abs(values) + 0.5)
+
+
+def is_fixed_point(values):
+    # Check if a money column holds integer minor units
+    return pd.api.types.is_integer_dtype(values)
+
+
+def to_fixed_point(df, columns):
+    # Convert money columns from currency units to integer minor units
+    scale = currency_scale(df["currency"])
+    converted = {}
+    for column in columns:
+        if column in df.columns and not is_fixed_point(df[column]):
+            units = df[column].to_numpy(dtype="float64", na_value=np.nan)
+            converted[column] = pd.array(
+                round_half_up(units * scale), dtype="Float64"
+            ).astype("Int64")
+    return df.assign(**converted)
+
+
+def restore_fixed_point(df):
+    # Make the money columns integer again after a round trip through a float-only store
+    converted = {
+        column: pd.array(df[column].to_numpy(), dtype="Float64").astype("Int64")
+        for column in MONEY_COLUMNS
+        if column in df.columns and pd.api.types.is_float_dtype(df[column])
+    }
+    return df.assign(**converted)
+
+
+def money_in_units(df):
+    # Convert the money columns in minor units back to currency units
+    columns = [
+        column
+        for column in MONEY_COLUMNS
+        if column in df.columns and is_fixed_point(df[column])
+    ]
+    if not columns or "currency" not in df.columns:
+        return df
+    scale = currency_scale(df["currency"])
+    return df.assign(
+        **{
+            column: df[column].to_numpy(dtype="float64", na_value=np.nan) / scale
+            for column in columns
+        }
+    )
+
+
+# Effective-dated bank tariffs
+
+TARIFF_COLUMNS = ["price_per_month", "min_deposit", "payout_price", "payin_price"]
+
+
+def load_tariffs(path):
+    # Load the tariff registry (bank, currency, effective_from, effective_to and the prices)
+    # Fall back to the built-in terms, valid at any time, when the file does not exist
+    if path and os.path.exists(path):
+        # round_trip keeps the prices exactly equal to the ones written in the file
+        tariffs = pd.read_csv(
+            path,
+            float_precision="round_trip",
+            parse_dates=["effective_from", "effective_to"],
+        )
+    else:
+        tariffs = build_dictionary_terms()
+        tariffs["effective_from"] = pd.NaT
+        tariffs["effective_to"] = pd.NaT
+
+    # Open bounds: a missing effective_from means "since always", a missing effective_to "until now"
+    tariffs["effective_from"] = (
+        pd.to_datetime(tariffs["effective_from"])
+        .fillna(pd.Timestamp.min)
+        .astype("datetime64[ns]")
+    )
+    tariffs["effective_to"] = pd.to_datetime(tariffs["effective_to"]).astype(
+        "datetime64[ns]"
+    )
+    tariffs["bank"] = tariffs["bank"].astype(object)
+    tariffs["currency"] = tariffs["currency"].astype(object)
+
+    # Index the registry by (bank, currency, effective_from) for the as-of lookups
+    return tariffs.sort_values(
+        by=["effective_from", "bank", "currency"], kind="stable"
+    ).reset_index(drop=True)
+
+
+def attach_tariffs(df, tariffs):
+    # Add the prices of the tariff in force for the provider and currency of every row at its
+    # datetime, in one as-of lookup over all rows. Rows without a tariff get NaN prices.
+    # Shared categoricals (compact dtype profile) are joined on their codes
+    bank, tariff_bank = shared_codes(df["provider_name"], tariffs["bank"])
+    currency, tariff_currency = shared_codes(df["currency"], tariffs["currency"])
+    lookup = pd.DataFrame(
+        {
+            "bank": bank,
+            "currency": currency,
+            "datetime": pd.to_datetime(df["datetime"]).to_numpy(),
+            "row": np.arange(len(df)),
+        }
+    )
+    lookup = lookup[lookup["datetime"].notna()].sort_values(
+        by="datetime", kind="stable"
     )
 
+    found = pd.merge_asof(
+        lookup,
+        tariffs[["effective_from", "effective_to"] + TARIFF_COLUMNS].assign(
+            bank=tariff_bank, currency=tariff_currency
+        ),
+        left_on="datetime",
+        right_on="effective_from",
+        by=["bank", "currency"],
+        direction="backward",
+    )
+
+    # effective_to is the last day of the tariff
+    expired = found["effective_to"].notna() & (
+        found["datetime"] >= found["effective_to"] + pd.Timedelta(days=1)
+    )
+    values = found[TARIFF_COLUMNS].to_numpy(dtype="float64")
+    values[expired.to_numpy()] = np.nan
+
+    prices = np.full((len(df), len(TARIFF_COLUMNS)), np.nan)
+    prices[found["row"].to_numpy()] = values
+    return df.assign(
+        **{column: prices[:, i] for i, column in enumerate(TARIFF_COLUMNS)}
+    )
+
+
+def verify_commissions(merged_df, dictionary_terms):
+    # Attach the bank tariffs in force at the time of every operation
+    check_commissions = attach_tariffs(merged_df, dictionary_terms)
+
     # Add fact commissions
-    check_commissions["bank_fact_commission"] = (
-        check_commissions["commission_banks"] / check_commissions["amount"]
+    commission_banks = check_commissions["commission_banks"].to_numpy(
+        dtype="float64", na_value=np.nan
     )
+    amount = check_commissions["amount"].to_numpy(dtype="float64", na_value=np.nan)
+    check_commissions["bank_fact_commission"] = commission_banks / amount
 
     # Add commissions from dictionary
     check_commissions["dict_commissions"] = check_commissions["payout_price"]
@@ -325,50 +1146,242 @@ def main():
     )
 
     # Check the correctness of commissions
-    check_commissions["is_correct_commission"] = (
-        check_commissions["bank_fact_commission"]
-        == check_commissions["dict_commissions"]
-    )
+    if is_fixed_point(check_commissions["commission_banks"]):
+        # Compare the commissions in minor units with the rounded tariff commission
+        expected = round_half_up(amount * check_commissions["payout_price"].to_numpy())
+        check_commissions["is_correct_commission"] = commission_banks == expected
+    else:
+        check_commissions["is_correct_commission"] = (
+            check_commissions["bank_fact_commission"]
+            == check_commissions["dict_commissions"]
+        )
 
     # Drop excess columns
-    check_commissions = check_commissions.drop(
+    return check_commissions.drop(
         columns=[
             "price_per_month",
             "min_deposit",
             "payout_price",
             "payin_price",
-            "bank",
         ]
     )
 
-    # Save the register fullness result to 'register_fullness.csv'
-    # check if file exists
-    try:
-        if os.path.exists("commissions.csv"):
-            os.remove("commissions.csv")
-        check_commissions.to_csv("commissions.csv", index=False)
-    except PermissionError:
-        # Raise an error with if permission is denied
-        print(
-            f"Permission denied: The file commissions.csv might be open in another program or you don't have write access."
+
+# Recurring fee check
+
+# Text of the monthly fee rows in the register commentary and the statement descriptions
+FEE_DESCRIPTION = "Monthly withdrawl according conditions"
+
+# Service period billed by a fee row, noted in its description ('... Period 2022-12'); the
+# fee of a month is paid in the next one
+FEE_PERIOD_PATTERN = r"Period (\d{4}-\d{2})"
+
+# Recurring fees: the table holding them, its amount and description columns and the
+# provider that charges them (None = the provider of the row). Every account of the table
+# owes the fee of each month from its first month in the data to the last month whose fee
+# is due within the data while a tariff with a monthly price is in force.
+RECURRING_FEES = [
+    {
+        # Fee of the company for every client account
+        "fee": "customer service fee",
+        "table": "register",
+        "amount": "amount",
+        "description": "commentary",
+        "provider": "Best Company",
+    },
+    {
+        # Fee of every bank for the company's accounts
+        "fee": "bank service fee",
+        "table": "statements",
+        "amount": "debit",
+        "description": "description",
+        "provider": None,
+    },
+]
+
+# Columns that tell the accounts of both fee tables apart
+FEE_ACCOUNT_COLUMNS = ["account_name", "provider_name", "currency"]
+
+FEE_ISSUE_COLUMNS = [
+    "fee",
+    "account_name",
+    "provider_name",
+    "currency",
+    "year_month",
+    "fees",
+    "amount",
+    "expected",
+    "issue",
+]
+
+# Difference of a paid fee from the tariff price that is still correct (half a cent)
+FEE_TOLERANCE = 0.005
+
+
+def fee_calendar(df, fee, last_month, tariffs):
+    # Dense (account x provider x currency x month) calendar of one recurring fee with the
+    # number of fees paid, their total and the tariff price of every month
+    df = df[df["datetime"].notna()]
+    provider = (
+        df["provider_name"].astype(object)
+        if fee["provider"] is None
+        else pd.Series(fee["provider"], index=df.index, dtype=object)
+    )
+    series = pd.DataFrame(
+        {
+            "account_name": df["account_name"].astype(object).to_numpy(),
+            "provider_name": provider.to_numpy(),
+            "currency": df["currency"].astype(object).to_numpy(),
+        }
+    )
+    codes = series.groupby(list(series.columns), sort=True, dropna=False).ngroup()
+    codes = codes.to_numpy()
+
+    # A fee row counts in the month it bills, the other rows in the month they were made
+    descriptions = df[fee["description"]].astype(object).fillna("").astype(str)
+    is_fee = descriptions.str.startswith(FEE_DESCRIPTION).to_numpy()
+    billed = pd.to_datetime(
+        descriptions.str.extract(FEE_PERIOD_PATTERN, expand=False),
+        format="%Y-%m",
+        errors="coerce",
+    )
+    billed = billed.where(is_fee, df["datetime"]).fillna(df["datetime"])
+    months = pd.PeriodIndex(billed, freq="M").asi8
+
+    # Every series spans its first month to the last month whose fee is due; the cells of
+    # all series are laid out one after another
+    first = pd.Series(months).groupby(codes).min().to_numpy()
+    lengths = np.maximum(last_month - first + 1, 0)
+    starts = np.cumsum(lengths) - lengths
+    cells = int(lengths.sum())
+
+    # Count and add up the fee rows per cell; the fees of later months are not due yet
+    is_fee &= months <= last_month
+    fee_cells = starts[codes[is_fee]] + months[is_fee] - first[codes[is_fee]]
+    amounts = money_in_units(df[is_fee])[fee["amount"]].to_numpy(
+        dtype="float64", na_value=np.nan
+    )
+    paid_count = np.bincount(fee_cells, minlength=cells)
+    paid = np.bincount(fee_cells, weights=np.nan_to_num(amounts), minlength=cells)
+
+    # Series and month of every cell, and the monthly price in force at its start
+    cell_series = np.repeat(np.arange(len(lengths)), lengths)
+    cell_months = first[cell_series] + np.arange(cells) - starts[cell_series]
+    keys = series.drop_duplicates().sort_values(list(series.columns))
+    keys = keys.reset_index(drop=True).iloc[cell_series].reset_index(drop=True)
+    # Monthly period ordinals count the months since 1970-01, like datetime64[M]
+    month_starts = pd.DatetimeIndex(
+        cell_months.astype("datetime64[M]").astype("datetime64[ns]")
+    )
+    calendar = keys.assign(
+        datetime=month_starts, year_month=month_starts.to_period("M")
+    )
+    expected = attach_tariffs(calendar, tariffs)["price_per_month"]
+    expected = money_in_units(calendar.assign(price_per_month=expected))[
+        "price_per_month"
+    ]
+    return calendar.assign(
+        fee=fee["fee"], fees=paid_count, amount=paid, expected=expected.to_numpy()
+    )
+
+
+def check_recurring_fees(frames, tariffs):
+    # Missing, duplicated and mis-priced monthly fees of every account against the tariffs
+    # 'frames' maps the table names of RECURRING_FEES to the register and the statements
+    # The fees of a month are paid early in the next one, so the data covers the fees up to
+    # the month before its last month
+    last = pd.Series([frame["datetime"].max() for frame in frames.values()]).max()
+    if pd.isna(last):
+        return pd.DataFrame(columns=FEE_ISSUE_COLUMNS)
+    last_month = pd.Period(last, freq="M").ordinal - 1
+    issues = []
+    for fee in RECURRING_FEES:
+        calendar = fee_calendar(frames[fee["table"]], fee, last_month, tariffs)
+        due = (calendar["expected"] > 0).to_numpy()
+        fees = calendar["fees"].to_numpy()
+        mispriced = ~np.isclose(
+            calendar["amount"], calendar["expected"], rtol=0, atol=FEE_TOLERANCE
         )
-        sys.exit()
+        issue = np.select(
+            [due & (fees == 0), fees > 1, due & (fees == 1) & mispriced],
+            ["missing", "duplicated", "mispriced"],
+            default="",
+        )
+        issues.append(calendar.assign(issue=issue)[issue != ""])
 
-    # Print the results
-    print("Task 3:")
-    print(
-        "Commissions for some operations are incorrect, as indicated in the 'is_correct_commission' column\nof the 'commissions.csv' file. However, the discrepancies in the commissions are relatively minor.\nIt is noteworthy that there are absent customer payments for using the company account in February."
+    issues = pd.concat(issues, ignore_index=True)[FEE_ISSUE_COLUMNS]
+    issues["year_month"] = issues["year_month"].astype(str)
+    return issues
+
+
+def fee_check_rows(df, table):
+    # Rows of a table that the recurring fee check needs: its fee rows, the first row of every
+    # account and its last row, so that the fees of data not kept in memory can be checked
+    description = next(
+        fee["description"] for fee in RECURRING_FEES if fee["table"] == table
+    )
+    df = df.reset_index(drop=True)
+    datetimes = pd.to_datetime(df["datetime"], errors="coerce")
+    if datetimes.isna().all():
+        return df.iloc[:0]
+    accounts = [df[column].astype(object) for column in FEE_ACCOUNT_COLUMNS]
+    first = datetimes.groupby(accounts, dropna=False).idxmin().dropna()
+    keep = (
+        df[description]
+        .astype(object)
+        .fillna("")
+        .astype(str)
+        .str.startswith(FEE_DESCRIPTION)
+        .to_numpy()
     )
+    keep[first.astype(int).to_numpy()] = True
+    keep[datetimes.idxmax()] = True
+    return df[keep]
 
-    #### TASK 4 ####
 
+def save_recurring_fees(frames, tariffs):
+    # Check the recurring monthly fees and save the issues to 'recurring_fees.csv'
+    fee_issues = check_recurring_fees(frames, tariffs)
+    save_output(fee_issues, "recurring_fees.csv")
+    return fee_issues
+
+
+def report_commissions(check_commissions):
+    # Print the number of operations whose commission does not match the tariff
+    correct = check_commissions["is_correct_commission"].fillna(False).astype(bool)
+    incorrect = int((~correct).sum())
+    if incorrect == 0:
+        print(f"The commissions of all {len(correct)} operations match the tariffs.")
+    else:
+        print(
+            f"Commissions for {incorrect} of {len(correct)} operations are incorrect, as indicated in the 'is_correct_commission' column\nof the 'commissions.csv' file."
+        )
+
+
+def report_recurring_fees(fee_issues):
+    # Print the number of fee issues of every kind
+    if fee_issues.empty:
+        print("All recurring monthly fees are present and match the tariffs.")
+        return
+    counts = fee_issues.groupby(["fee", "issue"]).size()
+    for (fee, issue), count in counts.items():
+        months = sorted(
+            fee_issues.loc[
+                (fee_issues["fee"] == fee) & (fee_issues["issue"] == issue),
+                "year_month",
+            ].unique()
+        )
+        print(f"{count} {issue} {fee}s in {', '.join(months)}")
+    print("See 'recurring_fees.csv' for the accounts.")
+
+
+def build_financial_base(register, check_commissions, dictionary_terms):
     # Select only the necessary columns from check_commissions
     check_commissions_subset = check_commissions[
         ["transaction_id_register", "commission_banks"]
     ]
 
     # Merge the register with the subset of bank statements based on transaction_id
-
     f = pd.merge(
         register,
         check_commissions_subset,
@@ -378,100 +1391,36 @@ def main():
         suffixes=("_register", "_banks"),
     )
 
-    # Merge the resulting data with dictionary terms based on provider_name and currency
-    fin = pd.merge(
-        f,
-        dictionary_terms,
-        how="left",
-        left_on=["provider_name", "currency"],
-        right_on=["bank", "currency"],
-        suffixes=("_operations", "_dict"),
-    )
+    # Attach the bank tariffs in force at the time of every operation
+    fin = attach_tariffs(f, dictionary_terms)
 
     fin["client"] = fin["account_name"].str.split("_").str[0]
 
-    # Drop the 'transaction_id_register', 'payin_price', and 'bank' columns as they are no longer needed
-    fin = fin.drop(columns=["transaction_id_register", "payin_price", "bank"])
+    # Drop the 'transaction_id_register' and 'payin_price' columns as they are no longer needed
+    fin = fin.drop(columns=["transaction_id_register", "payin_price"])
 
     # Replace missing values in 'price_per_month' with 0
     fin["price_per_month"] = fin["price_per_month"].fillna(0)
 
+    # Bring the tariff prices to minor units when the amounts are in minor units
+    if is_fixed_point(fin["amount"]):
+        fin = to_fixed_point(fin, ["price_per_month", "min_deposit"])
+        fin["commission_banks"] = fin["commission_banks"].astype("Int64")
+
     # Convert 'datetime' to pandas datetime format
     fin["datetime"] = pd.to_datetime(fin["datetime"])
 
     # Extract Month and Year from datetime and create a new 'year_month' column
     fin["year_month"] = fin["datetime"].dt.to_period("M")
 
-    # Create new 'income' column based on operation type
-    fin["income"] = fin.apply(
-        lambda x: (
-            x["amount"]
-            if x["operation_type"] == "income"
-            else x["commission"] if x["operation_type"] == "outcome" else 0
-        ),
-        axis=1,
-    )
-
-    # Create new 'outcome' column based on operation type
-    fin["outcome"] = fin.apply(
-        lambda x: (
-            x["commission_banks"]
-            if x["operation_type"] == "income"
-            else (
-                x["amount"]
-                if x["operation_type"] == "outcome"
-                and x["provider_name"] != "Best Company"
-                else 0
-            )
-        ),
-        axis=1,
-    )
-
-    # Create 'income_operations' column based on operation type
-    fin["income_operations"] = fin.apply(
-        lambda x: x["amount"] if x["operation_type"] == "income" else 0, axis=1
-    )
-
-    # Create 'income_commissions' column based on operation type
-    fin["income_commissions"] = fin.apply(
-        lambda x: x["commission"] if x["operation_type"] == "outcome" else 0, axis=1
-    )
-
-    # Create 'outcome_operations' column based on operation type
-    fin["outcome_operations"] = fin.apply(
-        lambda x: (
-            x["amount"]
-            if x["operation_type"] == "outcome" and x["provider_name"] != "Best Company"
-            else 0
-        ),
-        axis=1,
-    )
+    # Create the income and outcome columns from the classification rules in one pass
+    return apply_financial_rules(fin, compile_financial_rules(FINANCIAL_RULES))
 
-    # Create 'outcome_commissions' column based on operation type
-    fin["outcome_commissions"] = fin.apply(
-        lambda x: x["commission_banks"] if x["operation_type"] == "income" else 0,
-        axis=1,
-    )
-
-    # Create 'outcome_service_banks' column
-    fin["outcome_service_banks"] = fin.apply(
-        lambda x: (
-            x["price_per_month"]
-            if x["provider_name"] in ("Gold Fix", "Green Field")
-            else 0
-        ),
-        axis=1,
-    )
-
-    # Create 'income_service_customers' column
-    fin["income_service_customers"] = fin.apply(
-        lambda x: x["price_per_month"] if x["provider_name"] == "Best Company" else 0,
-        axis=1,
-    )
 
+def aggregate_financial_base(fin):
     # Group data by year_month, provider_name, and currency and aggregate the relevant columns
     fin_banks = (
-        fin.groupby(["year_month", "provider_name", "currency"])
+        fin.groupby(["year_month", "provider_name", "currency"], observed=True)
         .agg(
             income_operations=("income_operations", "sum"),
             income_commissions=("income_commissions", "sum"),
@@ -496,11 +1445,13 @@ def main():
     )
 
     # Drop 'outcome_not_full' and 'income_not_full' columns
-    fin_banks = fin_banks.drop(columns=["outcome_not_full", "income_not_full"])
+    return fin_banks.drop(columns=["outcome_not_full", "income_not_full"])
+
 
+def build_turnover(fin_banks, period="year_month"):
     # Report 1: Company Monthly Income and Outcome Breakdown by Currency
     turnover = (
-        fin_banks.groupby(["year_month", "currency"])
+        fin_banks.groupby([period, "currency"], observed=True)
         .agg(
             income=("income", "sum"),
             outcome=("outcome", "sum"),
@@ -510,32 +1461,13 @@ def main():
 
     # Calculate the balance for each month and currency
     turnover["balance"] = turnover["income"] - turnover["outcome"]
-    report_1_name = "Company Monthly Income and Outcome Breakdown by Currency"
+    return turnover
 
-    # Save the report's data to 'reports_financial_banks_base.csv'
-    # check if file exists
-    try:
-        if os.path.exists("reports_financial_banks_base.csv"):
-            os.remove("reports_financial_banks_base.csv")
-        fin_banks.to_csv("reports_financial_banks_base.csv", index=False)
-    except PermissionError:
-        # Raise an error with if permission is denied
-        print(
-            f"Permission denied: The file reports_financial_banks_base.csv might be open in another program or you don't have write access."
-        )
-        sys.exit()
-
-    # Display Report 1
-    print("\nTask 4:")
-    print(
-        "The data for the visualization is saved to 'reports_financial_banks_base.csv'."
-    )
-    print(report_1_name + "\n")
-    print(turnover)
 
+def build_turnover_type(fin_banks, period="year_month"):
     # Report 2: Company Monthly Income and Expense Breakdown by Currency and Type
     turnover_type = (
-        fin_banks.groupby(["year_month", "currency"])
+        fin_banks.groupby([period, "currency"], observed=True)
         .agg(
             income_operations=("income_operations", "sum"),
             income_commissions=("income_commissions", "sum"),
@@ -550,7 +1482,7 @@ def main():
     # Melt the DataFrame
     turnover_type_melted = pd.melt(
         turnover_type,
-        id_vars=["year_month", "currency"],
+        id_vars=[period, "currency"],
         value_vars=[
             "income_operations",
             "income_commissions",
@@ -563,212 +1495,1989 @@ def main():
     )
 
     # Sort the melted DataFrame by year_month, currency, and type
-    turnover_type = turnover_type_melted.sort_values(
-        by=["year_month", "currency", "type"]
-    )
+    turnover_type = turnover_type_melted.sort_values(by=[period, "currency", "type"])
 
     # Reset the index to start from 0 and then adjust to start from 1
     turnover_type = turnover_type.reset_index(drop=True)
     turnover_type.index = turnover_type.index + 1
+    return turnover_type
 
-    report_2_name = "Company Monthly Income and Expense Breakdown by Currency and Type"
 
-    # Display Report 2
-    print("\n" + report_2_name + "\n")
-    print(turnover_type)
+# Tariff scenarios
 
-    # Save two reports to different excel sheets to financial_report.xlsx
-    try:
-        if os.path.exists("financial_report.xlsx"):
-            os.remove("financial_report.xlsx")
-        with pd.ExcelWriter("financial_report.xlsx") as writer:
-            turnover.to_excel(
-                writer, sheet_name="Report 1", index=False, header=True, startrow=2
-            )
-            turnover_type.to_excel(
-                writer, sheet_name="Report 2", index=False, header=True, startrow=2
-            )
-
-        # Open the workbook to add the headers
-        wb = openpyxl.load_workbook("financial_report.xlsx")
-        ws1 = wb["Report 1"]
-        ws2 = wb["Report 2"]
+# Tariff prices a scenario can set per bank and currency; the ones it leaves empty (and the
+# banks and currencies it does not list) keep the tariffs in force
+SCENARIO_COLUMNS = ["price_per_month", "min_deposit", "payout_price"]
 
-        # Insert "Report" in the first row
-        ws1["A1"] = "Company Monthly Income and Outcome Breakdown by Currency"
-        ws2["A1"] = "Company Monthly Income and Expense Breakdown by Currency and Type"
+# Name of the scenario without any change, listed first for the comparison
+CURRENT_SCENARIO = "current"
 
-        # Save the changes
-        wb.save("financial_report.xlsx")
+SCENARIO_RESULT_COLUMNS = [
+    "scenario",
+    "year_month",
+    "currency",
+    "income",
+    "outcome",
+    "balance",
+    "deposits_below_minimum",
+]
 
-    except PermissionError:
-        # Raise an error with if permission is denied
-        print(
-            f"Permission denied: The file financial_report.xlsx might be open in another program or you don't have write access."
-        )
-        sys.exit()
 
-    print(
-        "\nFinancial reports have been generated and saved to 'financial_report.xlsx'."
+def rule_providers(column):
+    # Providers of the financial rule filling a column (e.g. the banks charging service fees)
+    return next(
+        rule["provider_in"]
+        for rule in FINANCIAL_RULES
+        if rule["column"] == column and "provider_in" in rule
     )
 
 
-# Define validation functions to check each field's format and value
+def load_scenarios(path):
+    # Read the scenarios (scenario, bank, currency and some of SCENARIO_COLUMNS per row)
+    scenarios = pd.read_csv(path, float_precision="round_trip")
+    missing = {"scenario", "bank", "currency"} - set(scenarios.columns)
+    if missing:
+        raise ValueError(
+            f"The scenario file '{path}' has no {', '.join(sorted(missing))} column"
+        )
+    for column in SCENARIO_COLUMNS:
+        if column not in scenarios.columns:
+            scenarios[column] = np.nan
+    scenarios = scenarios.astype(
+        {"scenario": str, "bank": str, "currency": str}
+    ).drop_duplicates(subset=["scenario", "bank", "currency"], keep="last")
+    return scenarios[["scenario", "bank", "currency"] + SCENARIO_COLUMNS]
+
+
+def scenario_prices(scenarios, names, banks, currencies):
+    # Price set by every scenario for every (bank, currency) key: {column: (scenarios x keys)}
+    # with NaN where the scenario keeps the tariff in force
+    keys = pd.MultiIndex.from_arrays([scenarios["bank"], scenarios["currency"]])
+    unique_keys = keys.unique()
+    rows = pd.Index(names).get_indexer(scenarios["scenario"])
+    columns = unique_keys.get_indexer(keys)
+    positions = unique_keys.get_indexer(pd.MultiIndex.from_arrays([banks, currencies]))
+
+    prices = {}
+    for column in SCENARIO_COLUMNS:
+        # The last column stays NaN for the keys no scenario sets
+        matrix = np.full((len(names), len(unique_keys) + 1), np.nan)
+        matrix[rows, columns] = scenarios[column].to_numpy(dtype="float64")
+        prices[column] = matrix[:, positions]
+    return prices
+
+
+def simulate_tariff_scenarios(fin, fin_banks, scenarios):
+    # Report 1 (income, outcome and balance per month and currency) of every scenario,
+    # computed for all scenarios at once from the monthly aggregates of the financial base
+    names = [CURRENT_SCENARIO] + [
+        name for name in scenarios["scenario"].unique() if name != CURRENT_SCENARIO
+    ]
+    cells = money_in_units(fin_banks)
+    provider = cells["provider_name"].astype(object).astype(str).to_numpy()
+    currency = cells["currency"].astype(object).astype(str).to_numpy()
+    company = rule_providers("income_service_customers")[0]
+
+    def actual(column):
+        return cells[column].to_numpy(dtype="float64", na_value=np.nan)
+
+    # Prices of the provider of every cell and of the company, scenarios x cells
+    prices = scenario_prices(scenarios, names, provider, currency)
+    company_prices = scenario_prices(
+        scenarios, names, np.full(len(cells), company, dtype=object), currency
+    )
 
+    # Bank commissions on the deposits and company commissions on the transfers
+    payout = prices["payout_price"]
+    outcome_commissions = np.where(
+        np.isnan(payout),
+        actual("outcome_commissions"),
+        actual("income_operations") * payout,
+    )
+    company_payout = company_prices["payout_price"]
+    income_commissions = np.where(
+        np.isnan(company_payout),
+        actual("income_commissions"),
+        actual("outcome_operations") * company_payout,
+    )
+
+    # Monthly service fees of the banks (one per cell) and of the customers (one per fee row)
+    fin_rows = money_in_units(fin)
+    fin_keys = [
+        fin_rows["year_month"].astype(str),
+        fin_rows["provider_name"].astype(object).astype(str),
+        fin_rows["currency"].astype(object).astype(str),
+    ]
+    fee_rows = (
+        pd.Series(1, index=fin_rows.index)
+        .groupby(fin_keys)
+        .sum()
+        .reindex(
+            pd.MultiIndex.from_arrays(
+                [cells["year_month"].astype(str).to_numpy(), provider, currency]
+            ),
+            fill_value=0,
+        )
+        .to_numpy()
+    )
+    price = prices["price_per_month"]
+    is_bank = np.isin(provider, rule_providers("outcome_service_banks"))
+    outcome_service_banks = np.where(
+        is_bank & ~np.isnan(price), price, actual("outcome_service_banks")
+    )
+    income_service_customers = np.where(
+        (provider == company) & ~np.isnan(price),
+        fee_rows * price,
+        actual("income_service_customers"),
+    )
 
-def validate_account_name(name):
-    # Check if account_name is not empty and is a string
-    return isinstance(name, str) and len(name) > 0
+    # Totals of the cells: the actual ones plus the changes of the scenario
+    income = actual("income") + (
+        income_commissions
+        - actual("income_commissions")
+        + income_service_customers
+        - actual("income_service_customers")
+    )
+    outcome = actual("outcome") + (
+        outcome_commissions
+        - actual("outcome_commissions")
+        + outcome_service_banks
+        - actual("outcome_service_banks")
+    )
 
+    # Report 1 of every scenario from the scenarios x cells totals
+    results = (
+        pd.DataFrame(
+            {
+                "scenario": np.repeat(names, len(cells)),
+                "year_month": np.tile(
+                    cells["year_month"].astype(str).to_numpy(), len(names)
+                ),
+                "currency": np.tile(currency, len(names)),
+                "income": income.ravel(),
+                "outcome": outcome.ravel(),
+            }
+        )
+        .groupby(["scenario", "year_month", "currency"], sort=False)
+        .sum()
+        .reset_index()
+    )
+    results["balance"] = results["income"] - results["outcome"]
 
-def validate_datetime(date_str):
-    # Validate datetime format 'YYYY-MM-DD HH:MM:SS'
+    # Deposits under the minimum of every scenario (scenarios x deposits)
+    deposits = fin_rows[
+        (fin_rows["operation_type"].astype(object) == "income").to_numpy()
+    ]
+    minimum = scenario_prices(
+        scenarios,
+        names,
+        deposits["provider_name"].astype(object).astype(str).to_numpy(),
+        deposits["currency"].astype(object).astype(str).to_numpy(),
+    )["min_deposit"]
+    minimum = np.where(
+        np.isnan(minimum),
+        deposits["min_deposit"].to_numpy(dtype="float64", na_value=np.nan),
+        minimum,
+    )
+    below_scenario, below_row = np.nonzero(
+        deposits["amount"].to_numpy(dtype="float64", na_value=np.nan) < minimum
+    )
+    below = (
+        pd.DataFrame(
+            {
+                "scenario": np.asarray(names, dtype=object)[below_scenario],
+                "year_month": deposits["year_month"].astype(str).to_numpy()[below_row],
+                "currency": deposits["currency"]
+                .astype(object)
+                .astype(str)
+                .to_numpy()[below_row],
+            }
+        )
+        .groupby(["scenario", "year_month", "currency"])
+        .size()
+        .rename("deposits_below_minimum")
+    )
+    results = results.join(below, on=["scenario", "year_month", "currency"])
+    results["deposits_below_minimum"] = (
+        results["deposits_below_minimum"].fillna(0).astype("int64")
+    )
+    return results.sort_values(
+        by=["year_month", "currency"], kind="stable"
+    ).reset_index(drop=True)[SCENARIO_RESULT_COLUMNS]
+
+
+def report_tariff_scenarios(results):
+    # Print the balance of every month and currency side by side for all scenarios
+    balances = results.pivot(
+        index=["year_month", "currency"], columns="scenario", values="balance"
+    )[list(results["scenario"].unique())]
+    balances.columns.name = None
+    print("\nTariff Scenarios: Monthly Balance by Currency\n")
+    print(balances.reset_index())
+
+
+# Style of the report column headers (the one pandas uses in to_excel)
+EXCEL_HEADER_FONT = openpyxl.styles.Font(bold=True)
+EXCEL_HEADER_BORDER = openpyxl.styles.Border(
+    left=openpyxl.styles.Side(style="thin"),
+    right=openpyxl.styles.Side(style="thin"),
+    top=openpyxl.styles.Side(style="thin"),
+    bottom=openpyxl.styles.Side(style="thin"),
+)
+EXCEL_HEADER_ALIGNMENT = openpyxl.styles.Alignment(horizontal="center", vertical="top")
+
+
+def excel_rows(ws, title, frame):
+    # Rows of a report sheet: the title, an empty row, the column headers and the data
+    yield [title]
+    yield []
+
+    header = []
+    for name in frame.columns:
+        cell = openpyxl.cell.WriteOnlyCell(ws, value=str(name))
+        cell.font = EXCEL_HEADER_FONT
+        cell.border = EXCEL_HEADER_BORDER
+        cell.alignment = EXCEL_HEADER_ALIGNMENT
+        header.append(cell)
+    yield header
+
+    # Periods are written as text and missing values as empty cells
+    columns = []
+    for name in frame.columns:
+        values = frame[name]
+        if isinstance(values.dtype, pd.PeriodDtype):
+            values = values.astype(str)
+        columns.append(values.astype(object).where(values.notna(), None))
+    for start in range(0, len(frame), ROWS_PER_BATCH):
+        batch = [column.iloc[start : start + ROWS_PER_BATCH] for column in columns]
+        yield from (list(row) for row in zip(*batch))
+
+
+def save_excel_reports(turnover, turnover_type, path, titles=None, extra_sheets=()):
+    # Save two reports (and the extra (sheet name, title, frame) sheets) to different excel
+    # sheets in one streaming pass
+    if titles is None:
+        titles = [REPORT_1_NAME, REPORT_2_NAME]
     try:
-        datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
+        # The write-only workbook streams the rows to disk instead of keeping the cells in memory
+        wb = openpyxl.Workbook(write_only=True)
+        for sheet_name, title, frame in [
+            ("Report 1", titles[0], turnover),
+            ("Report 2", titles[1], turnover_type),
+            *extra_sheets,
+        ]:
+            ws = wb.create_sheet(sheet_name)
+            for row in excel_rows(ws, title, frame):
+                ws.append(row)
+
+        # Replace the previous report only once the new one is complete
+        with sinks.atomic_path(path) as tmp_path:
+            wb.save(tmp_path)
         return True
-    except ValueError:
+
+    except OSError as error:
+        # Report the failure and go on; the run exits with an error status at the end
+        sinks.report_failure(path, error)
         return False
 
 
-def validate_transaction_id(tid):
-    # Check if transaction_id is a non-empty string
-    return isinstance(tid, str) and len(tid) > 0
+# Per-client statements
 
+CLIENT_STATEMENT_NAME = "Monthly Statement"
 
-def validate_provider_name(name):
-    # Check if provider_name is a string
-    return isinstance(name, str)
+# Categories of the financial base that belong to a client's operations (the bank service
+# fees are charged per bank, not per client)
+CLIENT_CATEGORIES = [
+    "income_operations",
+    "income_commissions",
+    "income_service_customers",
+    "outcome_operations",
+    "outcome_commissions",
+]
 
+# Clients written by one task of the worker pool
+CLIENTS_PER_TASK = 50
 
-def validate_client_name(name):
-    # Check if client_name is not empty and is a string
-    return isinstance(name, str)
 
+def build_client_statements(fin):
+    # Monthly income, commissions, service fees and balance of every client in one grouping
+    statements = (
+        fin.groupby(["client", "year_month", "currency"], observed=True)
+        .agg(
+            **{category: (category, "sum") for category in CLIENT_CATEGORIES},
+            income=("income", "sum"),
+            outcome=("outcome", "sum"),
+        )
+        .reset_index()
+    )
+    statements = money_in_units(statements)
+
+    # Add the service fees paid by the client to the income, as in the company reports
+    statements["income"] = statements["income"] + statements["income_service_customers"]
+    statements["balance"] = statements["income"] - statements["outcome"]
+    return statements
+
+
+def client_file_name(client, taken):
+    # File name of a client's statement, made safe and unique among the 'taken' names
+    name = re.sub(r"[^\w\- ]+", "_", str(client)).strip() or "client"
+    unique = name
+    number = 1
+    while unique.lower() in taken:
+        number += 1
+        unique = f"{name}_{number}"
+    taken.add(unique.lower())
+    return unique + ".xlsx"
+
+
+def write_client_statements(batch):
+    # Write the statements of a batch of (path, title, frame) clients; return the (path, error)
+    # pairs of the files that could not be written
+    failed = []
+    for path, title, frame in batch:
+        try:
+            wb = openpyxl.Workbook(write_only=True)
+            ws = wb.create_sheet("Statement")
+            for row in excel_rows(ws, title, frame):
+                ws.append(row)
+            with sinks.atomic_path(path) as tmp_path:
+                wb.save(tmp_path)
+        except OSError as error:
+            failed.append((path, error))
+    return failed
+
+
+def save_client_statements(fin, folder, workers=0):
+    # Partition the financial base by client once and write every client's statement to its
+    # own Excel file, with the files written by a process pool (0 = one process per CPU core)
+    statements = build_client_statements(fin)
+    os.makedirs(folder, exist_ok=True)
+
+    taken = set()
+    columns = [column for column in statements.columns if column != "client"]
+    clients = [
+        (
+            os.path.join(folder, client_file_name(client, taken)),
+            f"{client}: {CLIENT_STATEMENT_NAME}",
+            statements.iloc[rows][columns].reset_index(drop=True),
+        )
+        for client, rows in statements.groupby("client", observed=True).indices.items()
+    ]
+    batches = [
+        clients[start : start + CLIENTS_PER_TASK]
+        for start in range(0, len(clients), CLIENTS_PER_TASK)
+    ]
 
-def validate_currency(currency):
-    # Check if currency is in a list of valid currencies
-    currency_codes = CurrencyCodes()
-    return currency_codes.get_currency_name(currency) is not None
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    if workers > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(batches))) as pool:
+            failed = list(
+                itertools.chain.from_iterable(
+                    pool.map(write_client_statements, batches)
+                )
+            )
+    else:
+        failed = [
+            failure for batch in batches for failure in write_client_statements(batch)
+        ]
 
+    # Report the files that could not be written; the run exits with an error status
+    for path, error in failed:
+        sinks.report_failure(path, error)
+    return len(clients) - len(failed)
 
-def validate_amount(value):
-    # Check if the value is a float or can be converted to a float
-    try:
-        float(value)
-        return True
-    except ValueError:
-        return False
 
+# Incremental runs
 
-def validate_description(desc):
-    # Check if description is a string (it can be empty)
-    return isinstance(desc, str)
+# Columns added to the stored statements and results to find their source and month again
+STATE_COLUMNS = ["source", "row_no", "partition"]
 
 
-def validate_operation_type(op_type):
-    # Check if operation_type is either 'outcome' or 'income'
-    return op_type in ["outcome", "income"]
+def source_key(source):
+    # Name of a statement source in the state store
+    path, member = source
+    path = os.path.abspath(path)
+    return path if member is None else f"{path}::{member}"
 
 
-def validate_commentary(commentary):
-    # Check if commentary is a string (it can be empty)
-    return isinstance(commentary, str)
+def source_hash(source):
+    # Content hash of a statement source
+    path, member = source
+    if member is None:
+        with open(path, "rb") as f:
+            return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    # Zip members already carry a CRC-32 of their content, so there is no need to decompress them
+    with zipfile.ZipFile(path) as myzip:
+        info = myzip.getinfo(member)
+    return f"crc32:{info.CRC:08x}:{info.file_size}"
 
 
-def validate_provider_id(provider_id):
-    # Check if the value is a float or can be converted to a float
-    try:
-        float(provider_id)
-        return True
-    except ValueError:
-        return False
+def partition_hashes(df, months):
+    # Content hash of every month of a DataFrame
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return {
+        month: hashlib.blake2b(row_hashes[rows].tobytes(), digest_size=16).hexdigest()
+        for month, rows in pd.Series(range(len(df)))
+        .groupby(months.to_numpy())
+        .groups.items()
+    }
 
 
-# Perform validation
-def perform_validation(df, df_type):
-    validation_errors = []
+def neighbour_month(month, step):
+    # The month ('YYYY-MM') before (step=-1) or after (step=1) the given one
+    return str(pd.Period(month, freq="M") + step)
 
-    for index, row in df.iterrows():
-        if not validate_account_name(row["account_name"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid account_name '{row['account_name']}'"
-            )
 
-        if not validate_datetime(row["datetime"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid datetime '{row['datetime']}'"
-            )
+def run_incremental(args, dictionary_terms, run=None):
+    # Process only the statements and register months that changed since the previous run
+    # and merge the results into the ones kept in the state store
+    conn = state_store.open_store(args.state)
 
-        if not validate_transaction_id(row["transaction_id"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid transaction_id '{row['transaction_id']}'"
-            )
+    # The stored results depend on the reconciliation settings, the tariffs and the money
+    # mode; a run with other settings forgets them all and starts from scratch
+    tariffs_hash = (
+        cache.file_hash(args.tariffs)
+        if args.tariffs and os.path.exists(args.tariffs)
+        else "built-in"
+    )
+    settings = (
+        f"time_window={args.time_window};amount_tolerance={args.amount_tolerance};"
+        f"tariffs={tariffs_hash};money={args.money}"
+    )
+    state_store.reset_if_settings_changed(conn, settings)
 
-        if not validate_provider_name(row["provider_name"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid provider_name '{row['provider_name']}'"
-            )
+    #### TASK 1 ####
 
-        if not validate_currency(row["currency"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid currency '{row['currency']}'"
-            )
+    print("Task 1:")
 
-        if "provider_id" in row and not validate_provider_id(row["provider_id"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid provider_id '{row['provider_id']}'"
-            )
+    # Find the new, changed and removed statements by their content hash
+    sources = intake.list_statement_sources(args.statements)
+    keys = [source_key(source) for source in sources]
+    hashes = {key: source_hash(source) for key, source in zip(keys, sources)}
+    stored_hashes = state_store.read_hashes(conn, "sources", "source")
+    changed = [
+        (source, key)
+        for source, key in zip(sources, keys)
+        if stored_hashes.get(key) != hashes[key]
+    ]
+    changed_keys = [key for _, key in changed]
+    removed_keys = [key for key in stored_hashes if key not in hashes]
 
-        if "operation_type" in row and not validate_operation_type(
-            row["operation_type"]
-        ):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid operation_type '{row['operation_type']}'"
-            )
+    # Months whose stored statements are replaced or dropped
+    dirty_months = state_store.source_months(conn, changed_keys + removed_keys)
 
-        if "amount" in row and not validate_amount(row["amount"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid amount '{row['amount']}'"
+    # Parse and validate only the new and changed statements
+    if changed:
+        with metrics.stage(run, "ingest_statements") as stage:
+            blocks = parse_statement_sources(
+                [source for source, _ in changed], workers=args.workers
             )
-
-        if "debit" in row and not validate_amount(row["debit"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid debit '{row['debit']}'"
+            new_statements = statements_frame(blocks)
+            _, parsed = perform_validation(
+                new_statements, "Merging and Validating Banks' Records"
             )
+            new_statements = cast_statements(new_statements.assign(**parsed))
+            stage["rows_out"] = len(new_statements)
 
-        if "credit" in row and not validate_amount(row["credit"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid credit '{row['credit']}'"
+        lengths = [len(block["account_name"]) for block in blocks]
+        new_statements["source"] = np.repeat(changed_keys, lengths)
+        new_statements["row_no"] = np.concatenate(
+            [np.arange(length) for length in lengths] + [np.arange(0)]
+        )
+        new_statements["partition"] = new_statements["datetime"].dt.strftime("%Y-%m")
+        dirty_months |= set(new_statements["partition"].dropna())
+    else:
+        new_statements = None
+        print("Merging and Validating Banks' Records: No new or changed statements.")
+
+    # Credits at the end of a month can be paired with debits of the next month
+    dirty_months |= {neighbour_month(month, -1) for month in dirty_months}
+
+    # Find the new, changed and removed register months by their content hash
+    with metrics.stage(run, "ingest_register") as stage:
+        raw_register = pd.read_csv(args.register)
+        raw_register["provider_name"] = raw_register["provider_name"].astype(str)
+        stage["rows_out"] = len(raw_register)
+    register_months = raw_register["datetime"].astype(str).str[:7]
+    register_hashes = partition_hashes(raw_register, register_months)
+    stored_register_hashes = state_store.read_hashes(
+        conn, "register_partitions", "year_month"
+    )
+    dirty_months |= {
+        month
+        for month, content_hash in register_hashes.items()
+        if stored_register_hashes.get(month) != content_hash
+    }
+    removed_months = set(stored_register_hashes) - set(register_hashes)
+    dirty_months |= removed_months
+
+    # With a time window, a change can alter the verdicts of the bank operations of the
+    # neighbouring months too, so the months within the margin are processed again
+    window = pd.Timedelta(seconds=args.time_window)
+    if window:
+        dirty_months |= margin_months(dirty_months, window * STATEMENT_MARGIN_WINDOWS)
+
+    # Validate only the register months that are processed again
+    dirty_rows = register_months.isin(dirty_months).to_numpy()
+    register = raw_register[dirty_rows]
+    with metrics.stage(run, "validate_register", rows_in=len(register)) as stage:
+        if len(register):
+            _, parsed = perform_validation(register, "Register Validation")
+            register = register.assign(**parsed)
+        else:
+            print("Register Validation: No new or changed months.")
+
+        # Register rows of the other months that the bank operations of these months can
+        # match, as in the chunked runs; they were validated by earlier runs
+        borrowed = raw_register[
+            ~dirty_rows
+            & within_margin(
+                raw_register["datetime"], dirty_months, window * REGISTER_MARGIN_WINDOWS
             )
+        ]
+        if len(borrowed):
+            _, parsed = validate_frame(borrowed)
+            borrowed = borrowed.assign(**parsed)
+        stage["rows_out"] = len(register) + len(borrowed)
+
+    # Replace the stored statements of the changed and removed sources
+    state_store.delete_rows(conn, "statements", "source", changed_keys + removed_keys)
+    if new_statements is not None:
+        state_store.append_frame(conn, "statements", new_statements)
+
+    #### TASK 2, TASK 3 and TASK 4 for the changed months ####
+
+    if dirty_months:
+        own_register = len(register)
+        if len(borrowed):
+            register = pd.concat([register, borrowed])
+        register = cast_register(register)
+
+        # Take the months within the margin, and the following month of every one, so that
+        # the last credits of a month find their debits
+        statement_months = margin_months(
+            dirty_months, window * STATEMENT_MARGIN_WINDOWS
+        )
+        statement_months |= {neighbour_month(month, 1) for month in statement_months}
+        statements = state_store.load_frame(
+            conn, "statements", "partition", statement_months
+        )
+        if statements is None:
+            statements = cast_statements(statements_frame([]))
+            statements["partition"] = pd.Series(dtype="object")
+        statements = statements.sort_values(by=["source", "row_no"], kind="stable")
+        partitions = statements["partition"]
+        statements = statements.drop(columns=STATE_COLUMNS)
+        statements = cast_statements(statements)
+        if args.money == "fixed":
+            statements = to_fixed_point(statements, STATEMENT_MONEY_COLUMNS)
+            register = to_fixed_point(register, REGISTER_MONEY_COLUMNS)
+
+        with metrics.stage(run, "pair", rows_in=len(statements)) as stage:
+            paired, unpaired = pair_statement_legs(statements)
+            paired = paired[
+                within_margin(
+                    paired["datetime"], dirty_months, window * STATEMENT_MARGIN_WINDOWS
+                )
+            ]
+            unpaired = unpaired[partitions.loc[unpaired.index].isin(dirty_months)]
+            stage["rows_out"] = len(paired)
+
+        with metrics.stage(
+            run, "reconcile", rows_in=len(paired) + len(register)
+        ) as stage:
+            merged_df, ambiguous = check_register_fullness(
+                paired,
+                register,
+                time_window=args.time_window,
+                amount_tolerance=args.amount_tolerance,
+            )
+            stage["rows_out"] = len(merged_df)
+        with metrics.stage(run, "commission_check", rows_in=len(merged_df)) as stage:
+            check_commissions = verify_commissions(merged_df, dictionary_terms)
+            stage["rows_out"] = len(check_commissions)
+        # The bank operations of the margin bring the commissions of the register rows they
+        # matched; the financial base takes the rows of the changed months only
+        with metrics.stage(run, "aggregate", rows_in=own_register) as stage:
+            fin = build_financial_base(
+                register.iloc[:own_register], check_commissions, dictionary_terms
+            )
+            fin_banks = aggregate_financial_base(fin)
+            stage["rows_out"] = len(fin_banks)
+
+        # Replace the stored results of the changed months
+        with metrics.stage(run, "store_results", rows_in=len(merged_df)) as stage:
+            for table, result in (
+                ("register_fullness", merged_df),
+                ("commissions", check_commissions),
+                ("reconciliation_ambiguous", ambiguous),
+                ("unpaired_legs", unpaired),
+            ):
+                state_store.delete_rows(conn, table, "partition", dirty_months)
+                result = result.assign(
+                    partition=result["datetime"].dt.strftime("%Y-%m")
+                )
+                state_store.append_frame(
+                    conn, table, result[result["partition"].isin(dirty_months)]
+                )
+            state_store.delete_rows(conn, "fin_banks", "year_month", dirty_months)
+            state_store.append_frame(conn, "fin_banks", fin_banks)
+            stage["rows_out"] = len(merged_df) + len(fin_banks)
+
+    # Remember what has been processed
+    state_store.write_hashes(
+        conn,
+        "sources",
+        "source",
+        {key: hashes[key] for key in changed_keys},
+        removed_keys,
+    )
+    state_store.write_hashes(
+        conn, "register_partitions", "year_month", register_hashes, removed_months
+    )
+    conn.commit()
+
+    # Save the complete outputs from the state store
+    with export_stage(run, "export_statements") as stage:
+        statements = state_store.load_frame(conn, "statements")
+        if statements is not None:
+            source_rank = {key: rank for rank, key in enumerate(keys)}
+            statements = statements.assign(
+                rank=statements["source"].map(source_rank)
+            ).sort_values(by=["rank", "row_no"], kind="stable")
+            statements = statements.drop(columns=STATE_COLUMNS + ["rank"])
+            if save_output(statements, "banks_statemetns.csv"):
+                stage["rows_out"] = len(statements)
+                print(
+                    "The banks' statements are generated by code and saved to the 'banks_statements.csv' file."
+                )
+        else:
+            statements = cast_statements(statements_frame([]))
+
+    # Check the recurring fees over all months; only the register rows the check needs are
+    # validated again
+    with export_stage(
+        run, "fee_check", rows_in=len(statements) + len(raw_register)
+    ) as stage:
+        fee_register = fee_check_rows(raw_register, "register")
+        _, parsed = validate_frame(fee_register)
+        fee_register = cast_register(fee_register.assign(**parsed))
+        fee_issues = save_recurring_fees(
+            {"register": fee_register, "statements": statements}, dictionary_terms
+        )
+        stage["rows_out"] = len(fee_issues)
+
+    with export_stage(run, "export_results") as stage:
+        results = {}
+        for table in (
+            "register_fullness",
+            "commissions",
+            "reconciliation_ambiguous",
+            "unpaired_legs",
+        ):
+            result = state_store.load_frame(conn, table)
+            if result is not None:
+                if args.money == "fixed":
+                    # SQLite returns integer columns with missing values as floats
+                    result = restore_fixed_point(result)
+                result = result.drop(columns=["partition"]).sort_values(
+                    by=["client_name", "provider_name", "currency", "datetime"],
+                    kind="stable",
+                )
+            results[table] = result
+
+        merged_df = results["register_fullness"]
+        ambiguous = results["reconciliation_ambiguous"]
+        if ambiguous is None:
+            ambiguous = pd.DataFrame(columns=AMBIGUOUS_COLUMNS)
+        if merged_df is not None:
+            save_output(merged_df, "register_fullness.csv")
+            save_reconciliation(merged_df, ambiguous)
+        if results["commissions"] is not None:
+            save_output(results["commissions"], "commissions.csv")
+        # Without any unpaired leg the table is never created; the empty output still
+        # replaces the one of an earlier run
+        unpaired = results["unpaired_legs"]
+        if unpaired is None:
+            unpaired = pd.DataFrame(columns=STATEMENT_COLUMNS + ["leg"])
+        save_output(unpaired, "unpaired_legs.csv")
+        stage["rows_out"] = sum(
+            len(result) for result in results.values() if result is not None
+        )
+
+    check_commissions = results["commissions"]
+    if check_commissions is None:
+        check_commissions = pd.DataFrame({"is_correct_commission": []})
+
+    fin_banks = state_store.load_frame(conn, "fin_banks")
+    conn.close()
+    if fin_banks is None or merged_df is None:
+        print("\nThere is no data for the financial reports.")
+        return
+    fin_banks = fin_banks.sort_values(
+        by=["year_month", "provider_name", "currency"]
+    ).reset_index(drop=True)
+
+    with export_stage(run, "export_reports", rows_in=len(fin_banks)) as stage:
+        publish_reports(
+            fin_banks, merged_df, ambiguous, check_commissions, args, fee_issues
+        )
+        stage["rows_out"] = len(fin_banks)
 
-        if not validate_amount(row["commission"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid commission '{row['commission']}'"
+
+# Out-of-core runs with a bounded memory budget
+
+# Bytes a register row takes in the merges of Task 2-4, relative to its size after parsing
+REGISTER_MEMORY_FACTOR = 6
+
+
+def register_chunk_rows(path, memory_budget):
+    # Number of register rows that can be read at once within the memory budget (in MB)
+    sample = pd.read_csv(path, nrows=1000)
+    if sample.empty:
+        return 1000
+    row_bytes = sample.memory_usage(deep=True, index=False).sum() / len(sample)
+    return max(1000, int(memory_budget * 2**20 / (row_bytes * REGISTER_MEMORY_FACTOR)))
+
+
+def partition_key(datetimes, currencies):
+    # (year_month, currency) partition of every row, as 'YYYY-MM_CUR'
+    months = pd.Series(datetimes).astype(str).str[:7].to_numpy()
+    return pd.Series(months, index=currencies.index) + "_" + currencies.astype(str)
+
+
+# Margins around a partition, in time windows: the register rows and the bank operations of
+# the neighbouring months within them are matched together with the partition, so that the
+# verdicts of its own bank operations, and of the neighbouring ones that can match its
+# register rows, are the same as in a run over the whole register
+REGISTER_MARGIN_WINDOWS = 4
+STATEMENT_MARGIN_WINDOWS = 3
+
+
+def month_bounds(month):
+    # First moment of a month ('YYYY-MM') and of the next one, or None for another text
+    start = pd.to_datetime(month, format="%Y-%m", errors="coerce")
+    if pd.isna(start):
+        return None
+    return start, start + pd.offsets.MonthBegin(1)
+
+
+def margin_months(months, margin):
+    # Months within the margin (a Timedelta) of any of the given months, these included
+    found = set()
+    for month in months:
+        bounds = month_bounds(month)
+        if bounds is None:
+            found.add(month)
+            continue
+        start, end = bounds
+        periods = pd.period_range(
+            start - margin, end + margin - pd.Timedelta(1), freq="M"
+        )
+        found.update(str(period) for period in periods)
+    return found
+
+
+def within_margin(datetimes, months, margin):
+    # Mask of the datetimes that are within the margin of any of the given months
+    datetimes = pd.to_datetime(pd.Series(datetimes), errors="coerce")
+    keep = np.zeros(len(datetimes), dtype=bool)
+    for month in months:
+        bounds = month_bounds(month)
+        if bounds is not None:
+            start, end = bounds
+            keep |= (
+                (datetimes >= start - margin) & (datetimes < end + margin)
+            ).to_numpy()
+    return keep
+
+
+def partition_slice(key, parts, margin, load):
+    # Rows of a partition followed by the rows of the same currency in the neighbouring
+    # months that are within the margin (a Timedelta) of the partition's month
+    # Return the rows and the number of rows of the partition itself
+    own = load(parts[key]) if key in parts else None
+    month, _, currency = key.partition("_")
+    frames = [] if own is None else [own]
+    if margin:
+        for period in sorted(margin_months([month], margin) - {month}):
+            neighbour = f"{period}_{currency}"
+            if neighbour not in parts:
+                continue
+            rows = load(parts[neighbour])
+            frames.append(rows[within_margin(rows["datetime"], [month], margin)])
+    if not frames:
+        return None, 0
+    return pd.concat(frames, ignore_index=True), 0 if own is None else len(own)
+
+
+def partition_rows(df, key):
+    # Rows of a frame that belong to the partition
+    return df[(partition_key(df["datetime"], df["currency"]) == key).to_numpy()]
+
+
+def read_spilled_rows(files):
+    # Rows of one partition spilled by spill_register()
+    return pd.concat([pd.read_pickle(file) for file in files], ignore_index=True)
+
+
+def spill_register(path, chunk_rows, spill_dir):
+    # Read the register in chunks, validate them and spill their rows into per-partition files
+    # Return the validation errors and the {partition: [file, ...]} map
+    errors = []
+    files = {}
+    for chunk_no, chunk in enumerate(pd.read_csv(path, chunksize=chunk_rows)):
+        # read_csv keeps counting the index across the chunks, so errors show the real rows
+        chunk["provider_name"] = chunk["provider_name"].astype(str)
+        chunk_errors, _ = validate_frame(chunk)
+        errors.append(chunk_errors)
+
+        keys = partition_key(chunk["datetime"], chunk["currency"])
+        for key, rows in chunk.groupby(keys.to_numpy(), sort=False):
+            file = os.path.join(spill_dir, f"{key}.{chunk_no}.pkl")
+            rows.to_pickle(file)
+            files.setdefault(key, []).append(file)
+
+    # A missing column is reported by every chunk, keep it once
+    errors = pd.concat(errors, ignore_index=True)
+    missing_column = errors["rule"] == "missing_column"
+    errors = pd.concat(
+        [
+            errors[missing_column].drop_duplicates(subset=["column"]),
+            errors[~missing_column],
+        ],
+        ignore_index=True,
+    )
+    return errors, files
+
+
+def run_chunked(args, dictionary_terms, run=None):
+    # Process the register partition by partition (year_month and currency), so that only
+    # one partition and the small per-partition aggregates are in memory at a time
+
+    #### TASK 1 ####
+
+    print("Task 1:")
+    df = load_statements(args, run)
+    if args.money == "fixed":
+        df = to_fixed_point(df, STATEMENT_MONEY_COLUMNS)
+
+    chunk_rows = register_chunk_rows(args.register, args.memory_budget)
+
+    with tempfile.TemporaryDirectory(prefix="register_partitions_") as spill_dir:
+        with metrics.stage(run, "spill_register") as stage:
+            errors, register_files = spill_register(
+                args.register, chunk_rows, spill_dir
             )
+            report_validation(errors, "Register Validation")
+            stage["rows_out"] = len(register_files)
+
+        # Save the validated banks statements to 'banks_statements.csv'
+        with export_stage(run, "export_statements", rows_in=len(df)) as stage:
+            if save_output(df, "banks_statemetns.csv"):
+                stage["rows_out"] = len(df)
+                print(
+                    "The banks' statements are generated by code and saved to the 'banks_statements.csv' file."
+                )
 
-        if "commentary" in row and not validate_commentary(row["commentary"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid commentary '{row['commentary']}'"
+        # Pair the bank legs once and split the credits into the same partitions; the
+        # recurring fee check keeps only the rows it needs
+        fee_frames = {
+            "statements": [fee_check_rows(df, "statements")],
+            "register": [pd.read_csv(args.register, nrows=0)],
+        }
+        with export_stage(run, "pair", rows_in=len(df)) as stage:
+            paired, unpaired = pair_statement_legs(df)
+            save_output(unpaired, "unpaired_legs.csv")
+            stage["rows_out"] = len(paired)
+        del df, unpaired
+        paired_keys = partition_key(paired["datetime"], paired["currency"])
+        paired_partitions = {
+            key: rows
+            for key, rows in paired.groupby(paired_keys.to_numpy(), sort=False)
+        }
+        del paired
+
+        # With a time window, rows near the start or end of a month can match across it
+        window = pd.Timedelta(seconds=args.time_window)
+
+        #### TASK 2, TASK 3 and TASK 4 partition by partition ####
+
+        fin_banks_parts = []
+        missing = 0
+        operations = 0
+        incorrect = 0
+        ambiguous_ids = set()
+        streams = {
+            name: sinks.open_stream(name)
+            for name in (
+                "register_fullness.csv",
+                "commissions.csv",
+                "reconciliation_unmatched.csv",
+                "reconciliation_ambiguous.csv",
             )
+        }
+        # Row-level results are streamed to temporary files partition by partition
+        complete = False
+        try:
+            for key in sorted(set(register_files) | set(paired_partitions)):
+                # The partition's own rows come first in both slices
+                register, own_register = partition_slice(
+                    key,
+                    register_files,
+                    window * REGISTER_MARGIN_WINDOWS,
+                    read_spilled_rows,
+                )
+                if register is None:
+                    register = pd.read_csv(args.register, nrows=0)
+                fee_frames["register"].append(
+                    fee_check_rows(register.iloc[:own_register], "register")
+                )
+                register = cast_register(register)
+                paired, _ = partition_slice(
+                    key,
+                    paired_partitions,
+                    window * STATEMENT_MARGIN_WINDOWS,
+                    lambda rows: rows,
+                )
+                if paired is None:
+                    paired, _ = pair_statement_legs(
+                        cast_statements(statements_frame([]))
+                    )
+                if args.money == "fixed":
+                    register = to_fixed_point(register, REGISTER_MONEY_COLUMNS)
+                    paired = to_fixed_point(paired, STATEMENT_MONEY_COLUMNS)
+
+                # Every partition records its own stages
+                with metrics.stage(
+                    run, f"reconcile[{key}]", rows_in=len(paired) + len(register)
+                ) as stage:
+                    merged_df, ambiguous = check_register_fullness(
+                        paired,
+                        register,
+                        time_window=args.time_window,
+                        amount_tolerance=args.amount_tolerance,
+                    )
+                    stage["rows_out"] = len(merged_df)
+                with metrics.stage(
+                    run, f"commission_check[{key}]", rows_in=len(merged_df)
+                ) as stage:
+                    check_commissions = verify_commissions(merged_df, dictionary_terms)
+                    stage["rows_out"] = len(check_commissions)
+                # The neighbouring bank operations bring the commissions of the register
+                # rows they matched; the financial base takes the partition's rows only
+                with metrics.stage(
+                    run, f"aggregate[{key}]", rows_in=own_register
+                ) as stage:
+                    fin = build_financial_base(
+                        register.iloc[:own_register],
+                        check_commissions,
+                        dictionary_terms,
+                    )
+                    fin_banks_parts.append(aggregate_financial_base(fin))
+                    stage["rows_out"] = len(fin_banks_parts[-1])
+
+                # Keep the verdicts of the partition's own bank operations
+                merged_df = partition_rows(merged_df, key)
+                check_commissions = partition_rows(check_commissions, key)
+                ambiguous = partition_rows(ambiguous, key)
+
+                # Stream the row-level results to the output files
+                with metrics.stage(
+                    run, f"export_partition[{key}]", rows_in=len(merged_df)
+                ) as stage:
+                    unmatched = merged_df[~merged_df["is_present_in_register"]]
+                    unmatched = unmatched[
+                        ~unmatched["transaction_id_banks"].isin(
+                            ambiguous["transaction_id_banks"]
+                        )
+                    ]
+                    sinks.append_stream(
+                        streams["register_fullness.csv"], money_in_units(merged_df)
+                    )
+                    sinks.append_stream(
+                        streams["commissions.csv"], money_in_units(check_commissions)
+                    )
+                    sinks.append_stream(
+                        streams["reconciliation_unmatched.csv"],
+                        money_in_units(unmatched),
+                    )
+                    sinks.append_stream(
+                        streams["reconciliation_ambiguous.csv"],
+                        money_in_units(ambiguous),
+                    )
+                    stage["rows_out"] = len(merged_df)
+
+                missing += int((~merged_df["is_present_in_register"]).sum())
+                operations += len(merged_df)
+                incorrect += int(
+                    (~check_commissions["is_correct_commission"].astype(bool)).sum()
+                )
+                ambiguous_ids.update(ambiguous["transaction_id_banks"])
+                del register, paired, merged_df, check_commissions, fin
+            del paired_partitions
+            complete = True
+        finally:
+            # Move the complete outputs into place, or drop them if the run failed
+            for stream in streams.values():
+                sinks.close_stream(stream, complete)
+
+    # Combine the per-partition aggregates
+    fin_banks = (
+        pd.concat(fin_banks_parts, ignore_index=True)
+        .sort_values(by=["year_month", "provider_name", "currency"])
+        .reset_index(drop=True)
+    )
 
-        if "client_name" in row and not validate_client_name(row["client_name"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid client_name '{row['client_name']}'"
+    # Only the totals of the register check are needed for the summary
+    summary = pd.DataFrame(
+        {"is_present_in_register": [True] * (operations - missing) + [False] * missing}
+    )
+    commissions = pd.DataFrame(
+        {
+            "is_correct_commission": [True] * (operations - incorrect)
+            + [False] * incorrect
+        }
+    )
+    ambiguous = pd.DataFrame({"transaction_id_banks": sorted(ambiguous_ids)})
+    with export_stage(run, "fee_check") as stage:
+        fee_issues = save_recurring_fees(
+            {
+                "register": cast_register(pd.concat(fee_frames["register"])),
+                "statements": pd.concat(fee_frames["statements"]),
+            },
+            dictionary_terms,
+        )
+        stage["rows_out"] = len(fee_issues)
+    with export_stage(run, "export_reports", rows_in=len(fin_banks)) as stage:
+        publish_reports(fin_banks, summary, ambiguous, commissions, args, fee_issues)
+        stage["rows_out"] = len(fin_banks)
+
+
+# Watch-folder service
+
+# Exceptions of a statement file that is skipped instead of stopping the service
+SERVICE_READ_ERRORS = (OSError, ValueError, KeyError, zipfile.BadZipFile)
+
+
+def run_service(args, dictionary_terms):
+    # Keep the register and the tariffs loaded, process the statement files dropped into the
+    # inbox as they land and serve the current reports over HTTP until interrupted
+    os.makedirs(args.watch, exist_ok=True)
+    resident = {
+        "statements": {},
+        "failed": {},
+        "register": None,
+        "register_mtime": None,
+    }
+    service.publish(service_endpoints(resident))
+
+    server = service.start_server(args.host, args.port)
+    print(
+        f"Watching '{args.watch}' for the banks' statements, reports at http://{args.host}:{server.server_port}/"
+    )
+    try:
+        service.watch(
+            args.watch,
+            lambda ready, removed: refresh_service(
+                resident, ready, removed, args, dictionary_terms
+            ),
+            interval=args.poll_interval,
+        )
+    except KeyboardInterrupt:
+        print("\nThe service has been stopped.")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def read_inbox_file(path):
+    # Parse a statement file or archive of the inbox; a file without a statement header
+    # (one with the columns of a bank format) raises ValueError
+    sources = intake.list_statement_sources([path])
+    if not sources:
+        raise ValueError("The archive has no statements")
+    return statements_frame(
+        [parse_statement_source(source, require_header=True) for source in sources]
+    )
+
+
+def refresh_service(resident, ready, removed, args, dictionary_terms):
+    # Parse the new and changed statement files and rebuild the results from resident data
+    started = time.perf_counter()
+    for path in removed:
+        resident["statements"].pop(path, None)
+        resident["failed"].pop(path, None)
+
+    for path in ready:
+        name = os.path.basename(path)
+        try:
+            df = read_inbox_file(path)
+        except SERVICE_READ_ERRORS as error:
+            print(f"The file '{name}' could not be read: {error}")
+            resident["statements"].pop(path, None)
+            resident["failed"][path] = str(error)
+            continue
+        _, parsed = perform_validation(df, f"Validating '{name}'")
+        df = cast_statements(df.assign(**parsed))
+        if args.money == "fixed":
+            df = to_fixed_point(df, STATEMENT_MONEY_COLUMNS)
+        resident["statements"][path] = df
+        resident["failed"].pop(path, None)
+
+    # The register is read again only when its file changes
+    register_mtime = os.path.getmtime(args.register)
+    if resident["register_mtime"] != register_mtime:
+        register = load_register(args)
+        if args.money == "fixed":
+            register = to_fixed_point(register, REGISTER_MONEY_COLUMNS)
+        resident["register"] = register
+        resident["register_mtime"] = register_mtime
+
+    if not resident["statements"]:
+        service.publish(service_endpoints(resident))
+        return
+
+    # Task 2 to Task 4 over all resident statements, in the order of their file names
+    df = pd.concat(
+        [resident["statements"][path] for path in sorted(resident["statements"])],
+        ignore_index=True,
+    )
+    register = resident["register"]
+    paired, unpaired = pair_statement_legs(df)
+    merged_df, ambiguous = check_register_fullness(
+        paired,
+        register,
+        time_window=args.time_window,
+        amount_tolerance=args.amount_tolerance,
+    )
+    check_commissions = verify_commissions(merged_df, dictionary_terms)
+    fee_issues = save_recurring_fees(
+        {"register": register, "statements": df}, dictionary_terms
+    )
+    fin = build_financial_base(register, check_commissions, dictionary_terms)
+    fin_banks = money_in_units(aggregate_financial_base(fin))
+    turnover = build_turnover(fin_banks)
+    turnover_type = build_turnover_type(fin_banks)
+
+    # Keep the output files up to date as well
+    save_output(df, "banks_statemetns.csv")
+    save_output(merged_df, "register_fullness.csv")
+    save_output(unpaired, "unpaired_legs.csv")
+    save_reconciliation(merged_df, ambiguous)
+    save_output(check_commissions, "commissions.csv")
+    save_output(fin_banks, "reports_financial_banks_base.csv")
+    save_excel_reports(turnover, turnover_type, "financial_report.xlsx")
+    sinks.wait()
+
+    results = {
+        "merged_df": merged_df,
+        "ambiguous": ambiguous,
+        "unpaired": unpaired,
+        "check_commissions": check_commissions,
+        "fee_issues": fee_issues,
+        "turnover": turnover,
+        "turnover_type": turnover_type,
+    }
+    endpoints = service_endpoints(resident, results, time.perf_counter() - started)
+    service.publish(endpoints)
+
+    status = endpoints["/status"]
+    print(
+        f"Updated in {status['seconds']} s: {status['operations']} operations, "
+        f"{status['missing_in_register']} not in the register, "
+        f"{status['incorrect_commissions']} incorrect commissions."
+    )
+
+
+def frame_records(df):
+    # Rows of a DataFrame as JSON-serializable records
+    return json.loads(
+        df.to_json(orient="records", date_format="iso", default_handler=str)
+    )
+
+
+def service_endpoints(resident, results=None, seconds=None):
+    # Answers of the HTTP endpoints: the reconciliation status, Report 1 and Report 2
+    status = {
+        "updated": pd.Timestamp.now().isoformat(timespec="seconds"),
+        "seconds": None if seconds is None else round(seconds, 3),
+        "files": [os.path.basename(path) for path in sorted(resident["statements"])],
+        "failed_files": {
+            os.path.basename(path): error for path, error in resident["failed"].items()
+        },
+    }
+    if results is None:
+        return {"/status": status, "/report1": [], "/report2": [], "/unmatched": []}
+
+    merged_df = results["merged_df"]
+    ambiguous = results["ambiguous"]
+    missing = ~merged_df["is_present_in_register"]
+    status.update(
+        {
+            "operations": len(merged_df),
+            "missing_in_register": int(missing.sum()),
+            "ambiguous": int(ambiguous["transaction_id_banks"].nunique()),
+            "unpaired_legs": len(results["unpaired"]),
+            "incorrect_commissions": int(
+                (~results["check_commissions"]["is_correct_commission"]).sum()
+            ),
+            "recurring_fee_issues": len(results["fee_issues"]),
+        }
+    )
+    return {
+        "/status": status,
+        "/report1": frame_records(results["turnover"]),
+        "/report2": frame_records(results["turnover_type"]),
+        "/unmatched": frame_records(money_in_units(merged_df[missing])),
+    }
+
+
+# Streaming ingestion of the banks' statements
+
+# Columns of the merged banks' statements in output order
+STATEMENT_COLUMNS = [
+    "account_name",
+    "datetime",
+    "transaction_id",
+    "provider_name",
+    "client_name",
+    "currency",
+    "credit",
+    "debit",
+    "commission",
+    "description",
+]
+
+# Number of 'key: value' lines ('bank:', 'account:', 'currency:', 'fo period:' and a blank line)
+# written by the banks before the header row
+PREAMBLE_LINES = 5
+
+# Number of rows moved from the csv reader into the column buffers at once
+ROWS_PER_BATCH = 10000
+
+
+def sniff_delimiter(prefix_lines):
+    # Detect the delimiter from the first lines of a statement: the one (',' or ';') with
+    # more occurrences in the header and the first row after the preamble
+    sample = "".join(prefix_lines[PREAMBLE_LINES:])
+    return "," if sample.count(",") > sample.count(";") else ";"
+
+
+def read_statement(stream):
+    # Decode a single statement once and return its columnar buffers
+    # The preamble is skipped: the bank, account and currency are columns of every row
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+
+    # Read the preamble, the header and the first data row to sniff the dialect
+    prefix_lines = [text.readline() for _ in range(PREAMBLE_LINES + 2)]
+    delimiter = sniff_delimiter(prefix_lines)
+
+    header_and_first_row = [line for line in prefix_lines[PREAMBLE_LINES:] if line]
+    if not header_and_first_row:
+        return {}
+
+    # Continue reading the same stream after the prefix
+    reader = csv.reader(
+        itertools.chain(header_and_first_row, text), delimiter=delimiter
+    )
+    headers = next(reader)
+    buffers = {name: [] for name in headers}
+    width = len(headers)
+
+    # Move rows into the column buffers batch by batch
+    while True:
+        batch = [row for row in islice(reader, ROWS_PER_BATCH) if row]
+        if not batch:
+            break
+        # Pad short rows so every column keeps the same length
+        batch = [row + [""] * (width - len(row)) for row in batch]
+        for name, values in zip(headers, zip(*batch)):
+            buffers[name].extend(values)
+
+    return buffers
+
+
+# Column mappings of the bank formats
+# A format applies to a statement when all its 'match' columns are in the header. Every
+# column of the common layout is taken from the first applying format that maps it, else
+# copied from the column of the same name, else from DEFAULT_COLUMN_MAPPINGS. New bank
+# formats are added here, without changes to the parsing code.
+SCHEMA_MAPPINGS = [
+    {
+        # One 'amount' column signed by a 'D'/'C' flag (e.g. Green Field)
+        "format": "flagged amount",
+        "match": ["Debi/Credit", "amount"],
+        "columns": {
+            "debit": {
+                "transform": "flagged_amount",
+                "flag": "Debi/Credit",
+                "amount": "amount",
+                "value": "D",
+                "other": "C",
+            },
+            "credit": {
+                "transform": "flagged_amount",
+                "flag": "Debi/Credit",
+                "amount": "amount",
+                "value": "C",
+                "other": "D",
+            },
+        },
+    },
+    {
+        # Description in a 'payment info' column (e.g. Gold Fix)
+        "format": "payment info",
+        "match": ["payment info"],
+        "columns": {"description": {"transform": "copy", "source": "payment info"}},
+    },
+]
+
+# Mappings of the columns a statement may leave out
+DEFAULT_COLUMN_MAPPINGS = {"description": {"transform": "constant", "value": ""}}
+
+
+def copy_column(buffers, rows, spec):
+    # Values of another column
+    return buffers[spec["source"]]
+
+
+def flagged_amount(buffers, rows, spec):
+    # The amount where the flag has the given value, 0 where it has the other one
+    flags = np.asarray(buffers[spec["flag"]], dtype=object)
+    amounts = np.asarray(buffers[spec["amount"]], dtype=object)
+    return np.where(
+        flags == spec["value"],
+        amounts,
+        np.where(flags == spec["other"], "0", "").astype(object),
+    )
+
+
+def constant_column(buffers, rows, spec):
+    # The same value in every row
+    return [spec["value"]] * rows
+
+
+COLUMN_TRANSFORMS = {
+    "copy": copy_column,
+    "flagged_amount": flagged_amount,
+    "constant": constant_column,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_schema(headers):
+    # Column-level transforms that bring a statement with this header (a tuple) to the
+    # common layout; resolved once per distinct header
+    present = set(headers)
+    mappings = {}
+    for schema in SCHEMA_MAPPINGS:
+        if all(column in present for column in schema["match"]):
+            for column, spec in schema["columns"].items():
+                mappings.setdefault(column, spec)
+
+    plan = []
+    for column in STATEMENT_COLUMNS:
+        spec = mappings.get(column)
+        if spec is None and column in present:
+            spec = {"transform": "copy", "source": column}
+        if spec is None:
+            spec = DEFAULT_COLUMN_MAPPINGS.get(column)
+        if spec is None:
+            raise ValueError(f"The statement has no '{column}' column")
+        plan.append((column, COLUMN_TRANSFORMS[spec["transform"]], spec))
+    return plan
+
+
+def normalize_statement(buffers):
+    # Bring one bank's columns to the common statement layout
+    rows = len(next(iter(buffers.values()), ()))
+    return {
+        column: transform(buffers, rows, spec)
+        for column, transform, spec in resolve_schema(tuple(buffers))
+    }
+
+
+def parse_statement_stream(stream, require_header=False):
+    # Read one statement from a binary stream into the common column layout
+    # A statement without a header is empty, or refused when require_header is set
+    buffers = read_statement(stream)
+    if not buffers:
+        if require_header:
+            raise ValueError("The file has no statement header")
+        return {name: [] for name in STATEMENT_COLUMNS}
+    return normalize_statement(buffers)
+
+
+def parse_statement_data(data):
+    # Read one statement from its bytes (as fetched by the concurrent intake)
+    return parse_statement_stream(io.BytesIO(data))
+
+
+def parse_statement_source(source, require_header=False):
+    # Read one statement (a zip member or a plain csv file) into the common column layout
+    path, member = source
+    if member is None:
+        with open(path, "rb") as f:
+            return parse_statement_stream(f, require_header)
+    with zipfile.ZipFile(path) as myzip:
+        with myzip.open(member, "r") as f:
+            return parse_statement_stream(f, require_header)
+
+
+def parse_statement_sources(sources, workers=1):
+    # Parse the statements into per-file column blocks, using a process pool when workers > 1
+    # 0 means one worker per CPU core
+    if workers == 0:
+        workers = os.cpu_count() or 1
+
+    if workers > 1 and len(sources) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(sources))) as pool:
+            # map() keeps the order of the sources, so the result is deterministic
+            return list(pool.map(parse_statement_source, sources))
+    return [parse_statement_source(source) for source in sources]
+
+
+def statements_frame(blocks):
+    # Concatenate the per-file column blocks into one DataFrame
+    merged = {name: [] for name in STATEMENT_COLUMNS}
+    for columns in blocks:
+        for name in STATEMENT_COLUMNS:
+            merged[name].extend(columns[name])
+
+    df = pd.DataFrame(merged, columns=STATEMENT_COLUMNS, dtype="object")
+
+    # Replace the ',' symbol in 'commission' with a '.' for proper numeric parsing
+    if len(df):
+        df["commission"] = df["commission"].str.replace(",", ".", regex=False)
+    return df
+
+
+def read_statements(paths, workers=1):
+    # Parse all statements from the given archives, folders and files into one DataFrame
+    if isinstance(paths, str):
+        paths = [paths]
+    sources = intake.list_statement_sources(paths)
+    return statements_frame(parse_statement_sources(sources, workers=workers))
+
+
+def parse_args(argv=None):
+    # Read the command line options
+    parser = argparse.ArgumentParser(
+        description="Merge the banks' statements, check them against the company register and build the financial reports."
+    )
+    parser.add_argument(
+        "--statements",
+        nargs="+",
+        default=["employee_task_statements.zip"],
+        help="zip archives, folders, csv files or http(s)/file URLs with the banks' statements",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used to parse the statements (0 = one per CPU core)",
+    )
+    parser.add_argument(
+        "--intake",
+        choices=["serial", "async"],
+        default="serial",
+        help="async = fetch the sources concurrently and parse the statements as they arrive (always used for URLs)",
+    )
+    parser.add_argument(
+        "--fetch-concurrency",
+        type=int,
+        default=8,
+        help="maximum number of reads in flight in the async intake",
+    )
+    parser.add_argument(
+        "--register",
+        default="register.csv",
+        help="company register csv file",
+    )
+    parser.add_argument(
+        "--tariffs",
+        default="tariffs.csv",
+        help="tariff registry csv file with effective dates (the built-in terms are used if it does not exist)",
+    )
+    parser.add_argument(
+        "--time-window",
+        type=float,
+        default=0,
+        help="seconds a register datetime may differ from the bank's one (Task 2)",
+    )
+    parser.add_argument(
+        "--amount-tolerance",
+        type=float,
+        default=0,
+        help="amount a register amount may differ from the bank's one (Task 2)",
+    )
+    parser.add_argument(
+        "--money",
+        choices=["float", "fixed"],
+        default="float",
+        help="keep amounts as floats or as integer minor units (cents) with exact commission checks",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="folder of the binary cache of the parsed statements and register (requires pyarrow)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=None,
+        help="memory budget in MB; the register is then processed in chunks partitioned by month and currency",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="process only new or changed statements and register months",
+    )
+    parser.add_argument(
+        "--state",
+        default="pipeline_state.sqlite",
+        help="SQLite file with the state of the incremental runs",
+    )
+    parser.add_argument(
+        "--watch",
+        default=None,
+        help="inbox folder; run as a service that processes the statements dropped into it",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address of the HTTP endpoint of the service",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="port of the HTTP endpoint of the service (0 = any free port)",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1.0,
+        help="seconds between two scans of the inbox",
+    )
+    parser.add_argument(
+        "--dtype-profile",
+        choices=["standard", "compact"],
+        default="standard",
+        help="compact = shared categoricals for the low-cardinality text columns (default in-memory mode only)",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=sinks.FORMATS,
+        default="csv",
+        help="format of the output tables (parquet requires pyarrow)",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=sinks.COMPRESSIONS,
+        default="none",
+        help="compression of the output tables (zstd csv files require zstandard)",
+    )
+    parser.add_argument(
+        "--output-workers",
+        type=int,
+        default=4,
+        help="number of threads writing the output tables in parallel",
+    )
+    parser.add_argument(
+        "--cube",
+        default=None,
+        help="SQLite file of the rollup cube; new and changed transactions are added to it (see --cube-report)",
+    )
+    parser.add_argument(
+        "--cube-report",
+        choices=list(cube.GRAINS),
+        default=None,
+        help="only print and save the reports at this grain from the rollup cube (requires --cube)",
+    )
+    parser.add_argument(
+        "--base-currency",
+        default=None,
+        help="currency in which Report 1 and Report 2 are also consolidated (e.g. USD)",
+    )
+    parser.add_argument(
+        "--fx-rates",
+        default="fx_rates.csv",
+        help="csv table of FX rates (date, from_currency, to_currency, rate) for --base-currency",
+    )
+    parser.add_argument(
+        "--scenarios",
+        default=None,
+        help="csv file of alternative tariffs (scenario, bank, currency, price_per_month, min_deposit, payout_price) evaluated side by side",
+    )
+    parser.add_argument(
+        "--client-statements",
+        default=None,
+        help="folder for one Excel file per client with its monthly income, commissions, service fees and balance",
+    )
+    parser.add_argument(
+        "--client-workers",
+        type=int,
+        default=0,
+        help="number of processes writing the client statements (0 = one per CPU core)",
+    )
+    parser.add_argument(
+        "--index",
+        default=None,
+        help="SQLite file of the transaction lookup index, written by every run",
+    )
+    parser.add_argument(
+        "--lookup",
+        default=None,
+        metavar="TRANSACTION_ID",
+        help="only print the register rows, bank legs and verdicts of a transaction from --index",
+    )
+    parser.add_argument(
+        "--lookup-provider",
+        default=None,
+        help="bank of the --lookup transaction id (bank ids are unique per bank only; default: all banks)",
+    )
+    parser.add_argument(
+        "--lookup-key",
+        nargs=4,
+        default=None,
+        metavar=("ACCOUNT", "PROVIDER", "CURRENCY", "DATETIME"),
+        help="only print the register rows and bank legs with this key from --index",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="JSON (or .csv) file with the wall time, CPU time, rows and peak RSS of every stage",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="file for the cProfile stats of the slowest stage",
+    )
+    args = parser.parse_args(argv)
+
+    if args.base_currency and not os.path.exists(args.fx_rates):
+        parser.error(f"--base-currency requires the FX rate table '{args.fx_rates}'")
+    if args.scenarios and not os.path.exists(args.scenarios):
+        parser.error(f"the scenario file '{args.scenarios}' does not exist")
+    if args.cube_report and not args.cube:
+        parser.error("--cube-report requires --cube")
+    if (args.lookup or args.lookup_key) and not (
+        args.index and os.path.exists(args.index)
+    ):
+        parser.error("--lookup and --lookup-key require an existing --index")
+
+    # Options of the default in-memory mode that the other modes processing the inputs do
+    # not support
+    other_mode = next(
+        (
+            option
+            for option, value in (
+                ("--watch", args.watch),
+                ("--incremental", args.incremental),
+                ("--memory-budget", args.memory_budget),
             )
+            if value
+        ),
+        None,
+    )
+    if args.lookup or args.lookup_key or args.cube_report:
+        other_mode = None
+    if other_mode and args.dtype_profile == "compact":
+        parser.error(f"--dtype-profile compact can not be used with {other_mode}")
+    if other_mode and args.cube:
+        parser.error(f"--cube can not be used with {other_mode}")
+    if other_mode and args.client_statements:
+        parser.error(f"--client-statements can not be used with {other_mode}")
+    if other_mode and args.index:
+        parser.error(f"--index can not be used with {other_mode}")
+    if other_mode and args.scenarios:
+        parser.error(f"--scenarios can not be used with {other_mode}")
+
+    # Check the optional dependencies of the output format
+    unsupported = sinks.check_support(args.output_format, args.compression)
+    if unsupported:
+        parser.error(unsupported)
+    return args
+
+
+# Classification of the register operations into income and outcome columns (Task 4)
+
+# Each rule fills 'column' with the value of 'source' for the rows that match its
+# 'operation_type' (None = any) and provider conditions. The first matching rule of a
+# column wins, rows without a matching rule get 0.
+FINANCIAL_RULES = [
+    {"column": "income", "operation_type": "income", "source": "amount"},
+    {"column": "income", "operation_type": "outcome", "source": "commission"},
+    {"column": "outcome", "operation_type": "income", "source": "commission_banks"},
+    {
+        "column": "outcome",
+        "operation_type": "outcome",
+        "provider_not_in": ["Best Company"],
+        "source": "amount",
+    },
+    {"column": "income_operations", "operation_type": "income", "source": "amount"},
+    {
+        "column": "income_commissions",
+        "operation_type": "outcome",
+        "source": "commission",
+    },
+    {
+        "column": "outcome_operations",
+        "operation_type": "outcome",
+        "provider_not_in": ["Best Company"],
+        "source": "amount",
+    },
+    {
+        "column": "outcome_commissions",
+        "operation_type": "income",
+        "source": "commission_banks",
+    },
+    {
+        "column": "outcome_service_banks",
+        "provider_in": ["Gold Fix", "Green Field"],
+        "source": "price_per_month",
+    },
+    {
+        "column": "income_service_customers",
+        "provider_in": ["Best Company"],
+        "source": "price_per_month",
+    },
+]
+
+
+def compile_financial_rules(rules):
+    # Group the rules by target column and turn their conditions into hashable keys
+    compiled = {}
+    for rule in rules:
+        condition = (
+            rule.get("operation_type"),
+            tuple(rule.get("provider_in", ())),
+            tuple(rule.get("provider_not_in", ())),
+        )
+        compiled.setdefault(rule["column"], []).append((condition, rule["source"]))
+    return compiled
+
+
+def apply_financial_rules(df, compiled):
+    # Evaluate every distinct condition once and select the values of all columns with np.select
+    operation_type = df["operation_type"]
+    provider_name = df["provider_name"]
+    masks = {}
+
+    def condition_mask(condition):
+        if condition not in masks:
+            op_type, provider_in, provider_not_in = condition
+            mask = pd.Series(True, index=df.index)
+            if op_type is not None:
+                mask &= operation_type.eq(op_type).fillna(False).astype(bool)
+            if provider_in:
+                mask &= provider_name.isin(provider_in)
+            if provider_not_in:
+                mask &= ~provider_name.isin(provider_not_in)
+            masks[condition] = mask.to_numpy()
+        return masks[condition]
+
+    columns = {}
+    for column, rules in compiled.items():
+        conditions = [condition_mask(condition) for condition, _ in rules]
+        if all(is_fixed_point(df[source]) for _, source in rules):
+            # Amounts in minor units: missing values count as 0 and the sums stay exact
+            choices = [
+                df[source].to_numpy(dtype="int64", na_value=0) for _, source in rules
+            ]
+            columns[column] = np.select(conditions, choices, default=0)
+        else:
+            choices = [
+                df[source].to_numpy(dtype="float64", na_value=np.nan)
+                for _, source in rules
+            ]
+            columns[column] = np.select(conditions, choices, default=0.0)
+
+    return df.assign(**columns)
+
+
+# Column-wise validation engine
+# Every check takes a whole column and returns a boolean mask of the valid values
+
+
+def load_currency_codes():
+    # Read the ISO 4217 currency codes from the data file shipped with forex_python
+    data = (
+        importlib.resources.files("forex_python")
+        .joinpath("raw_data/currencies.json")
+        .read_text(encoding="utf-8")
+    )
+    return frozenset(item["cc"] for item in json.loads(data) if item.get("name"))
+
+
+# ISO 4217 currency codes accepted by the validation, read once
+CURRENCY_CODES = load_currency_codes()
+
+# Datetime format used by the banks and the register
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def string_lengths(values):
+    # Length of every string value, NaN for values that are not strings
+    if not (
+        pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)
+    ):
+        return pd.Series(float("nan"), index=values.index)
+    return values.str.len().astype("float64")
+
+
+def check_non_empty_string(values):
+    # Check if the value is not empty and is a string
+    return string_lengths(values).gt(0)
+
+
+def check_string(values):
+    # Check if the value is a string (it can be empty)
+    return string_lengths(values).notna()
+
+
+def check_currency(values):
+    # Check if the currency is a known ISO 4217 code
+    return values.isin(CURRENCY_CODES)
+
 
-        if "description" in row and not validate_description(row["description"]):
-            validation_errors.append(
-                f"{df_type} Row {index}: Invalid description '{row['description']}'"
+def check_operation_type(values):
+    # Check if operation_type is either 'outcome' or 'income'
+    return values.isin(["outcome", "income"])
+
+
+def parse_datetime(values):
+    # Parse the 'YYYY-MM-DD HH:MM:SS' datetimes, invalid values become NaT
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values, format=DATETIME_FORMAT, errors="coerce")
+
+
+def parse_number(values):
+    # Parse the numbers, invalid values become NaN
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype("float64")
+    try:
+        # astype() parses exactly like float(); to_numeric() can differ in the last digit
+        return values.astype("float64")
+    except (TypeError, ValueError):
+        parsed = pd.to_numeric(values, errors="coerce").astype("float64")
+        valid = parsed.notna()
+        parsed[valid] = values[valid].astype("float64")
+        return parsed
+
+
+def check_datetime(values, parsed):
+    # Check if the datetime has the format 'YYYY-MM-DD HH:MM:SS'
+    return parsed.notna()
+
+
+def check_number(values, parsed):
+    # Check if the value is a number or can be converted to a number (missing values are allowed)
+    return parsed.notna() | values.isna()
+
+
+# Validation rules: (column, rule, check, parser, required)
+# A parser converts the column once; its result is passed to the check and reused for the casting
+VALIDATION_RULES = [
+    ("account_name", "non_empty_string", check_non_empty_string, None, True),
+    ("datetime", "datetime", check_datetime, parse_datetime, True),
+    ("transaction_id", "non_empty_string", check_non_empty_string, None, True),
+    ("provider_name", "string", check_string, None, True),
+    ("currency", "currency", check_currency, None, True),
+    ("provider_id", "number", check_number, parse_number, False),
+    ("operation_type", "operation_type", check_operation_type, None, False),
+    ("amount", "number", check_number, parse_number, False),
+    ("debit", "number", check_number, parse_number, False),
+    ("credit", "number", check_number, parse_number, False),
+    ("commission", "number", check_number, parse_number, True),
+    ("commentary", "string", check_string, None, False),
+    ("client_name", "string", check_string, None, False),
+    ("description", "string", check_string, None, False),
+]
+
+VALIDATION_ERROR_COLUMNS = ["row", "column", "rule", "value"]
+
+
+def validate_frame(df):
+    # Run every rule over its whole column
+    # Return the table of errors (row, column, rule, value) and the parsed columns
+    errors = []
+    parsed_columns = {}
+
+    for column, rule, check, parser, required in VALIDATION_RULES:
+        if column not in df.columns:
+            if required:
+                errors.append(
+                    pd.DataFrame(
+                        {
+                            "row": [None],
+                            "column": [column],
+                            "rule": ["missing_column"],
+                            "value": [None],
+                        }
+                    )
+                )
+            continue
+
+        values = df[column]
+        if parser is None:
+            valid = check(values)
+        else:
+            parsed = parser(values)
+            parsed_columns[column] = parsed
+            valid = check(values, parsed)
+
+        invalid = ~valid.fillna(False).astype(bool)
+        if invalid.any():
+            errors.append(
+                pd.DataFrame(
+                    {
+                        "row": values.index[invalid],
+                        "column": column,
+                        "rule": rule,
+                        "value": values[invalid].to_numpy(),
+                    }
+                )
             )
 
-    if validation_errors:
+    if errors:
+        # Report the errors row by row, keeping the rule order inside a row
+        error_table = pd.concat(errors, ignore_index=True)
+        error_table = error_table.sort_values(
+            by="row", kind="stable", na_position="first"
+        ).reset_index(drop=True)
+    else:
+        error_table = pd.DataFrame(columns=VALIDATION_ERROR_COLUMNS)
+
+    return error_table, parsed_columns
+
+
+# Perform validation
+def perform_validation(df, df_type):
+    validation_errors, parsed_columns = validate_frame(df)
+    report_validation(validation_errors, df_type)
+    return validation_errors, parsed_columns
+
+
+def report_validation(validation_errors, df_type):
+    # Print the validation result
+    if len(validation_errors):
         print(f"{df_type}: Validation errors found:")
-        for error in validation_errors:
-            print(error)
+        for error in validation_errors.itertuples(index=False):
+            if error.rule == "missing_column":
+                print(f"{df_type}: Missing column '{error.column}'")
+            else:
+                print(
+                    f"{df_type} Row {error.row}: Invalid {error.column} '{error.value}'"
+                )
     else:
         print(f"{df_type}: All data has been uploaded and is valid.")
 
 
 # Entry point of the script
 if __name__ == "__main__":
-    main()
+    main(parse_args())
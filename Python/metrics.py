@@ -0,0 +1,128 @@
+# Run metrics of main_code.py
+# Every stage of a run (ingest, validate, cast, pair, reconcile, commission check,
+# aggregate, export) is recorded with its wall time, CPU time, rows in/out and peak RSS.
+# The records are written to a JSON or csv file, so scheduled runs can be compared, and
+# with profiling enabled the cProfile stats of the slowest stage can be dumped as well.
+
+
+import cProfile
+import csv
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; the peak RSS is then not recorded
+    resource = None
+
+
+STAGE_FIELDS = [
+    "stage",
+    "wall_seconds",
+    "cpu_seconds",
+    "rows_in",
+    "rows_out",
+    "peak_rss_mb",
+]
+
+
+def start_run(profile=False):
+    # Create the record of a run
+    return {
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "stages": [],
+        "profile": profile,
+        "profiles": {},
+    }
+
+
+def reset_peak_rss():
+    # Reset the peak RSS of the process, so the next reading is the peak of one stage (Linux)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb(reset):
+    # Peak RSS of the stage (if it could be reset) or of the whole process so far
+    if reset:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        peak = peak / 1024
+    return round(peak / 1024, 1)
+
+
+@contextmanager
+def stage(run, name, rows_in=None):
+    # Measure a stage; the caller may set 'rows_in' and 'rows_out' on the yielded record
+    record = {field: None for field in STAGE_FIELDS}
+    record["stage"] = name
+    record["rows_in"] = rows_in
+    if run is None:
+        yield record
+        return
+
+    reset = reset_peak_rss()
+    profiler = cProfile.Profile() if run["profile"] else None
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            run["profiles"][name] = profiler
+        record["wall_seconds"] = round(time.perf_counter() - wall_start, 4)
+        record["cpu_seconds"] = round(time.process_time() - cpu_start, 4)
+        record["peak_rss_mb"] = peak_rss_mb(reset)
+        run["stages"].append(record)
+
+
+def write_metrics(run, path):
+    # Write the stage records to a JSON file, or to a csv file if the path ends with '.csv'
+    if os.path.splitext(path)[1].lower() == ".csv":
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["started"] + STAGE_FIELDS)
+            writer.writeheader()
+            for record in run["stages"]:
+                writer.writerow({"started": run["started"], **record})
+        return
+
+    report = {
+        "started": run["started"],
+        "wall_seconds": round(sum(r["wall_seconds"] for r in run["stages"]), 4),
+        "cpu_seconds": round(sum(r["cpu_seconds"] for r in run["stages"]), 4),
+        "stages": run["stages"],
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def dump_hottest_profile(run, path):
+    # Dump the cProfile stats of the stage with the longest wall time; return its name
+    profiled = [r for r in run["stages"] if r["stage"] in run["profiles"]]
+    if not profiled:
+        return None
+    hottest = max(profiled, key=lambda r: r["wall_seconds"])["stage"]
+    run["profiles"][hottest].dump_stats(path)
+    return hottest
@@ -0,0 +1,104 @@
+# Watch-folder service of main_code.py
+# A long-running process polls an inbox folder for statement files and hands the new and
+# changed ones to the pipeline once they stopped growing, so the reference data stays loaded
+# between files. The latest results are served as JSON by a local HTTP endpoint; every update
+# replaces them as a whole, so a request never sees a half-updated set of reports.
+
+
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# Extensions of the statement files picked up from the inbox
+INBOX_EXTENSIONS = (".zip", ".csv")
+
+# Current answers of the endpoints: {path: JSON-serializable value}, replaced on every update
+STATE = {"endpoints": {}}
+
+
+def scan_inbox(folder, seen, pending):
+    # Files of the inbox that are new or changed and did not change since the previous scan,
+    # and the files that were removed; 'seen' and 'pending' map paths to (size, mtime)
+    # and are kept between the scans
+    current = {}
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if not name.lower().endswith(INBOX_EXTENSIONS) or not os.path.isfile(path):
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        current[path] = (stat.st_size, stat.st_mtime_ns)
+
+    ready = []
+    for path, signature in current.items():
+        if seen.get(path) == signature:
+            pending.pop(path, None)
+            continue
+        # A file is taken once it has the same size and time in two scans in a row
+        if pending.get(path) == signature:
+            ready.append(path)
+            seen[path] = signature
+            del pending[path]
+        else:
+            pending[path] = signature
+
+    removed = [path for path in seen if path not in current]
+    for path in removed:
+        del seen[path]
+    for path in [path for path in pending if path not in current]:
+        del pending[path]
+    return ready, removed
+
+
+def watch(folder, handle, interval=1.0, stop=None):
+    # Call handle(ready, removed) for every change of the inbox until 'stop' is set
+    stop = stop or threading.Event()
+    seen = {}
+    pending = {}
+    while not stop.is_set():
+        ready, removed = scan_inbox(folder, seen, pending)
+        if ready or removed:
+            handle(ready, removed)
+        stop.wait(interval)
+
+
+def publish(endpoints):
+    # Replace the answers of all endpoints at once
+    STATE["endpoints"] = dict(endpoints)
+
+
+class EndpointHandler(BaseHTTPRequestHandler):
+    # Answer GET requests with the current value of the endpoint as JSON
+
+    def do_GET(self):
+        endpoints = STATE["endpoints"]
+        path = urlsplit(self.path).path.rstrip("/") or "/"
+        if path == "/":
+            status, value = 200, {"endpoints": sorted(endpoints)}
+        elif path in endpoints:
+            status, value = 200, endpoints[path]
+        else:
+            status, value = 404, {"error": f"unknown endpoint {path}"}
+
+        body = json.dumps(value, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the console for the pipeline output
+        pass
+
+
+def start_server(host, port):
+    # Serve the endpoints from a background thread; return the server (shutdown() stops it)
+    server = ThreadingHTTPServer((host, port), EndpointHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="service", daemon=True).start()
+    return server
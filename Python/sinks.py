@@ -0,0 +1,237 @@
+# Output sinks of main_code.py
+# Every output table is written to a temporary file next to its target and renamed over the
+# target when it is complete, so a crash or a failed write never leaves a half-written file.
+# Tables are written as csv (optionally gzip or zstd compressed) or as Parquet, and
+# independent outputs are written in parallel by a thread pool while the run goes on.
+# A failed write is reported when the run waits for its outputs, instead of stopping the run.
+
+
+import gzip
+import io
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    # zstd compression is disabled when zstandard is not installed
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # The Parquet format is disabled when pyarrow is not installed
+    pa = None
+    pq = None
+
+
+FORMATS = ["csv", "parquet"]
+COMPRESSIONS = ["none", "gzip", "zstd"]
+
+# File name suffixes of the compressed csv files
+COMPRESSED_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+# Output settings of the run (set by configure()), the thread pool and the submitted writes
+SETTINGS = {"format": "csv", "compression": "none", "executor": None, "timed": False}
+PENDING = []
+
+# Outputs that could not be written since the last wait()
+FAILED = []
+
+
+def check_support(output_format, compression):
+    # Return why the format or the compression can not be used, or None
+    if output_format == "parquet" and pq is None:
+        return "the Parquet output format requires pyarrow"
+    if compression == "zstd" and output_format == "csv" and zstandard is None:
+        return "zstd compression of csv files requires zstandard"
+    return None
+
+
+def configure(output_format="csv", compression="none", workers=1, timed=False):
+    # Set the format and compression of the outputs, the number of writing threads and
+    # whether the writes are timed by the stages that submit them (see settle())
+    wait()
+    if SETTINGS["executor"] is not None:
+        SETTINGS["executor"].shutdown()
+    SETTINGS["format"] = output_format
+    SETTINGS["compression"] = compression
+    SETTINGS["timed"] = timed
+    SETTINGS["executor"] = (
+        ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sink")
+        if workers > 1
+        else None
+    )
+
+
+def output_path(path):
+    # Path of an output in the configured format, e.g. 'commissions.csv.gz'
+    if SETTINGS["format"] == "parquet":
+        return os.path.splitext(path)[0] + ".parquet"
+    return path + COMPRESSED_SUFFIXES.get(SETTINGS["compression"], "")
+
+
+def temporary_path(path):
+    # Unique temporary path next to 'path', so concurrent runs never write the same file
+    return f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+
+
+@contextmanager
+def atomic_path(path):
+    # Yield a temporary path and move it over 'path' once the block completed
+    # The temporary file is removed if the block or the move fails
+    tmp_path = temporary_path(path)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def csv_compression():
+    # pandas compression options of the csv outputs
+    compression = SETTINGS["compression"]
+    if compression == "none":
+        return None
+    if compression == "gzip":
+        # A fixed timestamp keeps the compressed files reproducible
+        return {"method": "gzip", "mtime": 0}
+    return {"method": compression}
+
+
+def parquet_compression():
+    # Parquet codec of the outputs
+    compression = SETTINGS["compression"]
+    return None if compression == "none" else compression
+
+
+def write_frame(df, path):
+    # Write a DataFrame atomically to its output path in the configured format
+    with atomic_path(path) as tmp_path:
+        if SETTINGS["format"] == "parquet":
+            df.to_parquet(tmp_path, index=False, compression=parquet_compression())
+        else:
+            df.to_csv(tmp_path, index=False, compression=csv_compression())
+
+
+def report_failure(path, error=None):
+    # Print why an output could not be written and remember it
+    if error is None or isinstance(error, PermissionError):
+        print(
+            f"Permission denied: The file {path} might be open in another program or you don't have write access."
+        )
+    else:
+        print(f"The file {path} could not be written: {error}")
+    FAILED.append(path)
+
+
+def save_frame(df, path):
+    # Write a DataFrame, in the background when the thread pool is enabled
+    # Return False if the output could not be written (known at once only without the pool)
+    path = output_path(path)
+    executor = SETTINGS["executor"]
+    if executor is None:
+        try:
+            write_frame(df, path)
+        except OSError as error:
+            report_failure(path, error)
+            return False
+        return True
+
+    # The shallow copy keeps the written columns if the caller adds columns to its frame
+    PENDING.append((path, executor.submit(write_frame, df.copy(deep=False), path)))
+    return True
+
+
+def drain():
+    # Wait for the submitted writes and report the ones that failed
+    for path, future in PENDING:
+        try:
+            future.result()
+        except OSError as error:
+            report_failure(path, error)
+    PENDING.clear()
+
+
+def settle():
+    # Wait for the submitted writes when they are timed, so that the stage that submitted
+    # them measures their I/O and not only their submission
+    if SETTINGS["timed"]:
+        drain()
+
+
+def wait():
+    # Wait for the submitted writes; return the outputs that could not be written
+    drain()
+    failed = list(FAILED)
+    FAILED.clear()
+    return failed
+
+
+def open_stream(path):
+    # Start an output that is written block by block (e.g. one block per partition)
+    path = output_path(path)
+    return {
+        "path": path,
+        "tmp_path": temporary_path(path),
+        "file": None,
+        "writer": None,
+    }
+
+
+def append_stream(stream, df):
+    # Append a block of rows to a stream; the first block also writes the header
+    if SETTINGS["format"] == "parquet":
+        if stream["writer"] is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            stream["writer"] = pq.ParquetWriter(
+                stream["tmp_path"], table.schema, compression=parquet_compression()
+            )
+        else:
+            table = pa.Table.from_pandas(
+                df, schema=stream["writer"].schema, preserve_index=False
+            )
+        stream["writer"].write_table(table)
+        return
+
+    first = stream["file"] is None
+    if first:
+        stream["file"] = open_csv(stream["tmp_path"])
+    df.to_csv(stream["file"], index=False, header=first)
+
+
+def open_csv(path):
+    # Open a csv file for writing as text with the configured compression
+    compression = SETTINGS["compression"]
+    if compression == "gzip":
+        return io.TextIOWrapper(
+            gzip.GzipFile(path, "wb", mtime=0), encoding="utf-8", newline=""
+        )
+    if compression == "zstd":
+        return io.TextIOWrapper(
+            zstandard.open(path, "wb"), encoding="utf-8", newline=""
+        )
+    return open(path, "w", encoding="utf-8", newline="")
+
+
+def close_stream(stream, complete=True):
+    # Finish a stream and move it over its target, or discard it if it is not complete
+    if stream["writer"] is not None:
+        stream["writer"].close()
+    if stream["file"] is not None:
+        stream["file"].close()
+    if not complete or not os.path.exists(stream["tmp_path"]):
+        if os.path.exists(stream["tmp_path"]):
+            os.remove(stream["tmp_path"])
+        return False
+    try:
+        os.replace(stream["tmp_path"], stream["path"])
+    except OSError as error:
+        report_failure(stream["path"], error)
+        os.remove(stream["tmp_path"])
+        return False
+    return True
@@ -0,0 +1,145 @@
+# State store of the incremental runs of main_code.py
+# Keeps in a SQLite file:
+#   - the content hash of every processed statement (zip member or csv file),
+#   - the content hash of every register month,
+#   - the parsed statements and the per-month results of Task 2, Task 3 and Task 4,
+# so that a run only has to process new or changed statements and register months.
+
+
+import sqlite3
+
+import pandas as pd
+
+# Tables holding DataFrames, with the columns used to restore their types on load
+FRAME_TABLES = {
+    "statements": {"datetime": ["datetime"], "bool": []},
+    "register_fullness": {
+        "datetime": ["datetime"],
+        "bool": ["is_present_in_register"],
+    },
+    "commissions": {
+        "datetime": ["datetime"],
+        "bool": ["is_present_in_register", "is_correct_commission"],
+    },
+    "reconciliation_ambiguous": {
+        "datetime": ["datetime", "datetime_register"],
+        "bool": [],
+    },
+    "unpaired_legs": {"datetime": ["datetime"], "bool": []},
+    "fin_banks": {"datetime": [], "bool": [], "period": ["year_month"]},
+}
+
+
+def open_store(path):
+    # Open (and create if needed) the state store
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, content_hash TEXT)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS register_partitions (year_month TEXT PRIMARY KEY, content_hash TEXT)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)"
+    )
+    conn.commit()
+    return conn
+
+
+def reset_if_settings_changed(conn, settings):
+    # Forget all hashes and stored frames when the settings differ from the stored ones
+    row = conn.execute("SELECT value FROM settings WHERE name = 'run'").fetchone()
+    if row is not None and row[0] == settings:
+        return
+    if row is not None:
+        conn.execute("DELETE FROM sources")
+        conn.execute("DELETE FROM register_partitions")
+        for table in FRAME_TABLES:
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.execute(
+        "INSERT OR REPLACE INTO settings (name, value) VALUES ('run', ?)", (settings,)
+    )
+    conn.commit()
+
+
+def read_hashes(conn, table, key):
+    # Return the stored {key: content_hash} of the 'sources' or 'register_partitions' table
+    rows = conn.execute(f"SELECT {key}, content_hash FROM {table}").fetchall()
+    return dict(rows)
+
+
+def write_hashes(conn, table, key, hashes, removed=()):
+    # Store the new content hashes and forget the removed keys
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {table} ({key}, content_hash) VALUES (?, ?)",
+        list(hashes.items()),
+    )
+    conn.executemany(
+        f"DELETE FROM {table} WHERE {key} = ?", [(item,) for item in removed]
+    )
+
+
+def table_exists(conn, table):
+    # Check if a DataFrame table has been stored already
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    return row is not None
+
+
+def delete_rows(conn, table, column, values):
+    # Delete the rows of a DataFrame table whose column is in values
+    if not values or not table_exists(conn, table):
+        return
+    conn.executemany(
+        f'DELETE FROM {table} WHERE "{column}" = ?', [(value,) for value in values]
+    )
+
+
+def append_frame(conn, table, df):
+    # Append a DataFrame to a table, storing periods as text
+    if df.empty:
+        return
+    df = df.copy()
+    for column in FRAME_TABLES[table].get("period", []):
+        df[column] = df[column].astype(str)
+    df.to_sql(table, conn, if_exists="append", index=False)
+
+
+def load_frame(conn, table, column=None, values=None):
+    # Load a DataFrame table (optionally only the rows whose column is in values)
+    if not table_exists(conn, table):
+        return None
+
+    query = f"SELECT * FROM {table}"
+    params = []
+    if column is not None:
+        values = list(values)
+        if not values:
+            query += " WHERE 0"
+        else:
+            query += f' WHERE "{column}" IN ({", ".join("?" * len(values))})'
+            params = values
+    df = pd.read_sql_query(query, conn, params=params)
+
+    # Restore the types lost in SQLite
+    types = FRAME_TABLES[table]
+    for name in types["datetime"]:
+        df[name] = pd.to_datetime(df[name])
+    for name in types["bool"]:
+        df[name] = df[name].astype(bool)
+    for name in types.get("period", []):
+        df[name] = pd.PeriodIndex(df[name], freq="M")
+    return df
+
+
+def source_months(conn, sources):
+    # Months ('YYYY-MM') of the stored statements that came from the given sources
+    if not sources or not table_exists(conn, "statements"):
+        return set()
+    sources = list(sources)
+    rows = conn.execute(
+        f'SELECT DISTINCT substr(datetime, 1, 7) FROM statements WHERE source IN ({", ".join("?" * len(sources))})',
+        sources,
+    ).fetchall()
+    return {row[0] for row in rows}